@@ -0,0 +1,234 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+for folder in ("Common", "Step 1", "Step 2", "Step 3"):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+sys.path.insert(0, BENCH)
+from phantom import make_cohort
+
+##팬텀 코호트로 Step 함수들을 하나씩 재서 JSON 리포트로 남김 (커밋끼리 비교용)
+##단계마다 새 프로세스(spawn)에서 돌려서 peak RSS가 단계별로 따로 나옴
+##리포트: 단계별 호출 수, 지연시간 평균/백분위(p50/p90/p95/p99), 초당 호출 수, 초당 백만 복셀, peak RSS(MB)
+
+STEPS = ["segmentation", "dicom2nifti", "stl", "hu_features", "hu_features_store", "hu_histogram",
+         "dicom_series_cold", "dicom_series_warm", "rtstruct"]
+
+def _peak_rss_mb(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    ##ru_maxrss는 리눅스에서 KB, macOS에서 바이트
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss / scale
+
+##단계 하나의 (준비, 측정 대상) 함수 만들기. 준비는 시간에 안 들어감
+def _step_calls(step, case, organ, scratch):
+    ct_voxels = None
+    if step == "segmentation":
+        from TotalSegmentator import run_segmentation
+        out = os.path.join(scratch, "seg")
+        return (lambda: shutil.rmtree(out, ignore_errors=True)), \
+            (lambda: run_segmentation(case["dicom_folder"], _mkdir(out), organ)), ct_voxels
+    if step == "dicom2nifti":
+        from DICOM_2_NIFTI import convert_dicom_folder
+        out = os.path.join(scratch, "nifti")
+        return (lambda: shutil.rmtree(out, ignore_errors=True)), \
+            (lambda: convert_dicom_folder(case["dicom_folder"], out, case["phase"])), ct_voxels
+    if step == "stl":
+        from NIFTI_2_STL import nifti_to_stl
+        stl_path = os.path.join(scratch, "bench.stl")
+        return None, (lambda: nifti_to_stl(case["mask_paths"][organ], stl_path)), ct_voxels
+    if step == "hu_features":
+        from sdf import extract_hu_features
+        return None, (lambda: extract_hu_features(case["ct_path"], case["mask_paths"][organ])), ct_voxels
+    if step == "hu_features_store":
+        ##저장소로 가져오는 건 준비 단계(시간 안 잼), 장기 주변 블록만 읽는 경로를 hu_features와 비교
+        from sdf import hu_features_case
+        from volume_store import import_case, store_cases
+        store = os.path.join(scratch, "store")
+        import_case(store, {"patient_id": case["patient_id"], "phase": case["phase"], "ct_path": case["ct_path"],
+                            "mask_paths": {organ: case["mask_paths"][organ]}})
+        stored = [c for c in store_cases(store, organ, (case["phase"],)) if c["patient_id"] == case["patient_id"]][0]
+
+        def run():
+            rows = hu_features_case(stored)
+            if rows[0]["status"] != "ok":
+                raise RuntimeError(rows[0]["error"])
+        return None, run, ct_voxels
+    if step == "hu_histogram":
+        from HU_Histogram import hu_histogram
+        from volume_io import load_mask, load_volume
+        ct, _ = load_volume(case["ct_path"], mmap=False)
+        mask, _ = load_mask(case["mask_paths"][organ], mmap=False)
+        values = np.asarray(ct)[np.asarray(mask)]
+        return None, (lambda: hu_histogram(values)), values.size
+    if step.startswith("dicom_series"):
+        import dicom_index
+        from rtstructb import validate_dicom_series
+        index_path = dicom_index.DEFAULT_INDEX_PATH
+        cold = step.endswith("cold")
+        setup = (lambda: os.path.exists(index_path) and os.remove(index_path)) if cold else None
+        if not cold:
+            validate_dicom_series(case["dicom_folder"])
+        return setup, (lambda: validate_dicom_series(case["dicom_folder"])), ct_voxels
+    if step == "rtstruct":
+        from rtstructb import process_patient
+        out = os.path.join(scratch, "rtstruct")
+        dicom_root = os.path.dirname(os.path.dirname(case["dicom_folder"]))
+        seg_root = os.path.dirname(os.path.dirname(os.path.dirname(case["mask_paths"][organ])))
+
+        def run():
+            _, status, output = process_patient((case["patient_id"], dicom_root, seg_root, out, None,
+                                                 case["phase"], [organ], None))
+            if output is None:
+                raise RuntimeError(status)
+        return (lambda: shutil.rmtree(out, ignore_errors=True)), run, ct_voxels
+    raise ValueError(f"모르는 단계: {step}")
+
+def _mkdir(path):
+    os.makedirs(path, exist_ok=True)
+    return path
+
+##자식 프로세스에서 도는 부분: 케이스마다 repeat번 재고, 실패는 따로 셈
+def _run_step(step, cases, organ, repeat, workdir):
+    os.environ["DICOM_INDEX_PATH"] = os.path.join(workdir, "dicom_index.sqlite")
+    os.environ["PATH"] = os.path.join(BENCH, "bin") + os.pathsep + os.environ.get("PATH", "")
+    latencies, voxels, errors = [], [], []
+    scratch = tempfile.mkdtemp(dir=workdir, prefix=f"{step}_")
+    for case in cases:
+        try:
+            setup, call, units = _step_calls(step, case, organ, scratch)
+        except Exception as e:
+            errors.append(f"{case['patient_id']}/{case['phase']}: {e}")
+            continue
+        if units is None:
+            import nibabel as nib
+            units = int(np.prod(nib.load(case["ct_path"]).shape[:3]))
+        for _ in range(repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            try:
+                result = call()
+                if result is False:
+                    raise RuntimeError("False를 돌려줌")
+            except Exception as e:
+                errors.append(f"{case['patient_id']}/{case['phase']}: {e}")
+                continue
+            latencies.append(time.perf_counter() - start)
+            voxels.append(units)
+    rss = _peak_rss_mb()
+    children = _peak_rss_mb(children=True)
+    return {"latencies": latencies, "voxels": voxels, "errors": errors,
+            "peak_rss_mb": rss, "peak_child_rss_mb": children}
+
+def summarize(raw):
+    latencies = np.asarray(raw["latencies"], dtype=np.float64)
+    summary = {"calls": int(latencies.size), "errors": raw["errors"][:10], "error_count": len(raw["errors"]),
+               "peak_rss_mb": raw["peak_rss_mb"], "peak_child_rss_mb": raw["peak_child_rss_mb"]}
+    if latencies.size:
+        p50, p90, p95, p99 = np.percentile(latencies, [50, 90, 95, 99])
+        summary.update(
+            mean_s=float(latencies.mean()), min_s=float(latencies.min()), max_s=float(latencies.max()),
+            p50_s=float(p50), p90_s=float(p90), p95_s=float(p95), p99_s=float(p99),
+            calls_per_s=float(latencies.size / latencies.sum()),
+            mvoxels_per_s=float(np.sum(raw["voxels"]) / latencies.sum() / 1e6),
+        )
+    return summary
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+##팬텀 만들고 단계별로 재서 리포트 dict 돌려줌 (output_json이 있으면 저장)
+def run_benchmark(workdir, steps=None, patients=2, rows=256, cols=256, slices=64, spacing=(0.8, 0.8, 2.5),
+                  organ="pancreas", repeat=3, seed=0, output_json=None):
+    steps = steps or STEPS
+    os.makedirs(workdir, exist_ok=True)
+    build_start = time.perf_counter()
+    cases = make_cohort(os.path.join(workdir, "phantom"), patients, ("PRE",), rows, cols, slices, spacing, seed=seed)
+    report = {
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {"patients": patients, "shape": [rows, cols, slices], "spacing": list(spacing),
+                   "organ": organ, "repeat": repeat, "seed": seed},
+        "phantom_seconds": round(time.perf_counter() - build_start, 2),
+        "steps": {},
+    }
+
+    spawn = multiprocessing.get_context("spawn")
+    for step in steps:
+        with spawn.Pool(1) as pool:
+            raw = pool.apply(_run_step, (step, cases, organ, repeat, workdir))
+        report["steps"][step] = summarize(raw)
+        s = report["steps"][step]
+        if s["calls"]:
+            print(f"{step:>18}: p50 {s['p50_s'] * 1e3:8.1f} ms, p95 {s['p95_s'] * 1e3:8.1f} ms, "
+                  f"{s['calls_per_s']:7.2f} 회/s, peak RSS {s['peak_rss_mb'] or 0:.0f} MB")
+        else:
+            print(f"{step:>18}: 전부 실패 ({s['errors'][:1]})")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"리포트 저장: {output_json}")
+    return report
+
+##두 리포트의 단계별 p50 비교 (1보다 작으면 빨라진 것)
+def compare_reports(baseline, current):
+    rows = []
+    for step, now in current["steps"].items():
+        before = baseline.get("steps", {}).get(step)
+        if not before or "p50_s" not in before or "p50_s" not in now:
+            continue
+        rows.append((step, before["p50_s"], now["p50_s"], now["p50_s"] / before["p50_s"]))
+    for step, before, now, ratio in rows:
+        print(f"{step:>18}: {before * 1e3:8.1f} ms -> {now * 1e3:8.1f} ms (x{ratio:.2f})")
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="팬텀 데이터로 Step 함수 벤치마크")
+    parser.add_argument("--workdir", default=None, help="팬텀/임시 파일 폴더 (기본: 임시 폴더, 끝나면 지움)")
+    parser.add_argument("--steps", nargs="+", default=STEPS, choices=STEPS)
+    parser.add_argument("--patients", type=int, default=2)
+    parser.add_argument("--shape", type=int, nargs=3, default=[256, 256, 64], metavar=("ROWS", "COLS", "SLICES"))
+    parser.add_argument("--spacing", type=float, nargs=3, default=[0.8, 0.8, 2.5], metavar=("ROW", "COL", "Z"))
+    parser.add_argument("--organ", default="pancreas")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--compare", default=None, help="비교할 예전 리포트 JSON")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="sis_bench_")
+    try:
+        report = run_benchmark(workdir, args.steps, args.patients, *args.shape, spacing=tuple(args.spacing),
+                               organ=args.organ, repeat=args.repeat, seed=args.seed, output_json=args.output)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_reports(json.load(f), report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
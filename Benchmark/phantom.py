@@ -0,0 +1,127 @@
+import os
+import sys
+import numpy as np
+import nibabel as nib
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Common"))
+from geometry import dicom_affine
+
+##환자 데이터를 밖으로 못 가져가니까 벤치마크용 가짜 CT(타원체 장기 + HU 잡음)를 만듦, 네트워크 없이 pydicom/nibabel만
+##레이아웃은 실제 Step 결과와 같게:
+##  {root}/dicom/{환자}/{phase}/IM0000.dcm ...
+##  {root}/nifti/{환자 3자리}/{환자 3자리}_{phase}.nii
+##  {root}/seg/{환자}/{phase}/{환자}_{phase}_{organ}.nii.gz
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+##장기 이름: (중심 위치 [열, 행, 슬라이스] 비율, 반지름 mm [열, 행, 슬라이스], 평균 HU)
+DEFAULT_ORGANS = {
+    "liver": ((0.35, 0.45, 0.5), (70.0, 60.0, 60.0), 60),
+    "pancreas": ((0.6, 0.55, 0.5), (40.0, 15.0, 20.0), 40),
+    "spleen": ((0.75, 0.4, 0.5), (25.0, 30.0, 40.0), 50),
+}
+
+##(행, 열, 슬라이스) 순서의 HU 볼륨과 장기별 bool 마스크. 몸통은 타원 기둥(0 HU), 바깥은 공기(-1000)
+def phantom_volume(rows=256, cols=256, slices=64, spacing=(0.8, 0.8, 2.5), organs=None, noise=15.0, seed=0):
+    organs = DEFAULT_ORGANS if organs is None else organs
+    rng = np.random.default_rng(seed)
+    r, c, k = np.ogrid[:rows, :cols, :slices]
+    row_mm, col_mm, z_mm = spacing[0], spacing[1], spacing[2]
+
+    body = ((c - cols / 2) / (cols * 0.45)) ** 2 + ((r - rows / 2) / (rows * 0.35)) ** 2 <= 1
+    hu = np.where(body, 0.0, -1000.0) * np.ones((1, 1, slices))
+    masks = {}
+    for name, (center, radii, mean_hu) in organs.items():
+        cc, cr, ck = center[0] * cols, center[1] * rows, center[2] * slices
+        mask = (((c - cc) * col_mm / radii[0]) ** 2 + ((r - cr) * row_mm / radii[1]) ** 2
+                + ((k - ck) * z_mm / radii[2]) ** 2) <= 1
+        mask &= body
+        hu[mask] = mean_hu
+        masks[name] = mask
+    hu += rng.normal(0.0, noise, hu.shape)
+    return np.clip(np.rint(hu), -1024, 3071).astype(np.int16), masks
+
+##슬라이스마다 DICOM 파일 하나 (rt_utils가 RTSTRUCT 만들 때 필요한 환자/검사 태그까지)
+def write_dicom_series(folder, hu, spacing, patient_id="1", seed=0):
+    os.makedirs(folder, exist_ok=True)
+    rows, cols, slices = hu.shape
+    study_uid = generate_uid(entropy_srcs=[f"study{seed}"])
+    series_uid = generate_uid(entropy_srcs=[f"series{seed}{folder}"])
+    frame_uid = generate_uid(entropy_srcs=[f"frame{seed}"])
+    stored = (hu.astype(np.int32) + 1024).astype(np.uint16)
+    paths = []
+    for k in range(slices):
+        sop_uid = generate_uid(entropy_srcs=[series_uid, str(k)])
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+        meta.MediaStorageSOPInstanceUID = sop_uid
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SOPClassUID, ds.SOPInstanceUID = CT_IMAGE_STORAGE, sop_uid
+        ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.FrameOfReferenceUID = study_uid, series_uid, frame_uid
+        ds.Modality = "CT"
+        ds.PatientID, ds.PatientName, ds.PatientBirthDate, ds.PatientSex = patient_id, f"PHANTOM^{patient_id}", "", "O"
+        ds.StudyDate, ds.StudyTime, ds.StudyID, ds.AccessionNumber = "20240101", "120000", "1", ""
+        ds.ReferringPhysicianName, ds.StudyDescription, ds.SeriesDescription = "", "phantom", "phantom"
+        ds.SeriesNumber, ds.InstanceNumber, ds.Manufacturer = 1, k + 1, "phantom"
+        ds.PositionReferenceIndicator = ""
+        ds.ImagePositionPatient = [-(cols / 2) * spacing[1], -(rows / 2) * spacing[0], k * spacing[2]]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [spacing[0], spacing[1]]
+        ds.SliceThickness = spacing[2]
+        ds.Rows, ds.Columns = rows, cols
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, "MONOCHROME2"
+        ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+        ds.PixelData = np.ascontiguousarray(stored[:, :, k]).tobytes()
+        path = os.path.join(folder, f"IM{k:04d}.dcm")
+        ds.save_as(path, enforce_file_format=True)
+        paths.append(path)
+    return paths
+
+##DICOM과 같은 좌표의 NIfTI affine (인덱스 순서 열, 행, 슬라이스)
+def phantom_affine(rows, cols, slices, spacing):
+    headers = [{
+        "ImageOrientationPatient": [1, 0, 0, 0, 1, 0],
+        "PixelSpacing": [spacing[0], spacing[1]],
+        "ImagePositionPatient": [-(cols / 2) * spacing[1], -(rows / 2) * spacing[0], k * spacing[2]],
+        "SliceThickness": spacing[2],
+    } for k in range(slices)]
+    return dicom_affine(headers)
+
+##환자 n명 x phase 코호트 한 벌 만들기, 케이스 목록(cohort.discover_cases와 같은 모양 + dicom_folder) 돌려줌
+def make_cohort(root, patients=2, phases=("PRE",), rows=256, cols=256, slices=64, spacing=(0.8, 0.8, 2.5),
+                organs=None, noise=15.0, seed=0):
+    cases = []
+    for p in range(1, patients + 1):
+        patient_id = str(p)
+        padded = patient_id.zfill(3)
+        for phase_index, phase in enumerate(phases):
+            case_seed = seed * 1000 + p * 10 + phase_index
+            hu, masks = phantom_volume(rows, cols, slices, spacing, organs, noise, case_seed)
+            dicom_folder = os.path.join(root, "dicom", patient_id, phase)
+            write_dicom_series(dicom_folder, hu, spacing, patient_id, case_seed)
+
+            affine = phantom_affine(rows, cols, slices, spacing)
+            ct_path = os.path.join(root, "nifti", padded, f"{padded}_{phase}.nii")
+            os.makedirs(os.path.dirname(ct_path), exist_ok=True)
+            nib.save(nib.Nifti1Image(hu.transpose(1, 0, 2), affine), ct_path)
+
+            mask_paths = {}
+            for organ, mask in masks.items():
+                mask_path = os.path.join(root, "seg", patient_id, phase, f"{patient_id}_{phase}_{organ}.nii.gz")
+                os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+                nib.save(nib.Nifti1Image(mask.transpose(1, 0, 2).astype(np.uint8), affine), mask_path)
+                mask_paths[organ] = mask_path
+            cases.append({"patient_id": patient_id, "phase": phase, "dicom_folder": dicom_folder,
+                          "ct_path": ct_path, "mask_paths": mask_paths})
+    return cases
+
+if __name__ == "__main__":
+    root = input("팬텀 코호트를 만들 폴더: ").strip().strip('"')
+    patients = input("환자 수 (기본 2): ").strip()
+    made = make_cohort(root, int(patients) if patients.isdigit() else 2)
+    print(f"팬텀 {len(made)}건 완성: {root}")
@@ -0,0 +1,87 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import nibabel as nib
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+for folder in ("Common", "Step 3"):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+sys.path.insert(0, BENCH)
+from phantom import make_cohort
+
+##팬텀 한 건으로 타일로 나눠 계산한 voxel 특징 맵이 통째로 계산한 맵과 같은지 확인 (Pyradiomics.voxel_feature_maps)
+##타일 크기는 ROI에서 가장 긴 축의 절반이라 적어도 2개로 나뉨. 다른 특징 이름이나 값이 atol보다 다르면 실패
+
+DEFAULT_PARAMS = """imageType:
+  Original: {}
+featureClass:
+  firstorder:
+  glcm:
+  glrlm:
+  glszm:
+  gldm:
+  ngtdm:
+setting:
+  binWidth: 25
+voxelSetting:
+  kernelRadius: 1
+"""
+
+def check_voxel_tiling(workdir, organ="liver", param_path=None, tile_size=None, rows=48, cols=48, slices=16,
+                       atol=1e-4, max_workers=2):
+    from Pyradiomics import voxel_feature_maps, voxel_tiles
+
+    case = make_cohort(os.path.join(workdir, "phantom"), 1, ("PRE",), rows, cols, slices, (3.0, 3.0, 4.0))[0]
+    if param_path is None:
+        param_path = os.path.join(workdir, "voxel_params.yaml")
+        with open(param_path, "w", encoding="utf-8") as f:
+            f.write(DEFAULT_PARAMS)
+    mask = np.asarray(nib.load(case["mask_paths"][organ]).dataobj).transpose(2, 1, 0) > 0
+    if tile_size is None:
+        coords = np.argwhere(mask)
+        tile_size = int(np.ceil((coords.max(axis=0) - coords.min(axis=0) + 1).max() / 2))
+    tiles = len(voxel_tiles(mask, tile_size))
+
+    whole = voxel_feature_maps(case["ct_path"], case["mask_paths"][organ], os.path.join(workdir, "whole"),
+                               param_path, tile_size=None, max_workers=max_workers)
+    tiled = voxel_feature_maps(case["ct_path"], case["mask_paths"][organ], os.path.join(workdir, "tiled"),
+                               param_path, tile_size=tile_size, max_workers=max_workers)
+
+    problems = []
+    if set(whole) != set(tiled):
+        problems.append(f"특징 이름이 달라요: {sorted(set(whole) ^ set(tiled))}")
+    for name in sorted(set(whole) & set(tiled)):
+        a = np.asarray(nib.load(whole[name]).dataobj)
+        b = np.asarray(nib.load(tiled[name]).dataobj)
+        both_nan = np.isnan(a) & np.isnan(b)
+        diff = np.where(both_nan, 0, np.abs(a - b))
+        if np.isnan(diff).any() or diff.max() > atol * max(1.0, np.nanmax(np.abs(a))):
+            problems.append(f"{name}: 최대 차이 {np.nanmax(diff):.3g}")
+    print(f"타일 {tiles}개 (tile_size {tile_size}), 특징 맵 {len(whole)}개 비교: "
+          + ("모두 같음" if not problems else f"{len(problems)}개 다름"))
+    for problem in problems[:20]:
+        print(f" - {problem}")
+    return {"tiles": tiles, "tile_size": tile_size, "features": len(whole), "problems": problems}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="타일 voxel 특징 맵이 통째로 계산한 것과 같은지 팬텀으로 확인")
+    parser.add_argument("--workdir", default=None, help="팬텀/맵 저장 폴더 (기본: 임시 폴더, 끝나면 지움)")
+    parser.add_argument("--organ", default="liver")
+    parser.add_argument("--params", default=None, help="PyRadiomics YAML (기본: 원본 이미지, 텍스처 클래스 전부)")
+    parser.add_argument("--tile-size", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="sis_voxel_check_")
+    try:
+        result = check_voxel_tiling(workdir, args.organ, args.params, args.tile_size)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if result["tiles"] >= 2 and not result["problems"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+import os
+
+##Step 1/Step 2 결과 폴더 구조에서 환자/phase별 CT와 장기 마스크 경로를 찾아줌
+##CT:   {ct_base}/{환자}/{환자}_{phase}.nii            (DICOM_2_NIFTI, 환자 번호 3자리로 채움)
+##마스크: {seg_base}/{환자}/{phase}/{환자}_{phase}_{organ}.nii.gz (TotalSegmentator rename_output)
+
+def _normalize_id(patient_id: str) -> str:
+    return patient_id.lstrip("0") or "0"
+
+##환자 폴더 이름이 0으로 채워졌는지와 상관없이 같은 환자끼리 묶음
+def _patient_folders(base: str) -> dict:
+    if not base or not os.path.isdir(base):
+        return {}
+    return {
+        _normalize_id(name): name
+        for name in os.listdir(base)
+        if name.isdigit() and os.path.isdir(os.path.join(base, name))
+    }
+
+def find_ct_path(ct_base: str, patient_folder: str, phase: str):
+    folder = os.path.join(ct_base, patient_folder)
+    for name in (f"{patient_folder}_{phase}.nii", f"{patient_folder}_{phase}.nii.gz"):
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+def find_mask_path(seg_base: str, patient_folder: str, phase: str, organ: str):
+    folder = os.path.join(seg_base, patient_folder, phase)
+    for name in (f"{patient_folder}_{phase}_{organ}.nii.gz", f"{patient_folder}_{phase}_{organ}.nii",
+                 f"{organ}.nii.gz", f"{organ}.nii"):
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+##CT가 있는 환자/phase마다 {"patient_id", "phase", "ct_path", "mask_paths": {organ: 경로 또는 None}}
+def discover_cases(ct_base: str, seg_base: str, organs, phases=("PRE", "POST")) -> list:
+    if isinstance(organs, str):
+        organs = [organs]
+    ct_folders = _patient_folders(ct_base)
+    seg_folders = _patient_folders(seg_base)
+
+    cases = []
+    for key in sorted(ct_folders, key=int):
+        ct_folder = ct_folders[key]
+        seg_folder = seg_folders.get(key)
+        for phase in phases:
+            ct_path = find_ct_path(ct_base, ct_folder, phase)
+            if ct_path is None:
+                continue
+            cases.append({
+                "patient_id": ct_folder,
+                "phase": phase,
+                "ct_path": ct_path,
+                "mask_paths": {
+                    organ: find_mask_path(seg_base, seg_folder, phase, organ) if seg_folder else None
+                    for organ in organs
+                },
+            })
+    return cases
@@ -0,0 +1,133 @@
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+
+##DICOM 헤더를 파일당 한 번만(stop_before_pixels) 읽어서 경로+수정시각 기준으로 저장해 두는 색인
+##validate_dicom_series, validate_dicom_folder, DICOM_2_NIFTI가 각자 dcmread 하지 않고 여기서 꺼내 씀
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+##저장된 헤더 형식이 바뀌면 올림, 버전이 다른 색인 항목은 다시 읽음
+HEADER_VERSION = 2
+DEFAULT_INDEX_PATH = os.environ.get(
+    "DICOM_INDEX_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "sis_pipeline", "dicom_index.sqlite"),
+)
+
+##.dcm 이거나 확장자가 없는 파일만 DICOM 후보로 봄 (TotalSegmentator.validate_dicom_folder와 같은 기준)
+def is_dicom_candidate(fname: str) -> bool:
+    return fname.lower().endswith(".dcm") or "." not in fname
+
+def _float_list(value):
+    return [float(v) for v in value] if value is not None else None
+
+def _slice_position(ipp, iop):
+    ##슬라이스 법선(행 방향 x 열 방향)에 IPP를 투영한 값, 축방향이 아니어도 정렬 가능
+    if ipp is None or iop is None or len(iop) != 6:
+        return ipp[2] if ipp else None
+    r, c = iop[:3], iop[3:]
+    normal = (r[1] * c[2] - r[2] * c[1], r[2] * c[0] - r[0] * c[2], r[0] * c[1] - r[1] * c[0])
+    return sum(p * n for p, n in zip(ipp, normal))
+
+def read_header(path: str) -> dict:
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, force=True)
+        ##force=True면 DICOM이 아닌 파일도 읽히므로 SOPClassUID나 Modality가 있을 때만 DICOM으로 봄
+        if "SOPClassUID" not in ds and "Modality" not in ds:
+            return {"path": path, "valid": False, "version": HEADER_VERSION}
+        ipp = _float_list(ds.get("ImagePositionPatient"))
+        iop = _float_list(ds.get("ImageOrientationPatient"))
+        return {
+            "path": path,
+            "valid": True,
+            "version": HEADER_VERSION,
+            "Modality": str(ds.get("Modality", "")),
+            "SOPClassUID": str(ds.get("SOPClassUID", "")),
+            "SeriesInstanceUID": str(ds.get("SeriesInstanceUID", "")),
+            "InstanceNumber": int(ds.InstanceNumber) if ds.get("InstanceNumber") is not None else None,
+            "ImagePositionPatient": ipp,
+            "ImageOrientationPatient": iop,
+            "PixelSpacing": _float_list(ds.get("PixelSpacing")),
+            "SliceThickness": float(ds.SliceThickness) if ds.get("SliceThickness") is not None else None,
+            "Rows": int(ds.Rows) if ds.get("Rows") is not None else None,
+            "Columns": int(ds.Columns) if ds.get("Columns") is not None else None,
+            "RescaleSlope": float(ds.get("RescaleSlope", 1) or 1),
+            "RescaleIntercept": float(ds.get("RescaleIntercept", 0) or 0),
+            "SlicePosition": _slice_position(ipp, iop),
+        }
+    except Exception:
+        return {"path": path, "valid": False, "version": HEADER_VERSION}
+
+def _connect(index_path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    conn = sqlite3.connect(index_path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS headers ("
+        " path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, header TEXT NOT NULL)"
+    )
+    return conn
+
+##폴더 안 DICOM 후보 파일의 헤더를 돌려줌, 색인에 없거나 바뀐 파일만 스레드 풀로 새로 읽음
+def index_folder(folder: str, index_path: str = None, max_workers: int = 8) -> list:
+    index_path = index_path or DEFAULT_INDEX_PATH
+    files = []
+    for entry in os.scandir(folder):
+        if entry.is_file() and is_dicom_candidate(entry.name):
+            st = entry.stat()
+            files.append((os.path.abspath(entry.path), st.st_mtime_ns, st.st_size))
+    if not files:
+        return []
+
+    conn = _connect(index_path)
+    try:
+        cached = {}
+        for path, mtime_ns, size in files:
+            row = conn.execute(
+                "SELECT mtime_ns, size, header FROM headers WHERE path = ?", (path,)
+            ).fetchone()
+            if row and row[0] == mtime_ns and row[1] == size:
+                header = json.loads(row[2])
+                if header.get("version") == HEADER_VERSION:
+                    cached[path] = header
+
+        missing = [f for f in files if f[0] not in cached]
+        if missing:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                headers = list(executor.map(read_header, [f[0] for f in missing]))
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO headers (path, mtime_ns, size, header) VALUES (?, ?, ?, ?)",
+                    [(path, mtime_ns, size, json.dumps(header))
+                     for (path, mtime_ns, size), header in zip(missing, headers)],
+                )
+            for (path, _, _), header in zip(missing, headers):
+                cached[path] = header
+    finally:
+        conn.close()
+
+    return [cached[path] for path, _, _ in files]
+
+##CT 영상 슬라이스만 골라 슬라이스 위치 순으로 정렬, 시리즈가 여러 개면 series_uid로 하나만 고를 수 있음
+def image_slices(folder: str, modality: str = "CT", sop_class_uid: str = CT_IMAGE_STORAGE,
+                 series_uid: str = None, index_path: str = None) -> list:
+    slices = [
+        h for h in index_folder(folder, index_path)
+        if h["valid"]
+        and h["Modality"] == modality
+        and (sop_class_uid is None or h["SOPClassUID"] == sop_class_uid)
+        and h["ImagePositionPatient"] is not None
+        and (series_uid is None or h["SeriesInstanceUID"] == series_uid)
+    ]
+    slices.sort(key=lambda h: h["SlicePosition"])
+    return slices
+
+##폴더 안에 있는 시리즈별 헤더 묶음
+def list_series(folder: str, index_path: str = None) -> dict:
+    series = {}
+    for h in index_folder(folder, index_path):
+        if h["valid"] and h["SeriesInstanceUID"]:
+            series.setdefault(h["SeriesInstanceUID"], []).append(h)
+    return series
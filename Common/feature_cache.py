@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+
+##특징 추출 결과를 (CT 내용 해시, 마스크 내용 해시, 파라미터 해시)로 저장해 두는 로컬 캐시(SQLite)
+##입력이 그대로면 다시 계산하지 않음. 결과는 pickle+zlib로 압축 저장, 전체 크기가 넘치면 오래 안 쓴 것부터 지움
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    "FEATURE_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "sis_pipeline", "feature_cache.sqlite"),
+)
+DEFAULT_MAX_BYTES = int(os.environ.get("FEATURE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+def _connect(cache_path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    conn = sqlite3.connect(cache_path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS file_hashes ("
+        " path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, digest TEXT NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS features ("
+        " cache_key TEXT PRIMARY KEY, namespace TEXT NOT NULL, payload BLOB NOT NULL,"
+        " nbytes INTEGER NOT NULL, last_access REAL NOT NULL)"
+    )
+    return conn
+
+def _hash_file(path, h):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+##파일(또는 DICOM 폴더) 내용 해시. 크기+수정시각이 같으면 예전에 계산한 해시를 다시 씀
+def content_hash(path: str, cache_path: str = None) -> str:
+    cache_path = cache_path or DEFAULT_CACHE_PATH
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path)
+                       if os.path.isfile(os.path.join(path, f)))
+        h = hashlib.sha1()
+        for f in files:
+            h.update(os.path.basename(f).encode("utf-8"))
+            h.update(content_hash(f, cache_path).encode("ascii"))
+        return h.hexdigest()
+
+    st = os.stat(path)
+    conn = _connect(cache_path)
+    try:
+        row = conn.execute("SELECT mtime_ns, size, digest FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+            return row[2]
+        h = hashlib.sha1()
+        _hash_file(path, h)
+        digest = h.hexdigest()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO file_hashes (path, mtime_ns, size, digest) VALUES (?, ?, ?, ?)",
+                         (path, st.st_mtime_ns, st.st_size, digest))
+        return digest
+    finally:
+        conn.close()
+
+def make_key(namespace: str, image_hash: str, mask_hash: str, params) -> str:
+    text = json.dumps([namespace, image_hash, mask_hash, params], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def cache_get(cache_key: str, cache_path: str = None):
+    cache_path = cache_path or DEFAULT_CACHE_PATH
+    if not os.path.exists(cache_path):
+        return None
+    conn = _connect(cache_path)
+    try:
+        row = conn.execute("SELECT payload FROM features WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute("UPDATE features SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key))
+        return pickle.loads(zlib.decompress(row[0]))
+    finally:
+        conn.close()
+
+def cache_put(cache_key: str, namespace: str, result, cache_path: str = None, max_bytes: int = None):
+    cache_path = cache_path or DEFAULT_CACHE_PATH
+    payload = zlib.compress(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    conn = _connect(cache_path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO features (cache_key, namespace, payload, nbytes, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (cache_key, namespace, payload, len(payload), time.time()),
+            )
+        _evict(conn, DEFAULT_MAX_BYTES if max_bytes is None else max_bytes)
+    finally:
+        conn.close()
+
+##전체 크기가 max_bytes를 넘으면 마지막 사용 시각이 오래된 것부터 지움
+def _evict(conn, max_bytes: int):
+    total = conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM features").fetchone()[0]
+    if total <= max_bytes:
+        return
+    victims = []
+    for cache_key, nbytes in conn.execute("SELECT cache_key, nbytes FROM features ORDER BY last_access"):
+        if total <= max_bytes:
+            break
+        victims.append((cache_key,))
+        total -= nbytes
+    with conn:
+        conn.executemany("DELETE FROM features WHERE cache_key = ?", victims)
@@ -0,0 +1,114 @@
+import nibabel as nib
+import numpy as np
+
+##NIfTI affine과 DICOM 시리즈 헤더(IPP/IOP/PixelSpacing)만으로 두 격자가 같은 공간을 가리키는지 확인
+##픽셀은 읽지 않고, 슬라이스 전부의 네 모서리 좌표를 한 번에 비교해서 최대 오차(mm)를 냄
+##DICOM 인덱스는 (열 c, 행 r, 슬라이스 k), 슬라이스는 법선 방향 위치 오름차순 (rt_utils와 같은 순서)
+
+LPS_TO_RAS = np.array([-1.0, -1.0, 1.0])
+
+def slice_normal(header) -> np.ndarray:
+    iop = np.asarray(header["ImageOrientationPatient"], dtype=np.float64)
+    return np.cross(iop[:3], iop[3:])
+
+##헤더 목록을 법선 방향 위치로 정렬 (rt_utils load_sorted_image_series와 같은 기준)
+def sort_headers(headers: list) -> list:
+    if not headers:
+        return []
+    normal = slice_normal(headers[0])
+    return sorted(headers, key=lambda h: float(np.dot(normal, h["ImagePositionPatient"])))
+
+##정렬된 헤더로 DICOM 인덱스 (c, r, k) -> RAS 좌표(mm) affine, 슬라이스 간격은 처음/끝 IPP 평균
+def dicom_affine(headers: list) -> np.ndarray:
+    first = headers[0]
+    iop = np.asarray(first["ImageOrientationPatient"], dtype=np.float64)
+    row_spacing, col_spacing = map(float, first["PixelSpacing"])
+    ipp = np.array([h["ImagePositionPatient"] for h in (headers[0], headers[-1])], dtype=np.float64)
+    if len(headers) > 1:
+        step = (ipp[1] - ipp[0]) / (len(headers) - 1)
+    else:
+        step = slice_normal(first) * float(first.get("SliceThickness") or 1.0)
+
+    affine = np.eye(4)
+    affine[:3, 0] = iop[:3] * col_spacing
+    affine[:3, 1] = iop[3:] * row_spacing
+    affine[:3, 2] = step
+    affine[:3, 3] = ipp[0]
+    affine[:3] *= LPS_TO_RAS[:, None]
+    return affine
+
+##DICOM 축마다 대응하는 NIfTI 축과 뒤집힘 여부. 축이 섞여 있으면(비스듬한 재샘플 등) None
+def axis_mapping(index_transform: np.ndarray, tol: float = 1e-2):
+    rotation = index_transform[:3, :3]
+    axes = tuple(int(np.argmax(np.abs(rotation[:, d]))) for d in range(3))
+    if len(set(axes)) != 3:
+        return None
+    permutation = np.zeros((3, 3))
+    for d, a in enumerate(axes):
+        permutation[a, d] = np.sign(rotation[a, d])
+    if not np.allclose(rotation, permutation, atol=tol):
+        return None
+    return axes, tuple(bool(permutation[a, d] < 0) for d, a in enumerate(axes))
+
+##핵심: NIfTI(affine, shape)와 DICOM 헤더 목록 비교 결과를 dict로
+##ok, max_error_mm, axes(DICOM c/r/k가 NIfTI 몇 번 축인지), flips, message
+def check_geometry(nifti_affine, nifti_shape, headers: list, tol_mm: float = 0.5) -> dict:
+    headers = sort_headers(headers)
+    report = {"ok": False, "max_error_mm": None, "axes": None, "flips": None, "message": ""}
+    if not headers:
+        report["message"] = "DICOM 헤더가 없어요"
+        return report
+
+    nifti_affine = np.asarray(nifti_affine, dtype=np.float64)
+    dicom_shape = (int(headers[0]["Columns"]), int(headers[0]["Rows"]), len(headers))
+    index_transform = np.linalg.solve(nifti_affine, dicom_affine(headers))
+    mapping = axis_mapping(index_transform)
+    if mapping is None:
+        report["message"] = f"축 방향이나 복셀 간격이 1:1로 대응하지 않아요 (NIfTI {''.join(nib.aff2axcodes(nifti_affine))})"
+        return report
+    axes, flips = mapping
+    report["axes"], report["flips"] = axes, flips
+
+    permuted_shape = tuple(int(nifti_shape[a]) for a in axes)
+    if permuted_shape != dicom_shape:
+        report["message"] = f"격자 크기 불일치 (DICOM c/r/k: {dicom_shape}, NIfTI 재배열: {permuted_shape})"
+        return report
+
+    ##슬라이스마다 네 모서리의 실제 DICOM 좌표와, 같은 복셀의 NIfTI 좌표를 한 번에 비교
+    cols, rows, n = dicom_shape
+    iop = np.asarray(headers[0]["ImageOrientationPatient"], dtype=np.float64)
+    row_spacing, col_spacing = map(float, headers[0]["PixelSpacing"])
+    ipp = np.array([h["ImagePositionPatient"] for h in headers], dtype=np.float64)
+    corners = np.array([[0, 0], [cols - 1, 0], [0, rows - 1], [cols - 1, rows - 1]], dtype=np.float64)
+    in_plane = corners[:, :1] * iop[:3] * col_spacing + corners[:, 1:] * iop[3:] * row_spacing
+    true_points = (ipp[:, None, :] + in_plane[None]) * LPS_TO_RAS
+
+    k = np.arange(n, dtype=np.float64)
+    dicom_index = np.concatenate([np.broadcast_to(corners, (n, 4, 2)),
+                                  np.broadcast_to(k[:, None, None], (n, 4, 1))], axis=2)
+    nifti_index = np.empty_like(dicom_index)
+    for d, a in enumerate(axes):
+        size = nifti_shape[a] - 1
+        nifti_index[..., a] = size - dicom_index[..., d] if flips[d] else dicom_index[..., d]
+    nifti_points = nifti_index @ nifti_affine[:3, :3].T + nifti_affine[:3, 3]
+
+    errors = np.linalg.norm(true_points - nifti_points, axis=-1)
+    report["max_error_mm"] = float(errors.max())
+    worst = int(np.argmax(errors.max(axis=1)))
+    report["ok"] = report["max_error_mm"] <= tol_mm
+    report["message"] = (
+        f"최대 위치 오차 {report['max_error_mm']:.3f} mm (슬라이스 {worst}), "
+        f"축 {axes}, 뒤집힘 {flips}"
+    )
+    return report
+
+##check_geometry 결과대로 축 바꾸기/뒤집기만으로 NIfTI 배열을 DICOM 순서 (행 r, 열 c, 슬라이스 k)로
+##재샘플링 없이 view만 만들어서 rt_utils add_roi에 바로 넣을 수 있음
+def reorient_to_dicom(array, report: dict):
+    if not report.get("axes"):
+        raise ValueError(f"축 대응이 없어서 재배열할 수 없어요: {report.get('message')}")
+    array = np.transpose(np.asarray(array), report["axes"])
+    flip_axes = tuple(d for d, flipped in enumerate(report["flips"]) if flipped)
+    if flip_axes:
+        array = np.flip(array, axis=flip_axes)
+    return np.swapaxes(array, 0, 1)
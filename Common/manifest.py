@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+##모든 Step이 같이 쓰는 작업 기록부(SQLite)
+##단계(stage)마다 입력 지문, 파라미터 해시, 출력 지문을 남겨두고, 다시 돌릴 때 바뀐 것만 새로 만들도록 함
+
+DEFAULT_MANIFEST_NAME = "pipeline_manifest.sqlite"
+
+def default_manifest_path(output_base: str) -> str:
+    return os.path.join(output_base, DEFAULT_MANIFEST_NAME)
+
+##파일은 크기+수정시각, 폴더는 안의 파일 전부를 합쳐서 지문 생성. hash_content=True면 내용까지 해시
+def fingerprint_path(path: str, hash_content: bool = False) -> str:
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        entries = [e for e in os.scandir(path) if e.is_file()]
+        for entry in sorted(entries, key=lambda e: e.name):
+            _update_file_hash(h, entry.path, entry.name, entry.stat(), hash_content)
+    elif os.path.isfile(path):
+        _update_file_hash(h, path, os.path.basename(path), os.stat(path), hash_content)
+    else:
+        return ""
+    return h.hexdigest()
+
+def _update_file_hash(h, path, name, st, hash_content):
+    h.update(f"{name}|{st.st_size}|{st.st_mtime_ns}\n".encode("utf-8"))
+    if hash_content:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+
+##파라미터 dict를 정렬된 JSON으로 만들어 해시 (장기, threshold, YAML 지문 등)
+def params_hash(params: dict) -> str:
+    text = json.dumps(params or {}, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _fingerprint_all(paths) -> dict:
+    if isinstance(paths, str):
+        paths = [paths]
+    return {os.path.abspath(p): fingerprint_path(p) for p in paths}
+
+def _connect(manifest_path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    ##여러 프로세스/스레드가 동시에 써도 되도록 호출마다 연결을 새로 열고 timeout으로 잠금 대기
+    conn = sqlite3.connect(manifest_path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        " stage TEXT NOT NULL, job_key TEXT NOT NULL,"
+        " inputs TEXT NOT NULL, params TEXT NOT NULL, outputs TEXT NOT NULL,"
+        " finished_at REAL NOT NULL,"
+        " PRIMARY KEY (stage, job_key))"
+    )
+    return conn
+
+##입력, 파라미터, 출력이 모두 기록과 같으면 이미 끝난 작업으로 보고 건너뜀
+def is_stage_done(manifest_path: str, stage: str, job_key: str, inputs, params: dict = None) -> bool:
+    if not manifest_path or not os.path.exists(manifest_path):
+        return False
+    conn = _connect(manifest_path)
+    try:
+        row = conn.execute(
+            "SELECT inputs, params, outputs FROM jobs WHERE stage = ? AND job_key = ?",
+            (stage, job_key),
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return False
+
+    recorded_inputs, recorded_params, recorded_outputs = row
+    if recorded_params != params_hash(params):
+        return False
+    if json.loads(recorded_inputs) != _fingerprint_all(inputs):
+        return False
+    ##출력이 지워졌거나 다른 걸로 바뀌었으면 다시 만들어야 함
+    outputs = json.loads(recorded_outputs)
+    return all(fp and fingerprint_path(path) == fp for path, fp in outputs.items())
+
+def record_stage(manifest_path: str, stage: str, job_key: str, inputs, params: dict = None, outputs=()):
+    if not manifest_path:
+        return
+    conn = _connect(manifest_path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (stage, job_key, inputs, params, outputs, finished_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    stage, job_key,
+                    json.dumps(_fingerprint_all(inputs), sort_keys=True),
+                    params_hash(params),
+                    json.dumps(_fingerprint_all(outputs), sort_keys=True),
+                    time.time(),
+                ),
+            )
+    finally:
+        conn.close()
+
+def invalidate_stage(manifest_path: str, stage: str, job_key: str = None):
+    if not manifest_path or not os.path.exists(manifest_path):
+        return
+    conn = _connect(manifest_path)
+    try:
+        with conn:
+            if job_key is None:
+                conn.execute("DELETE FROM jobs WHERE stage = ?", (stage,))
+            else:
+                conn.execute("DELETE FROM jobs WHERE stage = ? AND job_key = ?", (stage, job_key))
+    finally:
+        conn.close()
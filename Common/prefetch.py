@@ -0,0 +1,99 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+##배치 루프에서 다음 환자 볼륨을 백그라운드 스레드로 미리 읽어 두는 로더
+##지금 환자를 계산하는 동안 다음 depth명의 NIfTI를 읽고 gzip을 풀어 둠 (파일 읽기/zlib은 GIL을 놓아서 스레드로 충분)
+##max_bytes: 미리 읽어 둔 것 + 지금 쓰는 것의 배열 바이트 합 상한. 넘칠 것 같으면 소비할 때까지 새로 안 읽음
+##          (크기는 읽어 봐야 알아서 지금까지 본 것의 최댓값으로 어림, 쓰는 것도 읽는 것도 없을 때만 상한과 상관없이 하나 읽음)
+##          depth 1이어도 지금 것 + 다음 것이 상한을 넘으면 겹쳐 읽지 않고 지금 것을 다 쓴 뒤에 읽음
+##프로세스 풀 워커마다 prefetch를 돌리면 상한도 워커마다라서, 배치 전체 예산은 per_worker_bytes로 나눠서 넘김
+##사용: for item, value, error in prefetch(items, loader): ... (loader 예외는 error로, 순서는 items 그대로)
+
+DEFAULT_DEPTH = 2
+DEFAULT_MAX_BYTES = 1 << 30
+##배치 함수(워커 여럿)의 기본 전체 예산
+DEFAULT_BATCH_BYTES = 4 << 30
+
+##값 안의 numpy 배열(SimpleITK 이미지 포함) 바이트 합, dict/list/tuple은 안으로 들어가서 셈
+def nbytes(value) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    if hasattr(value, "GetNumberOfPixels") and hasattr(value, "GetSizeOfPixelComponent"):
+        return int(value.GetNumberOfPixels() * value.GetSizeOfPixelComponent()
+                   * value.GetNumberOfComponentsPerPixel())
+    return 0
+
+def prefetch(items, loader, depth: int = DEFAULT_DEPTH, max_bytes: int = DEFAULT_MAX_BYTES, workers: int = None):
+    items = iter(items)
+    depth = max(1, depth)
+    executor = ThreadPoolExecutor(max_workers=workers or depth, thread_name_prefix="prefetch")
+    pending = deque()
+    sizes = {}
+    largest = 0
+    held = 0
+    exhausted = False
+
+    ##다 읽은 것은 실제 크기, 아직 읽는 중인 것은 지금까지 본 최댓값으로
+    def outstanding():
+        nonlocal largest
+        total = 0
+        for _, future in pending:
+            if future.done() and future not in sizes:
+                sizes[future] = 0 if future.exception() is not None else nbytes(future.result())
+                largest = max(largest, sizes[future])
+            total += sizes.get(future, largest)
+        return total
+
+    def refill():
+        nonlocal exhausted
+        while not exhausted and len(pending) < depth:
+            if (pending or held) and held + outstanding() + largest > max_bytes:
+                return
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                return
+            pending.append((item, executor.submit(loader, item)))
+
+    try:
+        refill()
+        while pending:
+            item, future = pending.popleft()
+            sizes.pop(future, None)
+            try:
+                value, error = future.result(), None
+            except Exception as e:
+                value, error = None, e
+            held = nbytes(value)
+            largest = max(largest, held)
+            ##지금 것을 넘겨주기 전에 다음 것들을 걸어 둬야 계산하는 동안 읽기가 겹침
+            refill()
+            yield item, value, error
+            value = None
+            held = 0
+            refill()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+##배치 전체 예산을 워커 수(없으면 CPU 수)로 나눈 워커 하나의 max_bytes
+def per_worker_bytes(total_bytes: int, workers: int = None) -> int:
+    workers = workers or os.cpu_count() or 1
+    return max(1, int(total_bytes) // workers)
+
+##프로세스 풀에 넘길 때 쓰는 연속 덩어리 나누기 (덩어리 안에서 prefetch가 다음 환자를 미리 읽음)
+##워커마다 여러 덩어리가 돌아가게 나눠서 한 워커에만 일이 몰리지 않게 함
+def split_chunks(items: list, workers: int = None, per_worker: int = 4) -> list:
+    workers = workers or os.cpu_count() or 1
+    size = max(1, -(-len(items) // (workers * per_worker)))
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,263 @@
+import argparse
+import functools
+import glob
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+##Step 함수에 감싸 쓰는 가벼운 계측: 호출마다 한 줄짜리 JSON을 파일에 덧붙임 (JSON-lines)
+##SIS_PROFILE_LOG=경로 를 주면 켜지고, 없으면 함수를 그대로 부르기만 함
+##환경변수는 워커 프로세스(fork/spawn 둘 다)로 그대로 넘어가서 워커 기록도 같은 파일에 쌓임
+##SIS_PROFILE_CPROFILE=폴더 를 주면 호출마다 cProfile 결과(.prof)를 단계 이름으로 저장, hotspots 명령으로 모아 봄
+##한 줄: stage, key, pid, host, start, wall_s, ok, error, metrics, thread_*(호출 스레드만), process_*(호출 동안 프로세스 전체),
+##peak_rss_growth_mb(호출 동안 프로세스 최대 메모리가 늘어난 만큼), process_peak_rss_mb, 자식 몫은 metrics.child_*
+
+LOG_ENV = "SIS_PROFILE_LOG"
+CPROFILE_ENV = "SIS_PROFILE_CPROFILE"
+
+_local = threading.local()
+_write_lock = threading.Lock()
+_counter = [0]
+
+def enabled() -> bool:
+    return bool(os.environ.get(LOG_ENV))
+
+##/proc의 rchar/wchar (리눅스만, 캐시 히트 포함한 read/write 바이트), 없으면 None
+def _io_bytes(path="/proc/self/io"):
+    try:
+        with open(path, encoding="ascii") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _thread_io_bytes():
+    return _io_bytes(f"/proc/self/task/{threading.get_native_id()}/io")
+
+##프로세스가 뜬 뒤 지금까지 쓴 최대 메모리(MB), 윈도우면 None
+def process_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+##지금 돌고 있는 계측 호출에 숫자를 붙임 (복셀 수, 면 수 등), 계측이 꺼져 있으면 아무것도 안 함
+##숫자는 같은 호출 안에서 더해지고, 이름이 peak로 끝나거나 _peak_가 들어가면 최댓값을 남김
+def record_metric(name: str, value):
+    stack = getattr(_local, "stack", None)
+    if stack:
+        metrics = stack[-1]
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            metrics[name] = value
+        elif "_peak_" in name or name.endswith("peak"):
+            metrics[name] = max(metrics.get(name, value), value)
+        else:
+            metrics[name] = metrics.get(name, 0) + value
+
+##subprocess.Popen.wait 대신: 그 자식 하나의 CPU/최대 메모리를 os.wait4로 받아서 지금 계측 호출에 붙임
+##RUSAGE_CHILDREN은 프로세스 전체라 스레드로 동시에 도는 자식들이 섞여서 안 씀. wait4가 없으면(윈도우) 그냥 wait
+##리눅스 ru_maxrss는 exec 직전(띄운 쪽 메모리)부터 세서 자식 최대 메모리는 부모 RSS보다 작게 안 나옴
+def wait_child(process) -> int:
+    if not hasattr(os, "wait4") or process.returncode is not None:
+        return process.wait()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    record_metric("child_cpu_s", usage.ru_utime + usage.ru_stime)
+    record_metric("child_peak_rss_mb", usage.ru_maxrss / scale)
+    return process.returncode
+
+##돌려준 값으로 실패를 알리는 함수용: status가 "failed"인 dict, 또는 그런 dict(행)가 하나라도 있는 목록이면 에러 문구
+def failed_status(result):
+    rows = result if isinstance(result, list) else [result]
+    for row in rows:
+        if isinstance(row, dict) and row.get("status") == "failed":
+            return row.get("error") or "failed"
+    return None
+
+def _write_record(record):
+    line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+    path = os.environ[LOG_ENV]
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    ##O_APPEND로 한 번에 써서 여러 프로세스가 같이 써도 줄이 섞이지 않음
+    with _write_lock:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+def _default_key(args, kwargs):
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (tuple, list)) and value and isinstance(value[0], str):
+            return value[0]
+        if isinstance(value, dict) and "patient_id" in value:
+            return f"{value['patient_id']}/{value.get('phase', '')}"
+    return None
+
+##단계 함수 감싸기: @instrument("stl") 또는 instrument("stl", key=lambda args, kwargs: ...)
+##예외 없이 실패를 돌려주는 함수는 failed=결과를 받아 실패면 에러 문구(또는 True), 아니면 None을 주는 함수로 알려 줌
+##(False를 돌려주면 따로 안 줘도 실패)
+def instrument(stage: str, key=None, failed=None):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return fn(*args, **kwargs)
+
+            metrics = {}
+            if not hasattr(_local, "stack"):
+                _local.stack = []
+            _local.stack.append(metrics)
+            outer = len(_local.stack) == 1
+            peak_start = process_peak_rss_mb()
+            io_start, thread_io_start = _io_bytes(), _thread_io_bytes()
+            wall_start, cpu_start, thread_cpu_start = time.perf_counter(), time.process_time(), time.thread_time()
+            start = time.time()
+            profiler = None
+            ##cProfile은 한 번에 하나만 켤 수 있어서 바깥쪽 계측 호출에서만 씀
+            if os.environ.get(CPROFILE_ENV) and outer:
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+            ok, error = True, None
+            try:
+                result = fn(*args, **kwargs)
+                reason = failed(result) if failed else None
+                if result is False or reason:
+                    ok = False
+                    error = reason if isinstance(reason, str) else None
+                return result
+            except BaseException as e:
+                ok, error = False, f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    _dump_profile(profiler, stage)
+                io_end, thread_io_end = _io_bytes(), _thread_io_bytes()
+                thread_cpu = time.thread_time() - thread_cpu_start
+                _local.stack.pop()
+                peak_end = process_peak_rss_mb()
+                try:
+                    record_key = (key or _default_key)(args, kwargs)
+                except Exception:
+                    record_key = None
+                _write_record({
+                    "stage": stage,
+                    "key": record_key,
+                    "function": f"{fn.__module__}.{fn.__qualname__}",
+                    "pid": os.getpid(),
+                    "host": socket.gethostname(),
+                    "start": start,
+                    "wall_s": round(time.perf_counter() - wall_start, 6),
+                    "thread_cpu_s": round(thread_cpu, 6),
+                    "process_cpu_s": round(time.process_time() - cpu_start, 6),
+                    "thread_read_bytes": _delta(thread_io_start, thread_io_end, 0),
+                    "thread_write_bytes": _delta(thread_io_start, thread_io_end, 1),
+                    "process_read_bytes": _delta(io_start, io_end, 0),
+                    "process_write_bytes": _delta(io_start, io_end, 1),
+                    "peak_rss_growth_mb": round(peak_end - peak_start, 3) if peak_start is not None else None,
+                    "process_peak_rss_mb": peak_end,
+                    "ok": ok,
+                    "error": error,
+                    "metrics": metrics,
+                })
+        return wrapper
+    return decorator
+
+def _delta(start, end, index):
+    return end[index] - start[index] if start and end else None
+
+def _dump_profile(profiler, stage):
+    directory = os.environ[CPROFILE_ENV]
+    os.makedirs(directory, exist_ok=True)
+    with _write_lock:
+        _counter[0] += 1
+        count = _counter[0]
+    profiler.dump_stats(os.path.join(directory, f"{stage}_{os.getpid()}_{count}.prof"))
+
+def load_records(log_path: str):
+    import pandas as pd
+    with open(log_path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return pd.json_normalize(records)
+
+##한 번 돌린 기록을 단계별로 모음: 호출 수, 실패 수, wall 합과 백분위, CPU 합(호출 스레드/프로세스/자식),
+##읽고 쓴 바이트(프로세스 전체), 최대 메모리 증가분, metrics 합(peak가 붙은 건 최댓값)
+def summarize(log_path: str):
+    df = load_records(log_path)
+    if df.empty:
+        return df
+    metric_columns = [c for c in df.columns if c.startswith("metrics.")]
+    if "metrics.child_cpu_s" not in df.columns:
+        df["metrics.child_cpu_s"] = 0.0
+    grouped = df.groupby("stage")
+    summary = grouped.agg(
+        calls=("wall_s", "size"),
+        failed=("ok", lambda s: int((~s.astype(bool)).sum())),
+        wall_total_s=("wall_s", "sum"),
+        wall_p50_s=("wall_s", "median"),
+        wall_p95_s=("wall_s", lambda s: s.quantile(0.95)),
+        thread_cpu_total_s=("thread_cpu_s", "sum"),
+        process_cpu_total_s=("process_cpu_s", "sum"),
+        read_mb=("process_read_bytes", lambda s: s.sum() / 1e6),
+        write_mb=("process_write_bytes", lambda s: s.sum() / 1e6),
+        peak_rss_growth_mb=("peak_rss_growth_mb", "max"),
+        process_peak_rss_mb=("process_peak_rss_mb", "max"),
+        processes=("pid", "nunique"),
+    )
+    ##(호출 스레드 + 자식 프로세스) CPU / wall 이 낮으면 I/O나 도우미 스레드를 기다린 시간이 길었다는 뜻
+    cpu = grouped["thread_cpu_s"].sum() + grouped["metrics.child_cpu_s"].sum()
+    summary["cpu_ratio"] = cpu / summary["wall_total_s"].where(summary["wall_total_s"] > 0)
+    for column in metric_columns:
+        name = column.replace("metrics.", "")
+        summary[name] = grouped[column].max() if "_peak_" in name or name.endswith("peak") \
+            else grouped[column].sum()
+    return summary.sort_values("wall_total_s", ascending=False)
+
+##cProfile 파일들을 단계별로 합쳐서 누적 시간 상위 함수 출력
+def hotspots(profile_dir: str, top: int = 15):
+    import pstats
+    files = sorted(glob.glob(os.path.join(profile_dir, "*.prof")))
+    stages = {}
+    for path in files:
+        stage = os.path.basename(path).rsplit("_", 2)[0]
+        stages.setdefault(stage, []).append(path)
+    for stage, paths in stages.items():
+        print(f"\n=== {stage} ({len(paths)}회) ===")
+        stats = pstats.Stats(*paths)
+        stats.sort_stats("cumulative").print_stats(top)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="계측 기록(JSON-lines) 모아 보기")
+    sub = parser.add_subparsers(dest="command", required=True)
+    summary_parser = sub.add_parser("summary", help="단계별 합계")
+    summary_parser.add_argument("log_path")
+    summary_parser.add_argument("--csv", default=None, help="합계 표를 CSV로도 저장")
+    hot_parser = sub.add_parser("hotspots", help="cProfile 결과를 단계별로 합쳐 상위 함수 출력")
+    hot_parser.add_argument("profile_dir")
+    hot_parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args(argv)
+
+    if args.command == "summary":
+        import pandas as pd
+        summary = summarize(args.log_path)
+        with pd.option_context("display.width", 200, "display.max_columns", None):
+            print(summary.round(3).to_string())
+        if args.csv:
+            summary.to_csv(args.csv)
+    else:
+        hotspots(args.profile_dir, args.top)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+import json
+import nibabel as nib
+import numpy as np
+
+##모든 분석 Step이 같이 쓰는 NIfTI 로더
+##get_fdata()처럼 float64로 바꾸지 않고 저장된 dtype 그대로(int16 CT, uint8 마스크) 가져오고
+##압축 안 된 .nii는 memmap으로 열어서 실제로 건드리는 부분만 메모리에 올라옴
+
+##scl_slope/scl_inter가 있는 볼륨을 전부 변환하지 않고, 인덱싱한 부분만 그때그때 스케일링
+class LazyScaledVolume:
+    def __init__(self, raw, slope, inter):
+        self.raw = raw
+        self.slope = slope
+        self.inter = inter
+        ##slope/inter가 정수면 정수로 유지(int16 범위 넘칠 수 있어 int32), 아니면 float32
+        if np.issubdtype(raw.dtype, np.integer) and float(slope).is_integer() and float(inter).is_integer():
+            self.dtype = np.dtype(np.int32)
+        else:
+            self.dtype = np.dtype(np.float32)
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def ndim(self):
+        return self.raw.ndim
+
+    def _scale(self, values):
+        values = np.asarray(values)
+        if self.dtype == np.int32:
+            return values.astype(np.int32) * int(self.slope) + int(self.inter)
+        return values.astype(np.float32) * np.float32(self.slope) + np.float32(self.inter)
+
+    def __getitem__(self, index):
+        return self._scale(self.raw[index])
+
+    def __array__(self, dtype=None, copy=None):
+        values = self._scale(self.raw)
+        return values.astype(dtype) if dtype is not None else values
+
+def _slope_inter(img):
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    slope = 1.0 if slope is None or np.isnan(slope) or slope == 0 else float(slope)
+    inter = 0.0 if inter is None or np.isnan(inter) else float(inter)
+    return slope, inter
+
+##CT 같은 볼륨을 저장된 dtype 그대로 돌려줌 (data, img). 스케일링이 있으면 LazyScaledVolume
+def load_volume(path, mmap=True):
+    img = nib.load(path, mmap="r" if mmap else False)
+    raw = img.dataobj.get_unscaled()
+    slope, inter = _slope_inter(img)
+    if slope == 1.0 and inter == 0.0:
+        return raw, img
+    return LazyScaledVolume(raw, slope, inter), img
+
+##마스크를 float 중간단계 없이 바로 bool로 (mask, img). label을 주면 그 라벨만, 아니면 threshold 초과
+def load_mask(path, threshold=0, label=None, mmap=True):
+    img = nib.load(path, mmap="r" if mmap else False)
+    raw = img.dataobj.get_unscaled()
+    slope, inter = _slope_inter(img)
+    if label is not None:
+        ##라벨 값도 저장된 값 기준으로 바꿔서 비교
+        return raw == (label - inter) / slope, img
+    raw_threshold = (threshold - inter) / slope
+    if slope > 0:
+        return raw > raw_threshold, img
+    return raw < raw_threshold, img
+
+##다중 라벨 맵을 저장된 정수 dtype 그대로
+def load_labelmap(path, mmap=True):
+    img = nib.load(path, mmap="r" if mmap else False)
+    return np.asarray(img.dataobj.get_unscaled()), img
+
+##라벨 번호 -> 장기 이름. JSON({"1": "spleen"}) 또는 한 줄에 "1 spleen" / "1,spleen" 형식 파일
+def load_label_names(label_map_path: str) -> dict:
+    if not label_map_path:
+        return {}
+    with open(label_map_path, encoding="utf-8") as f:
+        if label_map_path.lower().endswith(".json"):
+            return {int(k): str(v) for k, v in json.load(f).items()}
+        names = {}
+        for line in f:
+            parts = line.replace(",", " ").split()
+            if len(parts) >= 2 and parts[0].isdigit():
+                names[int(parts[0])] = parts[1]
+        return names
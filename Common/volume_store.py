@@ -0,0 +1,391 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from tqdm import tqdm
+
+from cohort import discover_cases
+from volume_io import load_mask, load_volume
+
+##코호트 전체 CT/마스크를 블록(청크) 단위로 압축해 둔 저장소 (zarr 비슷한 폴더 구조, 추가 패키지 없이 zlib)
+##분석 Step이 환자마다 .nii.gz를 통째로 풀지 않고, ROI(장기 bounding box)에 걸친 블록만 읽게 하려는 것
+##  {store}/store.json                               청크 크기, 코덱
+##  {store}/{환자}/{phase}/meta.json                  shape, affine, 복셀 간격, 배열별 dtype/bbox/원본 파일 정보
+##  {store}/{환자}/{phase}/ct.{digest}/{i}.{j}.{k}     CT 블록 (int16, 범위를 넘으면 원래 정수형)
+##  {store}/{환자}/{phase}/mask_{organ}.{digest}/...  마스크 블록 (bool을 np.packbits로 8배 압축, 빈 블록은 파일 없음)
+##배열 순서는 volume_io.load_volume과 같은 NIfTI 인덱스 (x, y, z), meta.json을 os.replace로 바꾸는 순간 새 배열로 넘어감
+
+DEFAULT_CHUNKS = (64, 64, 32)
+STORE_FILE = "store.json"
+META_FILE = "meta.json"
+
+##zstandard가 깔려 있으면 더 빠른 zstd, 없으면 zlib 빠른 레벨
+def _codec(name: str):
+    if name == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    if name == "zlib":
+        return (lambda data: zlib.compress(data, 1)), zlib.decompress
+    raise ValueError(f"모르는 코덱: {name}")
+
+def _default_codec() -> str:
+    try:
+        import zstandard  # noqa: F401
+        return "zstd"
+    except ImportError:
+        return "zlib"
+
+def _write_json(path, data):
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def _read_json(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+##저장소 설정 읽기, 없으면 새로 만듦 (한 번 정한 청크 크기/코덱은 안 바뀜)
+def open_store(root: str, chunks=None, codec=None) -> dict:
+    path = os.path.join(root, STORE_FILE)
+    if os.path.exists(path):
+        return _read_json(path)
+    os.makedirs(root, exist_ok=True)
+    config = {"format": 1, "chunks": list(chunks or DEFAULT_CHUNKS), "codec": codec or _default_codec()}
+    _write_json(path, config)
+    return config
+
+def _case_dir(root, patient_id, phase):
+    return os.path.join(root, str(patient_id), phase)
+
+def case_meta(root: str, patient_id, phase: str):
+    path = os.path.join(_case_dir(root, patient_id, phase), META_FILE)
+    return _read_json(path) if os.path.exists(path) else None
+
+def _chunk_ranges(shape, chunks):
+    for i in range(0, shape[0], chunks[0]):
+        for j in range(0, shape[1], chunks[1]):
+            for k in range(0, shape[2], chunks[2]):
+                yield (i // chunks[0], j // chunks[1], k // chunks[2]), \
+                    (slice(i, min(i + chunks[0], shape[0])), slice(j, min(j + chunks[1], shape[1])),
+                     slice(k, min(k + chunks[2], shape[2])))
+
+##배열 하나를 블록으로 잘라 압축해서 새 폴더에 씀, 폴더 이름에 내용 digest가 붙어서 같은 내용이면 다시 안 씀
+def _write_array(case_dir, name, array, config, packed):
+    compress, _ = _codec(config["codec"])
+    tmp_dir = os.path.join(case_dir, f".{name}.{uuid.uuid4().hex}.tmp")
+    os.makedirs(tmp_dir)
+    digest = hashlib.sha1(f"{array.shape}{array.dtype.str}{packed}".encode("ascii"))
+    stored_bytes = 0
+    try:
+        for index, slices in _chunk_ranges(array.shape, config["chunks"]):
+            block = np.ascontiguousarray(array[slices])
+            if packed:
+                if not block.any():
+                    continue
+                data = np.packbits(block, axis=None).tobytes()
+            else:
+                data = block.tobytes()
+            blob = compress(data)
+            chunk_name = ".".join(map(str, index))
+            digest.update(chunk_name.encode("ascii"))
+            digest.update(blob)
+            with open(os.path.join(tmp_dir, chunk_name), "wb") as f:
+                f.write(blob)
+            stored_bytes += len(blob)
+        folder = f"{name}.{digest.hexdigest()[:16]}"
+        target = os.path.join(case_dir, folder)
+        if os.path.isdir(target):
+            shutil.rmtree(tmp_dir)
+        else:
+            os.replace(tmp_dir, target)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return {"folder": folder, "digest": digest.hexdigest(), "dtype": array.dtype.str, "packed": packed,
+            "stored_bytes": stored_bytes, "raw_bytes": int(array.nbytes)}
+
+def _source_info(path):
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+def _unchanged(entry, path):
+    if not entry or not path:
+        return False
+    source = entry.get("source", {})
+    st = os.stat(path)
+    return source.get("path") == os.path.abspath(path) and source.get("mtime_ns") == st.st_mtime_ns \
+        and source.get("size") == st.st_size
+
+##정수 HU는 int16에 들어가면 int16으로 (float 스케일링된 볼륨은 float32)
+def _ct_array(ct):
+    data = np.asarray(ct)
+    if np.issubdtype(data.dtype, np.integer):
+        if data.size and data.min() >= np.iinfo(np.int16).min and data.max() <= np.iinfo(np.int16).max:
+            return data.astype(np.int16, copy=False)
+        return data
+    return data.astype(np.float32, copy=False)
+
+##마스크 bounding box [[시작, 끝), ...], 비었으면 None
+def _bbox(mask):
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        hits = np.flatnonzero(mask.any(axis=other))
+        if hits.size == 0:
+            return None
+        bbox.append([int(hits[0]), int(hits[-1]) + 1])
+    return bbox
+
+##cohort.discover_cases 모양의 케이스 하나를 저장소로 가져옴. 원본 파일(경로, mtime, 크기)이 그대로인 배열은 건너뜀
+##labels({장기: label 번호})를 주면 다중 라벨 마스크에서 그 번호만 장기 마스크로 씀 (없으면 0이 아닌 값 전부), meta에 label로 남음
+##돌려주는 값: (patient_id, phase, 상태, 새로 쓴 배열 수)
+def import_case(root: str, case: dict, config=None, labels=None):
+    config = config or open_store(root)
+    patient_id, phase = case["patient_id"], case["phase"]
+    case_dir = _case_dir(root, patient_id, phase)
+    os.makedirs(case_dir, exist_ok=True)
+    old = case_meta(root, patient_id, phase) or {}
+    written = 0
+    try:
+        ct_entry = old.get("ct")
+        ct_img = None
+        if not _unchanged(ct_entry, case["ct_path"]):
+            ct, ct_img = load_volume(case["ct_path"])
+            ct_entry = _write_array(case_dir, "ct", _ct_array(ct), config, packed=False)
+            ct_entry["source"] = _source_info(case["ct_path"])
+            written += 1
+        if ct_img is not None:
+            shape = [int(s) for s in ct_img.shape[:3]]
+            affine = ct_img.affine.tolist()
+            zooms = [float(z) for z in ct_img.header.get_zooms()[:3]]
+        else:
+            shape, affine, zooms = old["shape"], old["affine"], old["zooms"]
+
+        masks = {}
+        for organ, mask_path in case["mask_paths"].items():
+            entry = old.get("masks", {}).get(organ)
+            label = (labels or {}).get(organ)
+            if mask_path is None:
+                continue
+            ##CT를 새로 썼으면 shape 확인을 다시 해야 해서 마스크도 다시 씀
+            if ct_img is not None or not _unchanged(entry, mask_path) or entry.get("label") != label:
+                mask, _ = load_mask(mask_path, label=label)
+                if list(mask.shape[:3]) != shape:
+                    raise ValueError(f"{organ} 마스크 shape {mask.shape}이 CT {tuple(shape)}와 달라요")
+                mask = np.asarray(mask)
+                entry = _write_array(case_dir, f"mask_{organ}", mask, config, packed=True)
+                entry["source"] = _source_info(mask_path)
+                entry["bbox"] = _bbox(mask)
+                entry["voxels"] = int(np.count_nonzero(mask))
+                entry["label"] = label
+                written += 1
+            masks[organ] = entry
+        ##이번에 안 준 장기도 예전 기록이 있으면 유지
+        for organ, entry in old.get("masks", {}).items():
+            masks.setdefault(organ, entry)
+
+        meta = {"patient_id": str(patient_id), "phase": phase, "shape": shape, "affine": affine, "zooms": zooms,
+                "ct": ct_entry, "masks": masks}
+        if written:
+            _write_json(os.path.join(case_dir, META_FILE), meta)
+            _remove_unreferenced(case_dir, meta)
+        return patient_id, phase, "imported" if written else "unchanged", written
+    except Exception as e:
+        return patient_id, phase, f"failed: {e}", written
+
+##meta.json이 더 이상 가리키지 않는 예전 배열 폴더 정리
+def _remove_unreferenced(case_dir, meta):
+    keep = {meta["ct"]["folder"]} | {entry["folder"] for entry in meta["masks"].values()}
+    for name in os.listdir(case_dir):
+        path = os.path.join(case_dir, name)
+        if os.path.isdir(path) and name not in keep and not name.startswith("."):
+            shutil.rmtree(path, ignore_errors=True)
+
+##Step 1/Step 2 결과 폴더(CT NIfTI 루트, Segmentation 루트)에서 코호트 전체를 가져옴, 환자/phase마다 프로세스 하나
+def import_cohort(root: str, ct_base: str, seg_base: str, organs, phases=("PRE", "POST"), max_workers=None,
+                  chunks=None, codec=None, labels=None):
+    config = open_store(root, chunks, codec)
+    cases = discover_cases(ct_base, seg_base, organs, phases)
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(import_case, root, case, config, labels) for case in cases]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="저장소로 가져오는 中"):
+            results.append(future.result())
+    failed = [r for r in results if r[2].startswith("failed")]
+    print(f"가져오기 끝: {len(results) - len(failed)}건 (새로 쓴 건 {sum(1 for r in results if r[3])}), 실패 {len(failed)}건")
+    for patient_id, phase, status, _ in failed:
+        print(f" - {patient_id}/{phase}: {status}")
+    return results
+
+##저장소에 든 환자/phase를 discover_cases와 같은 모양으로, mask_paths는 원본 경로(저장소에 없는 장기는 None)
+##"store" 키가 붙어 있어서 HU_Histogram/sdf/Pyradiomics가 원본 대신 저장소 블록을 읽음
+def store_cases(root: str, organs, phases=("PRE", "POST")) -> list:
+    if isinstance(organs, str):
+        organs = [organs]
+    cases = []
+    patients = [name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name))]
+    for patient_id in sorted(patients, key=lambda p: (not p.isdigit(), int(p) if p.isdigit() else p)):
+        for phase in phases:
+            meta = case_meta(root, patient_id, phase)
+            if meta is None:
+                continue
+            masks = meta["masks"]
+            cases.append({
+                "patient_id": patient_id,
+                "phase": phase,
+                "ct_path": meta["ct"]["source"]["path"],
+                "mask_paths": {organ: masks[organ]["source"]["path"] if organ in masks else None
+                               for organ in organs},
+                "store": root,
+            })
+    return cases
+
+##저장소 배열 하나를 memmap처럼 쓰는 객체: 슬라이스로 자른 부분에 걸친 블록만 풀어서 돌려줌
+##stream_hu_stats처럼 shape과 [:, :, z0:z1] 인덱싱만 쓰는 코드에는 그대로 넣을 수 있음
+class ChunkedVolume:
+    def __init__(self, folder, shape, entry, config):
+        self.folder = folder
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.packed = entry["packed"]
+        self.dtype = np.dtype(bool) if self.packed else np.dtype(entry["dtype"])
+        self.chunks = tuple(config["chunks"])
+        self._decompress = _codec(config["codec"])[1]
+        self._present = set(os.listdir(folder))
+
+    def _block(self, index, block_shape):
+        name = ".".join(map(str, index))
+        if name not in self._present:
+            return None
+        with open(os.path.join(self.folder, name), "rb") as f:
+            data = self._decompress(f.read())
+        if self.packed:
+            size = int(np.prod(block_shape))
+            return np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=size).view(bool).reshape(block_shape)
+        return np.frombuffer(data, dtype=self.dtype).reshape(block_shape)
+
+    ##[시작, 끝) 범위 박스를 읽음, 빈 마스크 블록은 파일을 열지 않음
+    def read(self, box):
+        box = [(max(int(lo), 0), min(int(hi), size)) for (lo, hi), size in zip(box, self.shape)]
+        out = np.zeros([max(hi - lo, 0) for lo, hi in box], dtype=self.dtype)
+        if out.size == 0:
+            return out
+        first = [lo // c for (lo, _), c in zip(box, self.chunks)]
+        last = [(hi - 1) // c for (_, hi), c in zip(box, self.chunks)]
+        for i in range(first[0], last[0] + 1):
+            for j in range(first[1], last[1] + 1):
+                for k in range(first[2], last[2] + 1):
+                    index = (i, j, k)
+                    start = [n * c for n, c in zip(index, self.chunks)]
+                    stop = [min(s + c, size) for s, c, size in zip(start, self.chunks, self.shape)]
+                    block = self._block(index, [b - a for a, b in zip(start, stop)])
+                    if block is None:
+                        continue
+                    src = tuple(slice(max(lo, a) - a, min(hi, b) - a) for (lo, hi), a, b in zip(box, start, stop))
+                    dst = tuple(slice(max(lo, a) - lo, min(hi, b) - lo) for (lo, hi), a, b in zip(box, start, stop))
+                    out[dst] = block[src]
+        return out
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(index) > self.ndim or not all(isinstance(s, slice) and s.step in (None, 1) for s in index):
+            return np.asarray(self)[index]
+        index = index + (slice(None),) * (self.ndim - len(index))
+        return self.read([s.indices(size)[:2] for s, size in zip(index, self.shape)])
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.read([(0, size) for size in self.shape])
+        return values.astype(dtype) if dtype is not None else values
+
+##저장소의 CT(name="ct") 또는 마스크(name=장기 이름)를 ChunkedVolume으로, (배열, meta)
+def open_volume(root: str, patient_id, phase: str, name: str = "ct"):
+    meta = case_meta(root, patient_id, phase)
+    if meta is None:
+        raise FileNotFoundError(f"저장소에 {patient_id}/{phase}가 없어요: {root}")
+    entry = meta["ct"] if name == "ct" else meta["masks"].get(name)
+    if entry is None:
+        raise FileNotFoundError(f"저장소 {patient_id}/{phase}에 {name} 마스크가 없어요")
+    folder = os.path.join(_case_dir(root, patient_id, phase), entry["folder"])
+    return ChunkedVolume(folder, meta["shape"], entry, open_store(root)), meta
+
+##장기 bounding box에 여유(margin_mm + margin_voxels)를 더한 영역만 읽어서 (CT, bool 마스크, 정보), margin_voxels가 None이면 전체
+##정보: box([시작, 끝) 목록), affine(잘라낸 영역 원점 기준), zooms, ct_digest, mask_digest, label(가져올 때 쓴 label 번호)
+def read_roi(root: str, patient_id, phase: str, organ: str, margin_mm: float = 0.0, margin_voxels: int = 0):
+    mask_volume, meta = open_volume(root, patient_id, phase, organ)
+    entry = meta["masks"][organ]
+    if entry["bbox"] is None:
+        raise ValueError(f"{organ} 마스크가 비어 있어요")
+    zooms = np.asarray(meta["zooms"], dtype=np.float64)
+    box = []
+    for (lo, hi), spacing, size in zip(entry["bbox"], zooms, meta["shape"]):
+        if margin_voxels is None:
+            box.append((0, size))
+            continue
+        pad = int(np.ceil(margin_mm / spacing)) + margin_voxels
+        box.append((max(lo - pad, 0), min(hi + pad, size)))
+    ct_volume, _ = open_volume(root, patient_id, phase, "ct")
+
+    affine = np.asarray(meta["affine"], dtype=np.float64)
+    crop_affine = affine.copy()
+    crop_affine[:3, 3] = affine[:3, :3] @ np.array([lo for lo, _ in box], dtype=np.float64) + affine[:3, 3]
+    info = {"box": box, "affine": crop_affine, "zooms": zooms, "ct_digest": meta["ct"]["digest"],
+            "mask_digest": entry["digest"], "label": entry.get("label")}
+    return ct_volume.read(box), mask_volume.read(box), info
+
+##저장소 크기 요약: 배열 종류별 원래 바이트 대비 저장 바이트
+def store_summary(root: str):
+    totals = {"cases": 0, "ct_raw": 0, "ct_stored": 0, "mask_raw": 0, "mask_stored": 0}
+    for patient_id in os.listdir(root):
+        patient_dir = os.path.join(root, patient_id)
+        if not os.path.isdir(patient_dir):
+            continue
+        for phase in os.listdir(patient_dir):
+            meta = case_meta(root, patient_id, phase)
+            if meta is None:
+                continue
+            totals["cases"] += 1
+            totals["ct_raw"] += meta["ct"]["raw_bytes"]
+            totals["ct_stored"] += meta["ct"]["stored_bytes"]
+            for entry in meta["masks"].values():
+                totals["mask_raw"] += entry["raw_bytes"]
+                totals["mask_stored"] += entry["stored_bytes"]
+    return totals
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CT/마스크 청크 저장소")
+    sub = parser.add_subparsers(dest="command", required=True)
+    import_parser = sub.add_parser("import", help="Step 1/Step 2 결과 폴더에서 가져오기 (바뀐 파일만 다시 씀)")
+    import_parser.add_argument("ct_base", help="CT NIfTI 루트 폴더 (DICOM_2_NIFTI 결과)")
+    import_parser.add_argument("seg_base", help="Segmentation 루트 폴더 (TotalSegmentator 결과)")
+    import_parser.add_argument("store", help="저장소 폴더")
+    import_parser.add_argument("--organs", nargs="+", required=True)
+    import_parser.add_argument("--phases", nargs="+", default=["PRE", "POST"])
+    import_parser.add_argument("--workers", type=int, default=None)
+    import_parser.add_argument("--chunks", type=int, nargs=3, default=list(DEFAULT_CHUNKS), metavar=("X", "Y", "Z"))
+    import_parser.add_argument("--codec", choices=["zlib", "zstd"], default=None)
+    info_parser = sub.add_parser("info", help="저장소 크기 요약")
+    info_parser.add_argument("store")
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        import_cohort(args.store, args.ct_base, args.seg_base, [o.lower() for o in args.organs], tuple(args.phases),
+                      args.workers, args.chunks, args.codec)
+        return 0
+    totals = store_summary(args.store)
+    print(f"환자/phase {totals['cases']}건")
+    for kind in ("ct", "mask"):
+        raw, stored = totals[f"{kind}_raw"], totals[f"{kind}_stored"]
+        ratio = raw / stored if stored else float("nan")
+        print(f" - {kind}: 원본 {raw / 1e6:.1f} MB -> 저장 {stored / 1e6:.1f} MB (x{ratio:.1f})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import pandas as pd
+from tqdm import tqdm
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ("Common", "Step 1", "Step 2", "Step 3"):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+from manifest import default_manifest_path
+from cohort import find_mask_path
+from profiling import LOG_ENV
+
+##Step 1~3을 input() 없이 환자/phase 단위로 흘려보내는 오케스트레이터
+##단계마다 executor 크기와 대기열 길이가 따로 있어서, 환자 N+1이 분할되는 동안 환자 N의 메쉬/특징 추출이 같이 돎
+##DAG: segment, convert는 서로 독립(시리즈만 있으면 됨) -> mesh/rtstruct는 segment 뒤, hu/radiomics는 둘 다 끝난 뒤
+##출력: {output}/segmentation, nifti, stl, rtstruct, features (manifest는 output 루트에 하나)
+
+##단계 하나: 이름, 선행 단계, 워커 수, 대기열 길이(넘치면 새 환자를 안 받음), 스레드/프로세스, 실행 함수와 추가 인자
+class Stage:
+    def __init__(self, name, deps, fn, args=(), workers=1, queue=4, kind="process"):
+        self.name = name
+        self.deps = tuple(deps)
+        self.fn = fn
+        self.args = tuple(args)
+        self.workers = max(1, workers)
+        self.queue = max(1, queue)
+        self.kind = kind
+
+##상주 모드(detach)의 프로세스 풀 워커는 SIGINT/SIGTERM을 무시: 프로세스 그룹 전체에 보낸 종료 신호가 돌던 단계를 죽이지 않고
+##부모(watch.py의 stop)가 새 일을 안 주면서 돌던 것만 마무리하게 함 (한 번 더 보내면 부모가 바로 끝남)
+def _ignore_signals():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+##아래 단계 함수들은 프로세스 풀로 넘어가야 해서 모듈 최상단에 둠
+##payload는 {"patient_id", "phase", "dicom_folder", 선행 단계 이름: 결과}
+
+def segment_stage(payload, seg_base, organs, threads, manifest_path, detach=False):
+    from TotalSegmentator import segment_case
+    patient_id, phase = payload["patient_id"], payload["phase"]
+    failed = segment_case(patient_id, phase, payload["dicom_folder"], os.path.join(seg_base, patient_id, phase),
+                          organs, threads, manifest_path, detach)
+    masks = {organ: find_mask_path(seg_base, patient_id, phase, organ) for organ in organs}
+    if not any(masks.values()):
+        raise RuntimeError("; ".join(failed) or "마스크가 하나도 안 나왔어요")
+    return masks
+
+def convert_stage(payload, nifti_base, manifest_path, fast=True):
+    from DICOM_2_NIFTI import convert_dicom_folder
+    result = convert_dicom_folder(payload["dicom_folder"], nifti_base, payload["phase"], manifest_path, fast)
+    if result["status"] not in ("converted", "skipped"):
+        raise RuntimeError(f"{result['status']}: {result['error']}")
+    return result["output"]
+
+def mesh_stage(payload, stl_base, step_size=1):
+    from NIFTI_2_STL import nifti_to_stl
+    outputs = {}
+    for organ, mask_path in payload["segment"].items():
+        if mask_path is None:
+            continue
+        stl_path = os.path.join(stl_base, payload["patient_id"], f"{payload['patient_id']}_{payload['phase']}_{organ}.stl")
+        if nifti_to_stl(mask_path, stl_path, step_size=step_size):
+            outputs[organ] = stl_path
+    return outputs
+
+def rtstruct_stage(payload, dicom_root, seg_base, rtstruct_base, manifest_path, organs):
+    from rtstructb import process_patient
+    _, status, output = process_patient((payload["patient_id"], dicom_root, seg_base, rtstruct_base,
+                                         manifest_path, payload["phase"], organs, None))
+    if output is None:
+        raise RuntimeError(status)
+    return output
+
+def _feature_case(payload):
+    return {"patient_id": payload["patient_id"], "phase": payload["phase"],
+            "ct_path": payload["convert"], "mask_paths": payload["segment"]}
+
+def hu_stage(payload, shells=None, cache_path=None):
+    from sdf import hu_features_case
+    return hu_features_case(_feature_case(payload), shells=shells, cache_path=cache_path)
+
+def radiomics_stage(payload, param_path=None, cache_path=None):
+    from Pyradiomics import extract_case
+    return extract_case(_feature_case(payload), param_path, cache_path=cache_path)
+
+##DICOM 루트에서 {환자}/{phase} 폴더를 찾아 작업 목록으로
+def discover_series(dicom_root, phases=("PRE", "POST")) -> list:
+    cases = []
+    for name in sorted(os.listdir(dicom_root), key=lambda n: (len(n), n)):
+        for phase in phases:
+            folder = os.path.join(dicom_root, name, phase)
+            if name.isdigit() and os.path.isdir(folder):
+                cases.append({"patient_id": name, "phase": phase, "dicom_folder": folder})
+    return cases
+
+##한 스레드가 모든 단계의 future를 보면서 끝난 결과를 다음 단계 대기열로 넘김
+##새 환자는 모든 단계의 대기열에 여유가 있을 때만 받음 (느린 단계가 밀리면 앞 단계가 알아서 쉼)
+##feed를 주면 상주 모드: feed(빈 자리 수)가 새 케이스 목록을 주는 동안 계속 돌고, None을 주면 남은 것만 끝내고 멈춤
+##max_active는 동시에 파이프라인 안에 있는 환자/phase 수 상한, on_case_done(case, 결과, 상태)은 한 건의 모든 단계가 끝날 때마다
+##detach면 프로세스 풀 워커가 종료 신호를 무시함(상주 모드), 아니면 Ctrl-C에 대기 중인 단계는 취소하고 돌던 분할도 죽이고 멈춤
+##돌려주는 것: 환자/phase별 {단계: 결과}, 단계별 상태 표(DataFrame), 처음 결과까지 걸린 시간, 전체 시간
+def run_pipeline(cases: list, stages: list, feed=None, on_case_done=None, max_active=None, poll_seconds=2.0,
+                 detach=False):
+    cases = list(cases)
+    order = [stage.name for stage in stages]
+    by_name = {stage.name: stage for stage in stages}
+    downstream = {name: [s.name for s in stages if name in s.deps] for name in order}
+    roots = [stage.name for stage in stages if not stage.deps]
+    leaves = [name for name in order if not downstream[name]]
+
+    ##스레드 풀(segment)이 도는 중에 fork하면 잠금이 복사돼서 멈출 수 있어서 프로세스 풀은 spawn으로
+    spawn = multiprocessing.get_context("spawn")
+    executors = {
+        stage.name: ThreadPoolExecutor(max_workers=stage.workers) if stage.kind == "thread"
+        else ProcessPoolExecutor(max_workers=stage.workers, mp_context=spawn,
+                                 initializer=_ignore_signals if detach else None)
+        for stage in stages
+    }
+    ready = {name: deque() for name in order}
+    results = [dict() for _ in cases]
+    status = [dict() for _ in cases]
+    futures = {}
+    next_case = 0
+    finished = 0
+    feed_open = feed is not None
+    start = time.time()
+    first_result = None
+
+    def has_room():
+        return all(len(ready[name]) < by_name[name].queue for name in order)
+
+    def can_admit():
+        return has_room() and (max_active is None or next_case - finished < max_active)
+
+    def settle(index, name, state, value=None, error=None, seconds=None):
+        status[index][name] = {"status": state, "error": error, "seconds": seconds}
+        if state == "ok":
+            results[index][name] = value
+        for child in downstream[name]:
+            deps = by_name[child].deps
+            if all(d in status[index] for d in deps) and child not in status[index]:
+                if all(status[index][d]["status"] == "ok" for d in deps):
+                    ready[child].append(index)
+                else:
+                    settle(index, child, "skipped", error="선행 단계 실패")
+
+    try:
+        with tqdm(total=len(cases) * len(order), desc="파이프라인 진행 中", disable=feed is not None) as pbar:
+            while next_case < len(cases) or futures or any(ready.values()) or feed_open:
+                ##자리가 없어도 feed는 불러서 (slots=0) 새 시리즈 감시는 계속되게 함
+                if feed_open and next_case == len(cases):
+                    slots = (max_active - (next_case - finished) if max_active else 1) if can_admit() else 0
+                    new_cases = feed(slots)
+                    if new_cases is None:
+                        feed_open = False
+                    else:
+                        for case in new_cases:
+                            cases.append(case)
+                            results.append({})
+                            status.append({})
+                        pbar.total = len(cases) * len(order)
+
+                while next_case < len(cases) and can_admit():
+                    for name in roots:
+                        ready[name].append(next_case)
+                    next_case += 1
+
+                for name in order:
+                    stage = by_name[name]
+                    running = sum(1 for stage_name, _, _ in futures.values() if stage_name == name)
+                    while ready[name] and running < stage.workers:
+                        index = ready[name].popleft()
+                        payload = dict(cases[index], **{d: results[index][d] for d in stage.deps})
+                        future = executors[name].submit(stage.fn, payload, *stage.args)
+                        futures[future] = (name, index, time.time())
+                        running += 1
+
+                if not futures:
+                    ##상주 모드에서 할 일이 없으면 잠깐 쉬었다가 feed를 다시 봄
+                    if feed_open:
+                        time.sleep(poll_seconds)
+                    continue
+                done, _ = wait(list(futures), timeout=poll_seconds if feed_open else None,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, index, submitted = futures.pop(future)
+                    seconds = round(time.time() - submitted, 2)
+                    try:
+                        value = future.result()
+                    except Exception as e:
+                        settle(index, name, "failed", error=str(e), seconds=seconds)
+                    else:
+                        settle(index, name, "ok", value, seconds=seconds)
+                        if name in leaves and first_result is None:
+                            first_result = time.time() - start
+                    if len(status[index]) == len(order):
+                        finished += 1
+                        if on_case_done is not None:
+                            on_case_done(cases[index], results[index], status[index])
+                        ##상주 모드에서는 결과를 넘겨준 뒤 버려서 메모리가 안 쌓이게 함
+                        if feed is not None:
+                            results[index] = {}
+                pbar.n = sum(len(s) for s in status)
+                pbar.set_postfix(in_flight=len(futures), admitted=next_case)
+                pbar.refresh()
+    except (KeyboardInterrupt, SystemExit):
+        for executor in executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        from TotalSegmentator import kill_children
+        kill_children()
+        raise
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    rows = []
+    for case, stage_status in zip(cases, status):
+        for name in order:
+            info = stage_status.get(name, {"status": "not_run", "error": None, "seconds": None})
+            rows.append(dict(patient_id=case["patient_id"], phase=case["phase"], stage=name, **info))
+    return results, pd.DataFrame(rows), first_result, time.time() - start
+
+##CLI 인자로 단계 목록을 만들어 돌리고, 특징 표와 단계별 상태 표를 output 루트에 저장
+def build_stages(args, output_base, manifest_path, detach=False) -> list:
+    seg_base = os.path.join(output_base, "segmentation")
+    nifti_base = os.path.join(output_base, "nifti")
+    threads = max(1, (args.total_threads or os.cpu_count() or 1) // args.segment_workers)
+    stages = [
+        Stage("segment", [], segment_stage, (seg_base, args.organs, threads, manifest_path, detach),
+              args.segment_workers, args.queue, kind="thread"),
+        Stage("convert", [], convert_stage, (nifti_base, manifest_path), args.convert_workers, args.queue),
+    ]
+    if "mesh" in args.stages:
+        stages.append(Stage("mesh", ["segment"], mesh_stage, (os.path.join(output_base, "stl"),),
+                            args.mesh_workers, args.queue))
+    if "rtstruct" in args.stages:
+        stages.append(Stage("rtstruct", ["segment"], rtstruct_stage,
+                            (args.dicom_root, seg_base, os.path.join(output_base, "rtstruct"), manifest_path,
+                             args.organs),
+                            args.rtstruct_workers, args.queue))
+    if "hu" in args.stages:
+        stages.append(Stage("hu", ["segment", "convert"], hu_stage, (None, args.cache_path),
+                            args.feature_workers, args.queue))
+    if "radiomics" in args.stages:
+        stages.append(Stage("radiomics", ["segment", "convert"], radiomics_stage, (args.param_path, args.cache_path),
+                            args.feature_workers, args.queue))
+    return stages
+
+##build_stages가 쓰는 인자들 (watch.py 상주 모드도 같은 인자를 씀)
+def add_stage_arguments(parser):
+    parser.add_argument("--organs", nargs="+", default=["pancreas"])
+    parser.add_argument("--phases", nargs="+", default=["PRE", "POST"])
+    parser.add_argument("--stages", nargs="+", default=["mesh", "rtstruct", "hu", "radiomics"],
+                        choices=["mesh", "rtstruct", "hu", "radiomics"], help="segment/convert 뒤에 붙일 단계")
+    parser.add_argument("--segment-workers", type=int, default=1)
+    parser.add_argument("--total-threads", type=int, default=None, help="TotalSegmentator 전체 스레드 예산")
+    parser.add_argument("--convert-workers", type=int, default=2)
+    parser.add_argument("--mesh-workers", type=int, default=2)
+    parser.add_argument("--rtstruct-workers", type=int, default=1)
+    parser.add_argument("--feature-workers", type=int, default=2)
+    parser.add_argument("--queue", type=int, default=4, help="단계별 대기열 길이")
+    parser.add_argument("--param-path", default=None, help="PyRadiomics YAML")
+    parser.add_argument("--cache-path", default=None, help="특징 캐시 SQLite (없으면 캐시 안 씀)")
+    parser.add_argument("--profile-log", default=None, help="단계별 계측 JSON-lines (워커 프로세스 포함)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="분할 -> 변환 -> 메쉬/RTSTRUCT/HU/Radiomics를 환자 단위로 흘려보내기")
+    parser.add_argument("dicom_root", help="{환자}/{phase}/ DICOM 폴더들이 있는 루트")
+    parser.add_argument("output_base", help="결과 루트 (segmentation, nifti, stl, rtstruct, features)")
+    add_stage_arguments(parser)
+    args = parser.parse_args(argv)
+
+    ##executor를 만들기 전에 환경변수로 넣어야 워커 프로세스도 같은 파일에 기록함
+    if args.profile_log:
+        os.environ[LOG_ENV] = os.path.abspath(args.profile_log)
+
+    os.makedirs(args.output_base, exist_ok=True)
+    manifest_path = default_manifest_path(args.output_base)
+    cases = discover_series(args.dicom_root, args.phases)
+    if not cases:
+        print(f"돌릴 시리즈가 없어요: {args.dicom_root}")
+        return 1
+
+    results, report, first_result, makespan = run_pipeline(cases, build_stages(args, args.output_base, manifest_path))
+
+    feature_dir = os.path.join(args.output_base, "features")
+    os.makedirs(feature_dir, exist_ok=True)
+    for name in ("hu", "radiomics"):
+        rows = [row for case_results in results for row in case_results.get(name, [])]
+        if rows:
+            pd.DataFrame(rows).to_csv(os.path.join(feature_dir, f"{name}_features.csv"), index=False)
+    report_path = os.path.join(args.output_base, "pipeline_report.csv")
+    report.to_csv(report_path, index=False)
+
+    print(report.pivot_table(index="stage", columns="status", values="patient_id", aggfunc="count",
+                             fill_value=0).to_string())
+    if first_result is not None:
+        print(f"첫 결과까지 {first_result:.1f}초")
+    print(f"전체 {makespan:.1f}초, 단계별 상태 표: {report_path}")
+    if args.profile_log:
+        print(f"계측 기록: {args.profile_log} (python Common/profiling.py summary 로 요약)")
+    return 0 if (report["status"] == "ok").all() else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
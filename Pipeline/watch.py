@@ -0,0 +1,260 @@
+import argparse
+import heapq
+import json
+import os
+import signal
+import sys
+import time
+import uuid
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from pipeline import add_stage_arguments, build_stages, discover_series, run_pipeline
+from manifest import default_manifest_path
+from profiling import LOG_ENV
+
+##스캐너가 DICOM을 떨구는 인박스 폴더({환자}/{phase}/)를 계속 보면서, 다 들어온 시리즈를 바로 파이프라인에 넣는 상주 모드
+##완료 판단: 파일 수/전체 크기/최근 mtime이 settle_seconds 동안 그대로면 다 들어온 것으로 봄 (폴링, 추가 패키지 없음)
+##우선순위: 시리즈 폴더나 환자 폴더의 PRIORITY 파일 숫자(클수록 먼저, 없으면 0), 같으면 먼저 안정된 순서
+##결과: 단계 산출물은 pipeline.py와 같은 자리에, 환자/phase별 특징 표와 status.json은 {output}/published/{환자}/{phase}/
+##      파일마다 임시 파일에 쓰고 os.replace로 바꾸고, status.json을 맨 마지막에 써서 이게 보이면 다 끝난 것
+##status.json에 시리즈 signature가 남아서, 재시작해도 이미 게시된 시리즈는 건너뜀 (실패한 것도 파일이 바뀌거나 status.json을 지워야 다시 돎)
+##종료 신호를 받은 뒤 실패/건너뜀 단계가 있는 시리즈는 종료 때문에 멈췄을 수 있어서 게시하지 않음 (재시작하면 다시 돎)
+
+PUBLISHED = "published"
+STATUS_FILE = "status.json"
+PRIORITY_FILE = "PRIORITY"
+
+##전송 중인 임시 파일(.으로 시작, .part/.tmp)은 세지 않음
+def _is_partial(name: str) -> bool:
+    return name.startswith(".") or name.endswith((".part", ".tmp", ".partial"))
+
+##시리즈 폴더의 (파일 수, 전체 바이트, 가장 최근 mtime_ns), 파일 내용은 안 읽음
+def series_signature(folder: str):
+    count = size = newest = 0
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or _is_partial(entry.name) or entry.name == PRIORITY_FILE:
+                    continue
+                st = entry.stat()
+                count += 1
+                size += st.st_size
+                newest = max(newest, st.st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    return count, size, newest
+
+def read_priority(series_folder: str) -> int:
+    for folder in (series_folder, os.path.dirname(series_folder)):
+        path = os.path.join(folder, PRIORITY_FILE)
+        try:
+            with open(path, encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            continue
+    return 0
+
+def published_dir(output_base: str, patient_id: str, phase: str) -> str:
+    return os.path.join(output_base, PUBLISHED, patient_id, phase)
+
+def _published_signature(output_base, patient_id, phase):
+    try:
+        with open(os.path.join(published_dir(output_base, patient_id, phase), STATUS_FILE), encoding="utf-8") as f:
+            signature = json.load(f).get("signature")
+        return tuple(signature) if signature else None
+    except (OSError, ValueError):
+        return None
+
+##같은 폴더에 임시 파일로 다 쓴 뒤 os.replace (읽는 쪽은 옛 파일 아니면 새 파일만 봄)
+def _atomic_write(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class SeriesWatcher:
+    def __init__(self, inbox, output_base, phases=("PRE", "POST"), settle_seconds=60.0, poll_seconds=5.0):
+        self.inbox = inbox
+        self.output_base = output_base
+        self.phases = tuple(phases)
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        ##키 (환자, phase) -> {"signature", "since"(이 signature가 된 시각), "first_seen"}
+        self.tracked = {}
+        self.heap = []
+        self.queued = set()
+        self.active = {}
+        self.last_scan = None
+        ##마지막으로 훑었을 때 아직 안정되길 기다리던 시리즈 수
+        self.unsettled = 0
+
+    ##poll_seconds마다 한 번씩 인박스를 훑어서 안정된 새 시리즈를 우선순위 큐에 넣음
+    def scan(self, now=None):
+        now = time.time() if now is None else now
+        if self.last_scan is not None and now - self.last_scan < self.poll_seconds:
+            return 0
+        self.last_scan = now
+        if not os.path.isdir(self.inbox):
+            return 0
+
+        added = 0
+        self.unsettled = 0
+        for case in discover_series(self.inbox, self.phases):
+            key = (case["patient_id"], case["phase"])
+            signature = series_signature(case["dicom_folder"])
+            if not signature or not signature[0]:
+                continue
+            state = self.tracked.get(key)
+            if state is None or state["signature"] != signature:
+                first_seen = state["first_seen"] if state else now
+                self.tracked[key] = state = {"signature": signature, "since": now, "first_seen": first_seen}
+            if now - state["since"] < self.settle_seconds:
+                self.unsettled += 1
+                continue
+            if key in self.queued or key in self.active:
+                continue
+            if _published_signature(self.output_base, *key) == signature:
+                continue
+            priority = read_priority(case["dicom_folder"])
+            heapq.heappush(self.heap, (-priority, state["since"], key, case))
+            self.queued.add(key)
+            added += 1
+            print(f"[대기열] {key[0]}/{key[1]}: 슬라이스 {signature[0]}장, 우선순위 {priority}")
+        return added
+
+    ##우선순위 순으로 최대 slots건 꺼냄, 꺼내는 순간 다시 확인해서 그 사이 파일이 늘었으면 안정될 때까지 미룸
+    def take(self, slots: int) -> list:
+        cases = []
+        while self.heap and len(cases) < slots:
+            _, since, key, case = heapq.heappop(self.heap)
+            self.queued.discard(key)
+            signature = series_signature(case["dicom_folder"])
+            if signature != self.tracked[key]["signature"]:
+                self.tracked[key].update(signature=signature, since=time.time())
+                continue
+            state = self.tracked[key]
+            self.active[key] = signature
+            cases.append(dict(case, signature=list(signature), first_seen=state["first_seen"], stable_at=since,
+                              started_at=time.time()))
+        return cases
+
+    def done(self, case):
+        self.active.pop((case["patient_id"], case["phase"]), None)
+
+##한 건이 끝나면 특징 표와 status.json을 published/{환자}/{phase}/에 원자적으로 씀
+def publish(output_base: str, case: dict, results: dict, status: dict) -> dict:
+    folder = published_dir(output_base, case["patient_id"], case["phase"])
+    outputs = {}
+    for name in ("hu", "radiomics"):
+        rows = results.get(name)
+        if rows:
+            path = os.path.join(folder, f"{name}_features.csv")
+            _atomic_write(path, lambda tmp, rows=rows: pd.DataFrame(rows).to_csv(tmp, index=False))
+            outputs[name] = path
+    for name in ("segment", "convert", "mesh", "rtstruct"):
+        if name in results:
+            outputs[name] = results[name]
+
+    published_at = time.time()
+    record = {
+        "patient_id": case["patient_id"],
+        "phase": case["phase"],
+        "dicom_folder": case["dicom_folder"],
+        "signature": case["signature"],
+        "ok": all(info["status"] == "ok" for info in status.values()),
+        "stages": status,
+        "outputs": outputs,
+        "first_seen": case["first_seen"],
+        "stable_at": case["stable_at"],
+        "started_at": case["started_at"],
+        "published_at": published_at,
+        "latency_s": round(published_at - case["first_seen"], 1),
+    }
+
+    def write_status(tmp):
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, indent=2, default=str)
+    _atomic_write(os.path.join(folder, STATUS_FILE), write_status)
+    return record
+
+##인박스를 보면서 파이프라인을 계속 돌림, once면 지금 안정된 것만 처리하고 끝냄
+##SIGINT/SIGTERM을 받으면 새 시리즈는 안 받고 돌던 것만 마무리 (한 번 더 보내면 바로 종료)
+##단계 워커와 TotalSegmentator는 신호를 안 받게 띄워서(detach: pipeline._ignore_signals, start_new_session) 돌던 것은 끝까지 감
+def watch(args):
+    os.makedirs(args.output_base, exist_ok=True)
+    manifest_path = default_manifest_path(args.output_base)
+    watcher = SeriesWatcher(args.inbox, args.output_base, args.phases, args.settle_seconds, args.poll_seconds)
+    stopping = []
+
+    def stop(signum, _frame):
+        print(f"\n그만할게요 (signal {signum}): 돌던 시리즈만 마무리해요")
+        stopping.append(signum)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    def feed(slots):
+        if stopping:
+            return None
+        watcher.scan()
+        cases = watcher.take(slots)
+        ##once: 안정되길 기다리는 시리즈도, 대기열/처리 중인 시리즈도 없으면 끝
+        if args.once and not cases and not watcher.heap and not watcher.active and not watcher.unsettled:
+            return None
+        return cases
+
+    counts = {"ok": 0, "failed": 0, "interrupted": 0}
+
+    def on_case_done(case, results, status):
+        watcher.done(case)
+        failed = [name for name, info in status.items() if info["status"] != "ok"]
+        if stopping and failed:
+            counts["interrupted"] += 1
+            print(f"[중단] {case['patient_id']}/{case['phase']}: 그만하는 중에 {failed} 단계가 못 끝나서 게시 안 함 "
+                  "(재시작하면 다시 돌아요)")
+            return
+        try:
+            record = publish(args.output_base, case, results, status)
+        except Exception as e:
+            counts["failed"] += 1
+            print(f"[실패] {case['patient_id']}/{case['phase']}: 결과 게시 실패 {e}")
+            return
+        counts["ok" if record["ok"] else "failed"] += 1
+        print(f"[완료] {case['patient_id']}/{case['phase']}: 처음 본 뒤 {record['latency_s']}초"
+              + (f", 실패/건너뜀 단계 {failed}" if failed else ""))
+
+    print(f"인박스 감시 시작: {args.inbox} (안정 {args.settle_seconds}초, 동시 {args.max_active}건)")
+    run_pipeline([], build_stages(args, args.output_base, manifest_path, detach=True), feed=feed,
+                 on_case_done=on_case_done, max_active=args.max_active, poll_seconds=min(args.poll_seconds, 2.0),
+                 detach=True)
+    print(f"감시 끝: 완료 {counts['ok']}건, 실패 {counts['failed']}건"
+          + (f", 중단돼서 다음에 다시 돌 것 {counts['interrupted']}건" if counts["interrupted"] else ""))
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="인박스 폴더를 보면서 새 DICOM 시리즈를 바로 분할/변환/특징 추출")
+    parser.add_argument("inbox", help="스캐너가 {환자}/{phase}/ 로 DICOM을 떨구는 폴더")
+    parser.add_argument("output_base", help="결과 루트 (pipeline.py와 같은 구조 + published/)")
+    add_stage_arguments(parser)
+    parser.add_argument("--settle-seconds", type=float, default=60.0, help="파일 수/크기가 이만큼 그대로면 다 들어온 것")
+    parser.add_argument("--poll-seconds", type=float, default=5.0, help="인박스 훑는 간격")
+    parser.add_argument("--max-active", type=int, default=2, help="동시에 처리하는 시리즈 수")
+    parser.add_argument("--once", action="store_true", help="지금 들어와 있는 것만 처리하고 끝내기")
+    args = parser.parse_args(argv)
+    args.dicom_root = args.inbox
+
+    if args.profile_log:
+        os.environ[LOG_ENV] = os.path.abspath(args.profile_log)
+    counts = watch(args)
+    return 0 if not counts["failed"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
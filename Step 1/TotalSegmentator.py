@@ -1,60 +1,118 @@
 import os
+import signal
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
-##주어진 경로에서 하위 파일을 f로 잡아 f 파일을 읽을 때 .dcm으로 끝나는 것들만 파일로 인식
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Common"))
+from manifest import default_manifest_path, is_stage_done, record_stage
+from dicom_index import index_folder
+from profiling import instrument, wait_child
+
+##주어진 경로에서 .dcm이거나 확장자 없는 파일 중 실제로 DICOM 헤더가 읽히는 게 있을 때만 인식
+##헤더는 dicom_index에 저장돼서 다음 Step에서는 다시 읽지 않음
 def validate_dicom_folder(folder_path: str) -> bool:
-    for f in os.listdir(folder_path):
-        if f.lower().endswith('.dcm') or (not '.' in f):
-            return True
-    return False
+    return any(h["valid"] for h in index_folder(folder_path))
+
+##장기 이름을 "pancreas liver" 또는 "pancreas,liver" 처럼 받아 리스트로 정리
+def parse_organs(organ_input) -> list:
+    if isinstance(organ_input, str):
+        organ_input = organ_input.replace(",", " ").split()
+    organs = []
+    for organ in organ_input:
+        organ = organ.strip().lower()
+        if organ and organ not in organs:
+            organs.append(organ)
+    return organs
+
+##TotalSegmentator 명령어 만들기, threads가 있으면 리샘플링/저장 스레드 수도 같이 넘김
+def build_segmentation_command(dicom_folder: str, output_path: str, organs: list, threads: int = None) -> list:
+    command = [
+        "TotalSegmentator",
+        "-i", dicom_folder,
+        "-o", output_path,
+    ]
+    ##--ml은 하나의 라벨맵으로 합쳐버려서, 장기가 여러 개면 장기별 파일로 받아 rename_output에서 나눔
+    if len(organs) == 1:
+        command.append("--ml")
+    command += ["--roi_subset", *organs, "--output_type", "nifti"]
+    if threads:
+        command += ["--nr_thr_resamp", str(threads), "--nr_thr_saving", str(threads)]
+    return command
+
+##동시에 여러 개 돌릴 때 torch/OMP가 코어를 다 잡아먹지 않도록 스레드 수를 환경변수로 제한
+def thread_env(threads: int = None) -> dict:
+    env = os.environ.copy()
+    if threads:
+        for key in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"):
+            env[key] = str(threads)
+    return env
+
+##지금 돌고 있는 TotalSegmentator 자식 {Popen: 따로 세션인지}, 중단될 때 kill_children으로 정리
+_children = {}
+_children_lock = threading.Lock()
+
+##돌고 있는 자식을 모두 죽임 (따로 세션이면 그 프로세스 그룹 전체), 기다리는 스레드의 wait_child가 바로 돌아옴
+def kill_children():
+    with _children_lock:
+        children = list(_children.items())
+    for process, detached in children:
+        try:
+            if detached and hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass
 
 ##validate_dicom_folder에서 파일로 인정된 폴더에 대해서만 command line 사용해서 Totalsegmentator 사용
-def run_segmentation(dicom_folder: str, output_path: str, organ: str):
+##여러 장기를 넣으면 --roi_subset a b c 로 한 번만 돌려서 모델 로딩과 DICOM 읽기를 한 번으로 줄임
+##detach: 따로 세션에 띄워서 프로세스 그룹에 보낸 Ctrl-C/SIGTERM을 안 받게 함 (watch.py 상주 모드에서 돌던 분할을 끝까지 돌리려고)
+@instrument("segmentation")
+def run_segmentation(dicom_folder: str, output_path: str, organ, threads: int = None, detach: bool = False):
+    organs = parse_organs(organ)
+    organ_tag = "_".join(organs)
     try:
         if not validate_dicom_folder(dicom_folder):
             print(f"DICOM 파일이 없는 것으로 보입니다: {dicom_folder}")
             return False
 
-        segmentator_cmd = "TotalSegmentator"
-
-        command = [
-            segmentator_cmd,
-            "-i", dicom_folder,
-            "-o", output_path,
-            "--ml",
-            "--roi_subset", organ,
-            "--output_type", "nifti"
-        ]
+        command = build_segmentation_command(dicom_folder, output_path, organs, threads)
 
         print(f"\n명령어 실행 中...: {' '.join(command)}")
 
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        print(f"변환이 완료됐어요: {dicom_folder}")
-
-        ##각 DICOM 파일마다 성공과 실패 여부를 확인해 txt 파일로 저장 
-      
-        log_file_path = os.path.join(output_path, f"{organ}_segmentation_log.txt")
+        ##각 DICOM 파일마다 성공과 실패 여부를 txt 파일로 저장, 메모리에 모아두지 않고 돌아가는 동안 바로 기록
+        log_file_path = os.path.join(output_path, f"{organ_tag}_segmentation_log.txt")
         with open(log_file_path, "w", encoding="utf-8") as log_file:
-            log_file.write("=== STDOUT ===\n")
-            log_file.write(result.stdout)
-            log_file.write("\n\n=== STDERR ===\n")
-            log_file.write(result.stderr)
+            log_file.write("=== STDOUT / STDERR ===\n")
+            log_file.flush()
+            process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT,
+                                       text=True, env=thread_env(threads), start_new_session=detach)
+            with _children_lock:
+                _children[process] = detach
+            try:
+                returncode = wait_child(process)
+            finally:
+                with _children_lock:
+                    _children.pop(process, None)
 
-        return True
+        if returncode != 0:
+            print(f"처리 실패: {dicom_folder}")
+            print("실패한 명령어:", ' '.join(command))
+            print(f"로그 확인해 보아요: {log_file_path}")
+            return False
 
-    except subprocess.CalledProcessError as e:
-        print(f"처리 실패: {dicom_folder}")
-        print("실패한 명령어:", ' '.join(e.cmd))
-        print("STDOUT:\n", e.stdout)
-        print("STDERR:\n", e.stderr)
-        return False
+        print(f"변환이 완료됐어요: {dicom_folder}")
+        return True
 
     except Exception as e:
         print(f"예외 발생: {dicom_folder}")
         print(str(e))
         return False
+
 ##추후 데이터 다룰 때 .nii.gz 통일해 꺼내오기 쉽도록 전체 파일 수정 
 def rename_output(output_folder: str, phase: str, organ: str, patient_id: str) -> bool:
     output_file = os.path.join(output_folder, f"{organ}.nii.gz")
@@ -68,22 +126,108 @@ def rename_output(output_folder: str, phase: str, organ: str, patient_id: str) -
         print(f"이름 없는 친구...: {output_file}")
         return False
       
+##환자/phase 한 건을 돌리고 장기별 실패 목록을 돌려줌, 스케줄러의 작업 단위
+##manifest_path가 있으면 입력 시리즈가 그대로이고 결과가 남아 있는 장기는 건너뜀
+def segment_case(patient_id: str, phase: str, phase_folder: str, output_folder: str,
+                 organs: list, threads: int = None, manifest_path: str = None, detach: bool = False) -> list:
+    failed = []
+    organs = [organ for organ in organs
+              if not is_stage_done(manifest_path, "segmentation", f"{patient_id}/{phase}/{organ}",
+                                   phase_folder, {"organ": organ})]
+    if not organs:
+        print(f"이미 분할됨: {phase_folder}")
+        return failed
+
+    os.makedirs(output_folder, exist_ok=True)
+    print(f"\n 변신 중: {phase_folder} 에서 {output_folder}")
+    ##시리즈당 한 번만 돌리고 장기별로 이름 바꾸기, 실패도 장기별로 기록
+    if run_segmentation(phase_folder, output_folder, organs, threads, detach):
+        for organ in organs:
+            if rename_output(output_folder, phase, organ, patient_id):
+                record_stage(manifest_path, "segmentation", f"{patient_id}/{phase}/{organ}",
+                             phase_folder, {"organ": organ},
+                             os.path.join(output_folder, f"{patient_id}_{phase}_{organ}.nii.gz"))
+            else:
+                failed.append(f"{patient_id}/{phase}/{organ} (결과 파일 없음)")
+    else:
+        for organ in organs:
+            failed.append(f"{patient_id}/{phase}/{organ} (segmentation 실패)")
+    return failed
+
+##TotalSegmentator 프로세스를 max_jobs개까지 동시에 돌리고, 전체 스레드 예산을 작업 수로 나눠줌
+def run_segmentation_jobs(jobs: list, organs: list, max_jobs: int = 1, total_threads: int = None,
+                          manifest_path: str = None) -> list:
+    if total_threads is None:
+        total_threads = os.cpu_count() or 1
+    max_jobs = max(1, min(max_jobs, len(jobs) or 1))
+    threads = max(1, total_threads // max_jobs)
+    print(f"동시 작업 {max_jobs}개, 작업당 스레드 {threads}개")
+
+    failed_cases = []
+    lock = threading.Lock()
+    in_flight = [0]
+    start_time = time.time()
+
+    def worker(job):
+        with lock:
+            in_flight[0] += 1
+        try:
+            return segment_case(*job, organs, threads, manifest_path)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+
+    ##with로 닫으면 예외가 나도 대기 중인 환자를 다 돌린 뒤에야 올라와서, 실패하면 대기 중인 것은 취소하고 올림
+    ##Ctrl-C(KeyboardInterrupt)는 이 스레드에만 오고 자식을 기다리는 건 워커 스레드라, 돌던 TotalSegmentator는 직접 죽임
+    executor = ThreadPoolExecutor(max_workers=max_jobs)
+    try:
+        with tqdm(total=len(jobs), desc="전체 환자 진행률") as pbar:
+            futures = [executor.submit(worker, job) for job in jobs]
+            for future in as_completed(futures):
+                failed_cases.extend(future.result())
+                pbar.update(1)
+                elapsed_min = (time.time() - start_time) / 60
+                pbar.set_postfix(in_flight=in_flight[0],
+                                 cases_per_min=f"{pbar.n / elapsed_min:.2f}" if elapsed_min else "-")
+    except (KeyboardInterrupt, SystemExit):
+        executor.shutdown(wait=False, cancel_futures=True)
+        kill_children()
+        raise
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+
+    return failed_cases
+
 ##입출력 경로 입력 받아 위 함수들이 움직이게 하는 메인 함수
 def main():
     print("파일 경로를 입력해요")
     base_path = input("시리즈가 있는 파일을 넣어보아요: ").strip()
     base_output_path = input("나왔으면 하는 폴더를 넣어보아요: ").strip()
     phase_input = input("처리할 phase를 입력해 보아요 PRE, POST, BOTH 중에서: ").strip().upper()
-    organ = input("분할할 장기 이름을 입력해 보아요: ").strip().lower()
+    organs = parse_organs(input("분할할 장기 이름을 입력해 보아요 (여러 개면 띄어쓰기나 쉼표로): "))
+    max_jobs_input = input("동시에 돌릴 작업 수를 입력해 보아요 (기본 1): ").strip()
+    total_threads_input = input(f"전체 CPU 스레드 예산을 입력해 보아요 (기본 {os.cpu_count()}): ").strip()
 
     ##슬래시 떨어트리기 
     base_path = os.path.normpath(base_path)
     base_output_path = os.path.normpath(base_output_path)
 
+    if not organs:
+        print("장기 이름을 하나 이상 입력해 보아요.")
+        sys.exit(1)
+
     if phase_input not in ['PRE', 'POST', 'BOTH']:
         print("PRE, POST, 또는 BOTH 중 하나를 입력해 보아요.")
         sys.exit(1)
 
+    if not (max_jobs_input or "1").isdigit() or not (total_threads_input or "1").isdigit():
+        print("작업 수와 스레드 수는 숫자로 입력해 보아요.")
+        sys.exit(1)
+    max_jobs = int(max_jobs_input) if max_jobs_input else 1
+    total_threads = int(total_threads_input) if total_threads_input else None
+
     phases = ['PRE', 'POST'] if phase_input == 'BOTH' else [phase_input]
 
     if not os.path.exists(base_path):
@@ -91,12 +235,12 @@ def main():
         sys.exit(1)
 
     os.makedirs(base_output_path, exist_ok=True)
-    failed_cases = []
     ##환자 폴더 이름이 숫자로 이루어질 때 선택해 DICOM 읽기 
     patient_folders = [d for d in os.listdir(base_path)
                        if os.path.isdir(os.path.join(base_path, d)) and d.isdigit()]
 
-    for patient_id in tqdm(patient_folders, desc="전체 환자 진행률"):
+    jobs = []
+    for patient_id in patient_folders:
         patient_folder = os.path.join(base_path, patient_id)
 
         for phase in phases:
@@ -104,28 +248,23 @@ def main():
 
             if os.path.isdir(phase_folder):
                 output_folder = os.path.join(base_output_path, patient_id, phase)
-                os.makedirs(output_folder, exist_ok=True)
-
-                print(f"\n 변신 중: {phase_folder} 에서 {output_folder}")
-                if run_segmentation(phase_folder, output_folder, organ):
-                    if not rename_output(output_folder, phase, organ, patient_id):
-                        failed_cases.append(f"{patient_id}/{phase} (결과 파일 없음)")
-                else:
-                    failed_cases.append(f"{patient_id}/{phase} (segmentation 실패)")
+                jobs.append((patient_id, phase, phase_folder, output_folder))
 
+    failed_cases = run_segmentation_jobs(jobs, organs, max_jobs, total_threads,
+                                         default_manifest_path(base_output_path))
     if failed_cases:
         print("\n실패한 케이스 목록:")
         for item in failed_cases:
             print(" -", item)
 
-        failed_path = os.path.join(base_output_path, f"failed_cases_{organ}.txt")
+        failed_path = os.path.join(base_output_path, f"failed_cases_{'_'.join(organs)}.txt")
         with open(failed_path, "w", encoding="utf-8") as f:
             for item in failed_cases:
                 f.write(item + "\n")
 
         print(f"\n실패한 목록이 저장되었어요: {failed_path}")
     else:
-        print(f"\n[{organ}] 모두 변환이 되었어요!")
+        print(f"\n[{', '.join(organs)}] 모두 변환이 되었어요!")
 
 if __name__ == "__main__":
     main()
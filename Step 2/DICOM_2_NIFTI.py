@@ -1,8 +1,21 @@
 import os
 import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import dicom2nifti
 import dicom2nifti.settings
 import nibabel as nib
+import numpy as np
+import pandas as pd
+import pydicom
+from nibabel.orientations import axcodes2ornt, io_orientation, ornt_transform
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Common"))
+from manifest import default_manifest_path, is_stage_done, record_stage
+from dicom_index import image_slices, index_folder
+from profiling import failed_status, instrument, record_metric
 
 ##DICOM 시리즈가 갖고 있는 모든 데이터를 만들어서 추후 히스토그램이나 RT Structure로 재구성할 때 필요한 파일 
 
@@ -11,45 +24,185 @@ def extract_patient_id(path: str) -> str:
     match = re.findall(r"\d+", path)
     return match[-1].zfill(3) if match else "000"
 
-def convert_dicom_folder(dicom_folder: str, output_base: str, phase: str):
+##깨끗한 축방향 CT만 받는 빠른 변환기, 기울어진 갠트리나 간격이 불규칙하면 None을 돌려줘서 dicom2nifti로 넘김
+##색인된 헤더로 가장 큰 시리즈 하나만 골라 슬라이스 법선 투영 순으로 쌓고, 픽셀 디코딩은 스레드로 나눠서 함
+def fast_dicom_to_nifti(dicom_folder: str, output_nii: str, max_workers: int = 8, spacing_tolerance: float = 0.01):
+    slices = image_slices(dicom_folder, sop_class_uid=None)
+    if len(slices) < 2:
+        return None
+
+    series = {}
+    for h in slices:
+        series.setdefault(h["SeriesInstanceUID"], []).append(h)
+    slices = max(series.values(), key=len)
+
+    ##image_slices는 IPP가 없는 슬라이스를 빼 버리므로, 같은 시리즈에 그런 게 있으면 구멍 난 볼륨이 되니 넘김
+    uid = slices[0]["SeriesInstanceUID"]
+    if any(h["valid"] and h["Modality"] == "CT" and h["SeriesInstanceUID"] == uid
+           and h["ImagePositionPatient"] is None for h in index_folder(dicom_folder)):
+        return None
+
+    ##모든 슬라이스가 같은 크기, 방향, 픽셀 간격이어야 함
+    first = slices[0]
+    for h in slices:
+        if (h["Rows"], h["Columns"]) != (first["Rows"], first["Columns"]) \
+                or h["ImageOrientationPatient"] is None or h["PixelSpacing"] is None \
+                or len(h["ImagePositionPatient"]) != 3 or len(h["ImageOrientationPatient"]) != 6 \
+                or len(h["PixelSpacing"]) != 2 \
+                or not np.allclose(h["ImageOrientationPatient"], first["ImageOrientationPatient"], atol=1e-4) \
+                or not np.allclose(h["PixelSpacing"], first["PixelSpacing"], atol=1e-4):
+            return None
+
+    iop = np.array(first["ImageOrientationPatient"])
+    row_dir, col_dir = iop[:3], iop[3:]
+    normal = np.cross(row_dir, col_dir)
+    ipp = np.array([h["ImagePositionPatient"] for h in slices])
+
+    ##슬라이스 간 이동이 법선과 평행하지 않으면 갠트리 틸트, 간격이 들쭉날쭉하면 불규칙 간격
+    steps = np.diff(ipp, axis=0)
+    along = steps @ normal
+    if np.any(along <= 0):
+        return None
+    off_axis = np.linalg.norm(steps - np.outer(along, normal), axis=1)
+    if np.any(off_axis > spacing_tolerance * along):
+        return None
+    if np.any(np.abs(along - np.median(along)) > spacing_tolerance * np.median(along)):
+        return None
+
+    ##slope/intercept가 정수면 int16 그대로, 아니면 float32로
+    slopes = {h["RescaleSlope"] for h in slices}
+    intercepts = {h["RescaleIntercept"] for h in slices}
+    integral = all(float(v).is_integer() for v in slopes | intercepts)
+    dtype = np.int16 if integral else np.float32
+
+    rows, cols = first["Rows"], first["Columns"]
+    volume = np.empty((cols, rows, len(slices)), dtype=dtype)
+    record_metric("voxels", volume.size)
+
+    def decode(k):
+        h = slices[k]
+        pixels = pydicom.dcmread(h["path"], force=True).pixel_array
+        if integral:
+            values = pixels.astype(np.int32) * int(h["RescaleSlope"]) + int(h["RescaleIntercept"])
+            volume[:, :, k] = np.clip(values, -32768, 32767).T
+        else:
+            volume[:, :, k] = (pixels.astype(np.float32) * h["RescaleSlope"] + h["RescaleIntercept"]).T
+
+    ##압축 전송 구문을 풀 핸들러가 없거나 픽셀 크기가 헤더와 다르면 실패로 치지 않고 dicom2nifti로 넘김
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(decode, range(len(slices))))
+    except Exception as e:
+        print(f"빠른 변환은 포기하고 dicom2nifti로 갈게요: {dicom_folder} - {e}")
+        return None
+
+    ##DICOM(LPS) 기준 affine을 만들고 x, y 부호를 뒤집어 NIfTI(RAS)로
+    row_spacing, col_spacing = first["PixelSpacing"]
+    affine = np.eye(4)
+    affine[:3, 0] = row_dir * col_spacing
+    affine[:3, 1] = col_dir * row_spacing
+    affine[:3, 2] = (ipp[-1] - ipp[0]) / (len(slices) - 1)
+    affine[:3, 3] = ipp[0]
+    affine[:2, :] *= -1
+
+    ##dicom2nifti reorient 결과와 같게 LAS로 맞춤 (축 뒤집기/바꾸기만, 리샘플링 없음)
+    img = nib.Nifti1Image(volume, affine)
+    img = img.as_reoriented(ornt_transform(io_orientation(affine), axcodes2ornt(("L", "A", "S"))))
+    img.header.set_slope_inter(1, 0)
+    img.header.set_xyzt_units(2)
+    nib.save(img, output_nii)
+    return img
+
+##변환 결과를 표로 모을 수 있게 환자/phase마다 상태를 dict로 돌려줌 (converted, skipped, no_dicom, failed)
+@instrument("dicom2nifti", failed=failed_status)
+def convert_dicom_folder(dicom_folder: str, output_base: str, phase: str, manifest_path: str = None,
+                         fast: bool = True) -> dict:
+    start = time.time()
+    patient_id = extract_patient_id(dicom_folder)
+    result = {"patient_id": patient_id, "phase": phase, "dicom_folder": dicom_folder,
+              "status": "failed", "output": None, "error": None, "seconds": 0.0}
+
+    def finish(status, output=None, error=None):
+        result.update(status=status, output=output, error=error, seconds=round(time.time() - start, 2))
+        return result
+
     if not os.path.isdir(dicom_folder):
         print(f"다이콤 폴더가 아님: {dicom_folder}")
-        return
+        return finish("no_dicom", error="다이콤 폴더가 아님")
 
-    patient_id = extract_patient_id(dicom_folder)
     output_folder = os.path.join(output_base, patient_id)
     os.makedirs(output_folder, exist_ok=True)
 
-    ##nii.gz 파일을 압축 풀기
-    temp_nii_gz = os.path.join(output_folder, f"{patient_id}_{phase}.nii.gz")
-    final_nii = temp_nii_gz.replace(".nii.gz", ".nii")
+    ##gz로 썼다가 다시 풀어서 저장하지 않고 처음부터 압축 없는 .nii로 바로 씀
+    final_nii = os.path.join(output_folder, f"{patient_id}_{phase}.nii")
 
-    if os.path.exists(final_nii):
+    ##manifest가 있으면 시리즈가 바뀌었는지까지 보고, 없으면 예전처럼 파일 존재만 확인
+    job_key = f"{patient_id}/{phase}"
+    if manifest_path:
+        if is_stage_done(manifest_path, "dicom2nifti", job_key, dicom_folder):
+            print(f"이미 변환됨: {final_nii}")
+            return finish("skipped", final_nii)
+    elif os.path.exists(final_nii):
         print(f"이미 변환됨: {final_nii}")
-        return
+        return finish("skipped", final_nii)
       
-    ##reorientation이 중요해서 convert_directiory 사용
+    ##reorientation이 중요해서 reorient_nifti 켜고 시리즈 하나만 변환
     try:
-        dicom2nifti.convert_directory(dicom_folder, output_folder, reorient=True)
-
-        
-        for f in os.listdir(output_folder):
-            if f.endswith(".nii.gz"):
-                temp_path = os.path.join(output_folder, f)
-                img = nib.load(temp_path)
-                nib.save(img, final_nii)
-                os.remove(temp_path)
-                print(f"변환 완료: {final_nii}")
-                return
-
-        print(f"NIfTI 파일을 찾을 수 없어ㅠㅠㅠㅠㅠㅠ: {dicom_folder}")
+        ##영상 슬라이스가 없는 폴더는 dicom2nifti 부르기 전에 색인으로 걸러냄
+        if not image_slices(dicom_folder, sop_class_uid=None):
+            print(f"CT 슬라이스가 없어요: {dicom_folder}")
+            return finish("no_dicom", error="CT 슬라이스 없음")
+
+        if not (fast and fast_dicom_to_nifti(dicom_folder, final_nii) is not None):
+            dicom2nifti.dicom_series_to_nifti(dicom_folder, final_nii, reorient_nifti=True)
+
+        if not os.path.exists(final_nii):
+            print(f"NIfTI 파일을 찾을 수 없어ㅠㅠㅠㅠㅠㅠ: {dicom_folder}")
+            return finish("failed", error="NIfTI 파일 없음")
+
+        record_stage(manifest_path, "dicom2nifti", job_key, dicom_folder, outputs=final_nii)
+        print(f"변환 완료: {final_nii}")
+        return finish("converted", final_nii)
     except Exception as e:
         print(f"변신하다 공격 받음: {dicom_folder} - {e}")
+        return finish("failed", error=str(e))
+
+##프로세스마다 dicom2nifti 설정이 따로라서 워커 시작할 때 다시 꺼줌
+def _init_worker():
+    dicom2nifti.settings.disable_validate_slice_increment()
+
+def _convert_job(job):
+    return convert_dicom_folder(*job)
+
+##환자 폴더들을 프로세스 풀로 나눠 변환하고 환자/phase별 결과 표(DataFrame)를 돌려줌
+def batch_convert_patients(root_folder: str, output_base: str, phases=("PRE",),
+                           max_workers: int = None, manifest_path: str = None,
+                           fast: bool = True) -> pd.DataFrame:
+    os.makedirs(output_base, exist_ok=True)
+    if manifest_path is None:
+        manifest_path = default_manifest_path(output_base)
+
+    jobs = []
+    for name in sorted(os.listdir(root_folder)):
+        patient_folder = os.path.join(root_folder, name)
+        for phase in phases:
+            phase_folder = os.path.join(patient_folder, phase)
+            if os.path.isdir(phase_folder):
+                jobs.append((phase_folder, output_base, phase, manifest_path, fast))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+        for result in tqdm(executor.map(_convert_job, jobs), total=len(jobs), desc="NIfTI 변환 中"):
+            results.append(result)
+
+    return pd.DataFrame(results, columns=["patient_id", "phase", "dicom_folder", "status",
+                                          "output", "error", "seconds"])
 
 def for_batch_convert_all_patients():
     root_folder = input("DICOM 루트 폴더 입력: ").strip('"').strip()
-    phase = input("PRE냐 POST냐 그것이 문제로다: ").strip().upper()
+    phase = input("PRE냐 POST냐 그것이 문제로다 (둘 다면 BOTH): ").strip().upper()
     output_base = input("출력 폴더 입력: ").strip('"').strip()
+    workers = input(f"동시에 변환할 프로세스 수 (기본 {os.cpu_count()}): ").strip()
 
     if not output_base:
         output_base = os.path.join(os.getcwd(), "converted_output")
@@ -58,20 +211,21 @@ def for_batch_convert_all_patients():
         print(f"잘못된 DICOM 루트 경로: {root_folder}")
         return
 
-    if phase not in ("PRE", "POST"):
-        print("PRE 또는 POST만 입력 가능")
+    if phase not in ("PRE", "POST", "BOTH"):
+        print("PRE, POST 또는 BOTH만 입력 가능")
         return
 
-    dicom2nifti.settings.disable_validate_slice_increment()
-    os.makedirs(output_base, exist_ok=True)
+    if workers and not workers.isdigit():
+        print("프로세스 수는 숫자로 입력 가능")
+        return
 
-    for name in sorted(os.listdir(root_folder)):
-        patient_folder = os.path.join(root_folder, name)
-        phase_folder = os.path.join(patient_folder, phase)
-        if os.path.isdir(phase_folder):
-            print(f"변환: {phase_folder}")
-            convert_dicom_folder(phase_folder, output_base, phase)
+    phases = ("PRE", "POST") if phase == "BOTH" else (phase,)
+    results = batch_convert_patients(root_folder, output_base, phases, int(workers) if workers else None)
 
-if __name__ == "__main__":
-    for_convert_all_patients()
+    results_csv = os.path.join(output_base, "conversion_results.csv")
+    results.to_csv(results_csv, index=False)
+    print(results["status"].value_counts().to_string())
+    print(f"결과 표 저장: {results_csv}")
 
+if __name__ == "__main__":
+    for_batch_convert_all_patients()
@@ -1,64 +1,224 @@
 import os
-import nibabel as nib
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+from scipy import ndimage
 from skimage import measure
-from stl import mesh
 from tqdm import tqdm
 
-def nifti_to_stl(nifti_path: str, stl_path: str, threshold: float = 0):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Common"))
+from manifest import default_manifest_path, is_stage_done, record_stage
+from volume_io import load_label_names, load_labelmap, load_mask
+from profiling import instrument, record_metric
+from mesh_decimation import cluster_decimate, taubin_smooth, weld_vertices
+from prefetch import DEFAULT_DEPTH, DEFAULT_MAX_BYTES, prefetch
+
+##STL 바이너리 레코드 한 개 (법선 3개, 꼭짓점 9개, attribute 2바이트) = 50바이트
+STL_RECORD_DTYPE = np.dtype([
+    ("normal", "<f4", (3,)),
+    ("vectors", "<f4", (3, 3)),
+    ("attr", "<u2"),
+])
+
+##마스크가 있는 영역만 잘라내고 바깥으로 0을 한 칸씩 덧대서 표면이 닫히도록 함, 잘린 시작 위치(offset)도 같이
+def crop_to_mask(binary_mask, pad: int = 1):
+    coords = [np.flatnonzero(np.any(binary_mask, axis=tuple(a for a in range(binary_mask.ndim) if a != axis)))
+              for axis in range(binary_mask.ndim)]
+    slices = tuple(slice(c[0], c[-1] + 1) for c in coords)
+    cropped = np.pad(np.asarray(binary_mask[slices]), pad, mode="constant", constant_values=False)
+    offset = np.array([s.start - pad for s in slices], dtype=np.float64)
+    return cropped, offset
+
+##잘라낸 마스크에 Marching Cubes 적용 후 offset 더하고 affine으로 실제 좌표(mm)로 변환
+def mesh_mask(binary_mask, affine, step_size: int = 1):
+    cropped, offset = crop_to_mask(binary_mask)
+    return mesh_cropped(cropped, offset, affine, step_size)
+
+def mesh_cropped(cropped, offset, affine, step_size: int = 1):
+    verts, faces, _, _ = measure.marching_cubes(cropped.astype(np.float32), level=0.5, step_size=step_size)
+    verts = (verts + offset) @ affine[:3, :3].T + affine[:3, 3]
+    ##STL은 바깥에서 봤을 때 반시계 방향이어야 해서, affine이 좌우를 뒤집지 않으면 감는 방향을 바꿔줌
+    if np.linalg.det(affine[:3, :3]) > 0:
+        faces = faces[:, ::-1]
+    return verts, faces
+
+##numpy-stl 없이 레코드 배열을 한 번에 채워서 바이너리 STL로 저장 (면 수와 레코드 모두 little-endian)
+def write_binary_stl(stl_path: str, verts, faces):
+    triangles = verts[faces]
+    records = np.zeros(len(faces), dtype=STL_RECORD_DTYPE)
+    records["vectors"] = triangles
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    records["normal"] = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+
+    stl_dir = os.path.dirname(stl_path)
+    if stl_dir:
+        os.makedirs(stl_dir, exist_ok=True)
+    with open(stl_path, "wb") as f:
+        f.write(b"binary STL from NIFTI_2_STL".ljust(80, b" "))
+        f.write(np.array(len(records), "<u4").tobytes())
+        records.tofile(f)
+
+##목표 면 수마다 간소화한 LOD 파일(_lod0, _lod1, ...)을 만들고 면 수와 파일 크기를 출력/반환
+def write_lods(stl_path: str, verts, faces, lod_faces=None) -> list:
+    report = [{"path": stl_path, "faces": len(faces), "bytes": os.path.getsize(stl_path)}]
+    root = stl_path[:-4] if stl_path.lower().endswith(".stl") else stl_path
+    for level, target in enumerate(sorted(lod_faces or [], reverse=True)):
+        lod_verts, lod_faces_ = cluster_decimate(verts, faces, target)
+        lod_path = f"{root}_lod{level}.stl"
+        write_binary_stl(lod_path, lod_verts, lod_faces_)
+        report.append({"path": lod_path, "faces": len(lod_faces_), "bytes": os.path.getsize(lod_path)})
+    for item in report:
+        print(f"  {os.path.basename(item['path'])}: 면 {item['faces']}개, {item['bytes'] / 1e6:.2f} MB")
+    return report
+
+##step_size를 키우면 더 거칠지만 빠른 메쉬
+##smooth_iterations > 0 이면 Taubin 스무딩, lod_faces=[200000, 50000] 처럼 주면 간소화한 LOD 파일도 같이
+##loaded에 미리 읽어 둔 (bool 마스크, img)를 주면 파일을 다시 안 읽음 (prefetch로 배치 돌릴 때)
+@instrument("stl")
+def nifti_to_stl(nifti_path: str, stl_path: str, threshold: float = 0, step_size: int = 1,
+                 smooth_iterations: int = 0, lod_faces=None, loaded=None):
     ##nibabel로 NIfTI 마스크가 갖고 있는 데이터부터 추출
     try:
-        img = nib.load(nifti_path)
-        data = img.get_fdata()
-        affine = img.affine
-
-        ##마스크 영역의 임계값을 정해서 어떤 느낌으로 갈지 결정 
-        binary_mask = data > threshold
+        ##마스크 영역의 임계값을 정해서 어떤 느낌으로 갈지 결정, float로 바꾸지 않고 저장된 값에 바로 비교
+        binary_mask, img = loaded if loaded is not None else load_mask(nifti_path, threshold)
         if not np.any(binary_mask):
             raise ValueError("Threshold보다 큰 값이 없는뎅... 마스크가 비어 있는 거 같애")
             
-        ##Marching Cubes 알고리즘 적용
-        verts, faces, _, _ = measure.marching_cubes(binary_mask.astype(np.float32), level=0)
-
-        verts_homogeneous = np.c_[verts, np.ones(len(verts))]
-        verts_transformed = np.dot(affine, verts_homogeneous.T).T[:, :3]
-
-        stl_mesh = mesh.Mesh(np.zeros(faces.shape[0], dtype=mesh.Mesh.dtype))
-        for i, f in enumerate(faces):
-            for j in range(3):
-                stl_mesh.vectors[i][j] = verts_transformed[f[j], :]
-
-        os.makedirs(os.path.dirname(stl_path), exist_ok=True)
-        stl_mesh.save(stl_path)
+        ##Marching Cubes 알고리즘 적용 (마스크 영역만 잘라서)
+        verts, faces = mesh_mask(binary_mask, img.affine, step_size)
+        record_metric("mask_voxels", int(np.count_nonzero(binary_mask)))
+        if smooth_iterations or lod_faces:
+            verts, faces = weld_vertices(verts, faces)
+            verts = taubin_smooth(verts, faces, smooth_iterations)
+        write_binary_stl(stl_path, verts, faces)
+        record_metric("faces", len(faces))
+        if lod_faces:
+            write_lods(stl_path, verts, faces, lod_faces)
         return True
 
     except Exception as e:
         print(f"Blast {nifti_path} 변환 오류: {e}")
         return False
         
+def _mesh_label_job(job):
+    cropped, offset, affine, step_size, stl_path = job
+    verts, faces = mesh_cropped(cropped, offset, affine, step_size)
+    write_binary_stl(stl_path, verts, faces)
+    return stl_path
+
+##다중 라벨 맵(--ml 결과)을 한 번만 읽고, find_objects로 라벨별 bounding box를 한 번에 찾아서
+##라벨마다 잘라낸 마스크만 워커 프로세스로 보내 STL을 동시에 만듦. ({라벨: stl 경로}, 메쉬 만들다 실패한 라벨 목록) 돌려줌
+def labelmap_to_stls(nifti_path: str, stl_dir: str, label_names: dict = None, step_size: int = 1,
+                     max_workers: int = None, loaded=None) -> dict:
+    label_names = label_names or {}
+    labelmap, img = loaded if loaded is not None else load_labelmap(nifti_path)
+    labelmap = np.asarray(labelmap)
+    if not np.issubdtype(labelmap.dtype, np.integer):
+        labelmap = np.rint(labelmap).astype(np.int32)
+
+    base_name = os.path.basename(nifti_path)
+    for ext in (".nii.gz", ".nii"):
+        if base_name.lower().endswith(ext):
+            base_name = base_name[:-len(ext)]
+            break
+
+    jobs = []
+    for index, slices in enumerate(ndimage.find_objects(labelmap)):
+        label = index + 1
+        if slices is None or (label_names and label not in label_names):
+            continue
+        cropped = np.pad(labelmap[slices] == label, 1, mode="constant", constant_values=False)
+        offset = np.array([s.start - 1 for s in slices], dtype=np.float64)
+        name = label_names.get(label, f"label_{label}")
+        stl_path = os.path.join(stl_dir, f"{base_name}_{name}.stl")
+        jobs.append((label, (cropped, offset, img.affine, step_size, stl_path)))
+
+    outputs = {}
+    failed_labels = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {label: executor.submit(_mesh_label_job, job) for label, job in jobs}
+        for label, future in futures.items():
+            try:
+                outputs[label] = future.result()
+            except Exception as e:
+                print(f"Blast {nifti_path} 라벨 {label} 변환 오류: {e}")
+                failed_labels.append(label)
+    return outputs, failed_labels
+
 ##위 nifti_to_stl 함수가 돌아가기 위해 어떤 방식일지 정의 
-def convert_all_nii_to_stl_simple(nii_base_path: str, stl_output_path: str, threshold: float = 0):
+##manifest에 마스크 지문과 threshold를 남겨서 다시 돌릴 때 바뀐 마스크만 새로 메쉬로 만듦
+##multilabel=True면 파일 하나를 다중 라벨 맵으로 보고 라벨마다 STL 하나씩 (이름은 label_names에서)
+##할 일 목록을 먼저 만들고, 지금 파일을 메쉬로 만드는 동안 다음 prefetch_depth개 마스크를 백그라운드에서 읽어 둠
+##환자 폴더 아래(Step 1의 {환자}/{phase}/ 포함)의 .nii.gz와 .nii를 다 찾고, STL은 같은 상대 경로에 확장자만 바꿔 둠
+def convert_all_nii_to_stl_simple(nii_base_path: str, stl_output_path: str, threshold: float = 0,
+                                  manifest_path: str = None, step_size: int = 1,
+                                  multilabel: bool = False, label_names: dict = None,
+                                  smooth_iterations: int = 0, lod_faces=None,
+                                  prefetch_depth: int = DEFAULT_DEPTH, prefetch_bytes: int = DEFAULT_MAX_BYTES):
     failed = []
+    if manifest_path is None:
+        manifest_path = default_manifest_path(stl_output_path)
 
-    for patient_folder in tqdm(os.listdir(nii_base_path), desc="환자별 STL 변환 中"):
+    jobs = []
+    for patient_folder in os.listdir(nii_base_path):
         patient_path = os.path.join(nii_base_path, patient_folder)
         if not os.path.isdir(patient_path):
             continue
 
-        for fname in os.listdir(patient_path):
-            if not fname.lower().endswith(".nii"):
-                continue
+        for folder, _, fnames in os.walk(patient_path):
+            relative = os.path.relpath(folder, nii_base_path)
+            for fname in sorted(fnames):
+                stem = next((fname[:-len(ext)] for ext in (".nii.gz", ".nii") if fname.lower().endswith(ext)), None)
+                if stem is None:
+                    continue
 
-            nii_path = os.path.join(patient_path, fname)
-            stl_dir = os.path.join(stl_output_path, patient_folder)
-            stl_filename = fname.replace(".nii", ".stl")
-            stl_path = os.path.join(stl_dir, stl_filename)
+                nii_path = os.path.join(folder, fname)
+                stl_dir = os.path.join(stl_output_path, relative)
+                stl_path = os.path.join(stl_dir, f"{stem}.stl")
 
-            success = nifti_to_stl(nii_path, stl_path, threshold)
-            if success:
-                print(f"만세 {stl_path}")
+                job_key = f"{relative.replace(os.sep, '/')}/{fname}"
+                params = {"threshold": threshold, "step_size": step_size,
+                          "smooth_iterations": smooth_iterations, "lod_faces": lod_faces}
+                if multilabel:
+                    params = {"step_size": step_size, "label_names": label_names}
+                if is_stage_done(manifest_path, "stl", job_key, nii_path, params):
+                    continue
+                jobs.append((nii_path, stl_dir, stl_path, job_key, params))
+
+    ##memmap 말고 실제로 읽어야 백그라운드에서 디스크를 기다림
+    def load(job):
+        if multilabel:
+            return load_labelmap(job[0], mmap=False)
+        mask, img = load_mask(job[0], threshold, mmap=False)
+        return np.asarray(mask), img
+
+    for job, loaded, error in tqdm(prefetch(jobs, load, prefetch_depth, prefetch_bytes), total=len(jobs),
+                                   desc="환자별 STL 변환 中"):
+        nii_path, stl_dir, stl_path, job_key, params = job
+        if error is not None:
+            print(f"Blast {nii_path} 읽기 오류: {error}")
+            failed.append(nii_path)
+            continue
+
+        if multilabel:
+            outputs, failed_labels = labelmap_to_stls(nii_path, stl_dir, label_names, step_size, loaded=loaded)
+            ##라벨 하나라도 실패하면 manifest에 안 남겨서 다음에 다시 돎
+            if outputs and not failed_labels:
+                record_stage(manifest_path, "stl", job_key, nii_path, params, list(outputs.values()))
+                print(f"만세 {stl_dir} ({len(outputs)}개 라벨)")
+            elif failed_labels:
+                failed.extend(f"{nii_path} (라벨 {label})" for label in failed_labels)
             else:
                 failed.append(nii_path)
+            continue
+
+        success = nifti_to_stl(nii_path, stl_path, threshold, step_size, smooth_iterations, lod_faces, loaded)
+        if success:
+            record_stage(manifest_path, "stl", job_key, nii_path, params, stl_path)
+            print(f"만세 {stl_path}")
+        else:
+            failed.append(nii_path)
 
     if failed:
         print("\n댕청해서 미안해...:")
@@ -70,5 +230,8 @@ def convert_all_nii_to_stl_simple(nii_base_path: str, stl_output_path: str, thre
 if __name__ == "__main__":
     nii_base = input("NIfTI 시리즈가 있는 폴더를 입력해요: ").strip()
     stl_base = input("어디에 두고 싶나요: ").strip()
-    convert_all_nii_to_stl_simple(nii_base, stl_base)
+    label_map = input("다중 라벨 맵이면 라벨 이름 파일 경로를 입력해요 (아니면 엔터): ").strip().strip('"')
+    multilabel = input("다중 라벨 맵인가요? (y/N): ").strip().lower() == "y" or bool(label_map)
+    convert_all_nii_to_stl_simple(nii_base, stl_base, multilabel=multilabel,
+                                  label_names=load_label_names(label_map))
 
@@ -0,0 +1,80 @@
+import numpy as np
+from scipy import sparse
+
+##Marching Cubes 메쉬 후처리 (NumPy/SciPy만 사용, CPU 노드용)
+##꼭짓점 합치기 -> 스무딩 -> 클러스터링 간소화 순서로 쓰고, 여러 단계(LOD) 파일을 만들 때 씀
+
+##거의 같은 위치의 꼭짓점을 하나로 합치고, 찌그러진 면(꼭짓점 중복)과 중복된 면을 지움
+def weld_vertices(verts, faces, tolerance: float = 1e-5):
+    keys = np.round(verts / tolerance).astype(np.int64)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    welded = verts[first]
+    faces = inverse.reshape(-1)[faces]
+    return welded, _clean_faces(faces)
+
+def _clean_faces(faces):
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    faces = faces[keep]
+    ##꼭짓점 순서만 다른 같은 면은 하나만 남김 (감는 방향은 처음 것 유지)
+    _, unique_index = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    return faces[np.sort(unique_index)]
+
+##안 쓰는 꼭짓점을 빼고 번호를 다시 매김
+def _compact(verts, faces):
+    used, inverse = np.unique(faces, return_inverse=True)
+    return verts[used], inverse.reshape(faces.shape)
+
+def _adjacency(n_verts, faces):
+    i = np.concatenate([faces[:, 0], faces[:, 1], faces[:, 2], faces[:, 1], faces[:, 2], faces[:, 0]])
+    j = np.concatenate([faces[:, 1], faces[:, 2], faces[:, 0], faces[:, 0], faces[:, 1], faces[:, 2]])
+    adj = sparse.coo_matrix((np.ones(len(i)), (i, j)), shape=(n_verts, n_verts)).tocsr()
+    adj.data[:] = 1.0
+    degree = np.asarray(adj.sum(axis=1)).ravel()
+    degree[degree == 0] = 1.0
+    ##이웃 평균을 구하는 행렬
+    return sparse.diags(1.0 / degree) @ adj
+
+##Taubin 스무딩(lambda로 당기고 mu로 다시 밀어서 부피가 줄어드는 걸 막음), mu=0이면 그냥 라플라시안 스무딩
+def taubin_smooth(verts, faces, iterations: int = 10, lam: float = 0.5, mu: float = -0.53):
+    if iterations <= 0:
+        return verts
+    average = _adjacency(len(verts), faces)
+    verts = verts.astype(np.float64, copy=True)
+    for _ in range(iterations):
+        verts += lam * (average @ verts - verts)
+        if mu:
+            verts += mu * (average @ verts - verts)
+    return verts
+
+def laplacian_smooth(verts, faces, iterations: int = 10, lam: float = 0.5):
+    return taubin_smooth(verts, faces, iterations, lam, mu=0.0)
+
+##격자 한 칸 안의 꼭짓점을 평균 위치 하나로 합치는 간소화 (cell_size mm)
+def cluster_decimate_cell(verts, faces, cell_size: float):
+    cells = np.floor((verts - verts.min(axis=0)) / cell_size).astype(np.int64)
+    _, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    n_clusters = inverse.max() + 1
+    counts = np.bincount(inverse, minlength=n_clusters)[:, None]
+    clustered = np.zeros((n_clusters, 3))
+    np.add.at(clustered, inverse, verts)
+    clustered /= counts
+    faces = _clean_faces(inverse[faces])
+    return _compact(clustered, faces)
+
+##목표 면 수 이하가 되는 가장 작은 격자 크기를 이분 탐색으로 찾아서 간소화
+def cluster_decimate(verts, faces, target_faces: int, iterations: int = 12):
+    if len(faces) <= target_faces:
+        return verts, faces
+    extent = float(np.max(verts.max(axis=0) - verts.min(axis=0)))
+    edge = np.linalg.norm(verts[faces[:, 1]] - verts[faces[:, 0]], axis=1).mean()
+    low, high = edge * 0.5, extent
+    best = None
+    for _ in range(iterations):
+        cell = (low + high) / 2
+        result = cluster_decimate_cell(verts, faces, cell)
+        if len(result[1]) <= target_faces:
+            best, high = result, cell
+        else:
+            low = cell
+    return best if best is not None else cluster_decimate_cell(verts, faces, high)
@@ -1,26 +1,181 @@
 import os
-import nibabel as nib
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd 
+from tqdm import tqdm
 
-##DICOM 전체를 NifTI로 돌린 폴더를 입력
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Common"))
+from volume_io import load_mask, load_volume
+from cohort import discover_cases
+from volume_store import read_roi, store_cases
+from prefetch import DEFAULT_BATCH_BYTES, DEFAULT_MAX_BYTES, per_worker_bytes, prefetch, split_chunks
+
+##OncoSoft 버전에서 주로 나오던 bin 영역대로 설정, 1 HU 간격 (-184 ~ 697, 마지막 bin은 697 포함)
+HU_LOW = -184
+HU_HIGH = 697
+BIN_EDGES = np.arange(HU_LOW, HU_HIGH + 1, 1)
+BIN_CENTERS = ((BIN_EDGES[:-1] + BIN_EDGES[1:]) / 2).astype(int)
+
+##DICOM 전체를 NifTI로 돌린 폴더를 입력, float64로 바꾸지 않고 int16 그대로 (memmap)
 def load_dcmnifti(CT_path):
     try:
-        dcmdata = nib.load(CT_path).get_fdata()
+        dcmdata, _ = load_volume(CT_path)
         return dcmdata
     except Exception as e:
         print(f'CT nii 파일 로딩 안 됨...: {e}')
         return None
+##마스크는 바로 bool로
 def load_masknifti(mask_path):
     try:
-        niftidata = nib.load(mask_path).get_fdata()
+        niftidata, _ = load_mask(mask_path)
         return niftidata
     except Exception as e:
         print(f"마스크 로딩 안 됨...: {e}")
         return None
 
+##np.histogram(values, bins=BIN_EDGES)와 같은 결과를 정수 bincount로 (범위 밖은 버림)
+##범위 밖 값을 양 끝 한 칸씩으로 모은 뒤 잘라내고, 697은 마지막 bin에 합침
+##float(스케일된) CT는 0 쪽으로 자르면 -0.5가 0 bin에 들어가니 내림하고, 697 초과(697.9 등)는 미리 버림
+def hu_histogram(values):
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.integer):
+        values = np.clip(np.floor(values[values <= HU_HIGH]), HU_LOW - 1, HU_HIGH + 1)
+    values = np.clip(values.astype(np.int32, copy=False), HU_LOW - 1, HU_HIGH + 1)
+    counts = np.bincount(values - (HU_LOW - 1), minlength=HU_HIGH - HU_LOW + 3)[1:-1]
+    counts[-2] += counts[-1]
+    return counts[:-1]
+
+def histogram_table(hist_counts):
+    hist_portions = hist_counts / hist_counts.sum()
+    return pd.DataFrame({'Bin Center': BIN_CENTERS, 'Portions': hist_portions})
+
+##plt.show() 없이 파일로만 그림 저장 (워커 프로세스에서도 돌 수 있게 Figure 객체 직접 사용)
+def save_histogram_plot(hist_counts, plot_path, title="HU Histogram"):
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(8, 4))
+    ax = fig.add_subplot()
+    ax.stairs(hist_counts, BIN_EDGES, fill=True, color='gray')
+    ax.set_title(title)
+    ax.set_xlabel("Hounsfield Unit (HU)")
+    ax.set_ylabel("Voxel Count")
+    fig.savefig(plot_path, dpi=100)
+
+##환자/phase 한 건: CT와 마스크를 읽어 히스토그램 계산, 실패하면 error에 이유를 남김
+##store가 (저장소 폴더, 장기)면 NIfTI 대신 저장소에서 장기 bounding box에 걸친 블록만 읽음
+##preloaded에 load_job_volumes가 미리 읽어 둔 (CT, 마스크)를 주면 파일을 다시 안 읽음
+def histogram_case(job, preloaded=None):
+    patient_id, phase, ct_path, mask_path, plot_dir, store = job
+    try:
+        if mask_path is None:
+            raise FileNotFoundError("마스크 파일 없음")
+        if preloaded is not None:
+            ct_data, mask_data = preloaded
+        elif store:
+            ct_data, mask_data, _ = read_roi(store[0], patient_id, phase, store[1])
+        else:
+            ct_data, _ = load_volume(ct_path)
+            mask_data, _ = load_mask(mask_path)
+        if ct_data.shape != mask_data.shape:
+            raise ValueError(f"CT({ct_data.shape})와 마스크({mask_data.shape})의 shape이 달라요.")
+        hist_counts = hu_histogram(ct_data[mask_data])
+        if plot_dir:
+            os.makedirs(plot_dir, exist_ok=True)
+            save_histogram_plot(hist_counts, os.path.join(plot_dir, f"{patient_id}_{phase}_histogram.png"),
+                                f"HU Histogram {patient_id} {phase}")
+        return patient_id, phase, hist_counts, None
+    except Exception as e:
+        return patient_id, phase, None, str(e)
+
+##prefetch용 로더: CT와 마스크를 memmap 없이 메모리로 (저장소 케이스는 ROI 블록만)
+def load_job_volumes(job):
+    patient_id, phase, ct_path, mask_path, _, store = job
+    if mask_path is None:
+        return None
+    if store:
+        ct_data, mask_data, _ = read_roi(store[0], patient_id, phase, store[1])
+        return ct_data, mask_data
+    ct_data, _ = load_volume(ct_path, mmap=False)
+    mask_data, _ = load_mask(mask_path, mmap=False)
+    return np.asarray(ct_data), np.asarray(mask_data)
+
+##워커 하나가 작업 덩어리를 순서대로: 지금 환자 히스토그램을 계산하는 동안 다음 환자 볼륨을 미리 읽음
+##미리 읽기가 실패하면 histogram_case가 직접 읽다가 같은 오류를 남기므로 여기선 무시
+def histogram_cases(jobs, prefetch_depth=1, prefetch_bytes=DEFAULT_MAX_BYTES):
+    return [histogram_case(job, preloaded)
+            for job, preloaded, _ in prefetch(jobs, load_job_volumes, prefetch_depth, prefetch_bytes)]
+
+##환자 트리 전체를 프로세스 풀로 돌려 환자 x bin 행렬 하나로 저장 (.npz 또는 .parquet)
+##CSV 수천 개 대신 counts/portions 행렬과 실패 목록이 한 파일에 들어감, parquet 열 이름은 bin 시작 HU
+##store_path(volume_store 저장소)를 주면 ct_base/seg_base 대신 저장소에 든 환자를 돌림
+##prefetch_depth/prefetch_bytes: 워커마다 미리 읽을 환자 수, 모든 워커를 합친 미리 읽기 메모리 예산(워커 수로 나눠 씀)
+def batch_histograms(ct_base, seg_base, organ, output_path, phases=("PRE", "POST"),
+                     max_workers=None, plot_dir=None, store_path=None, prefetch_depth=1,
+                     prefetch_bytes=DEFAULT_BATCH_BYTES):
+    if store_path:
+        cases = store_cases(store_path, organ, phases)
+    else:
+        cases = discover_cases(ct_base, seg_base, organ, phases)
+    store = (store_path, organ) if store_path else None
+    jobs = [(c["patient_id"], c["phase"], c["ct_path"], c["mask_paths"][organ], plot_dir, store) for c in cases]
+
+    rows, failed = [], []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(total=len(jobs), desc="HU 히스토그램 계산 中") as pbar:
+        worker = partial(histogram_cases, prefetch_depth=prefetch_depth,
+                         prefetch_bytes=per_worker_bytes(prefetch_bytes, max_workers))
+        for chunk_results in executor.map(worker, split_chunks(jobs, max_workers)):
+            for patient_id, phase, hist_counts, error in chunk_results:
+                if error or hist_counts.sum() == 0:
+                    failed.append((patient_id, phase, error or "마스크 영역이 없습니다"))
+                else:
+                    rows.append((patient_id, phase, hist_counts))
+            pbar.update(len(chunk_results))
+
+    counts = np.array([r[2] for r in rows], dtype=np.int64).reshape(len(rows), len(BIN_CENTERS))
+    portions = counts / counts.sum(axis=1, keepdims=True) if len(rows) else counts.astype(float)
+    patient_ids = np.array([r[0] for r in rows])
+    row_phases = np.array([r[1] for r in rows])
+
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    if output_path.lower().endswith(".parquet"):
+        df = pd.concat([
+            pd.DataFrame({"patient_id": patient_ids, "phase": row_phases}),
+            pd.DataFrame(counts, columns=[f"count_{e}" for e in BIN_EDGES[:-1]]),
+            pd.DataFrame(portions, columns=[f"portion_{e}" for e in BIN_EDGES[:-1]]),
+        ], axis=1)
+        df.to_parquet(output_path, index=False)
+    else:
+        np.savez_compressed(output_path, patient_id=patient_ids, phase=row_phases, bin_center=BIN_CENTERS,
+                            counts=counts, portions=portions,
+                            failed=np.array(failed, dtype=str).reshape(-1, 3))
+
+    print(f"저장 완료: {output_path} (성공 {len(rows)}, 실패 {len(failed)})")
+    for patient_id, phase, error in failed:
+        print(f" - {patient_id}/{phase}: {error}")
+    return counts, failed
+
+##코호트 전체를 한 번에 돌리는 입력 받기
+def batch_main():
+    store_path = input('청크 저장소 폴더 (NIfTI 폴더에서 바로 읽으려면 엔터): ').strip().strip('"')
+    ct_base = seg_base = None
+    if not store_path:
+        ct_base = input('CT nii 루트 폴더를 입력해 보아요: ').strip().strip('"')
+        seg_base = input('Segmentation 루트 폴더를 입력해 보아요: ').strip().strip('"')
+    organ = input('장기 이름을 입력해 보아요: ').strip().lower()
+    output_path = input('결과 파일 경로 (.npz 또는 .parquet): ').strip().strip('"')
+    plot_dir = input('그림 저장 폴더 (안 그리려면 엔터): ').strip().strip('"')
+    batch_histograms(ct_base, seg_base, organ, output_path, plot_dir=plot_dir or None, store_path=store_path or None)
+
 def main():
+    if input('코호트 전체를 돌릴까요? (y/N): ').strip().lower() == 'y':
+        batch_main()
+        return
+
     print('nii Version')
     CT_path = input('CT의 nii 파일 경로를 입력해 보아요: ')
     mask_path = input('mask nii 파일 경로를 입력해 보아요: ')
@@ -38,8 +193,8 @@ def main():
     if os.path.isdir(output_path):
         output_path = os.path.join(output_path, 'histo_mask.csv')
 
-        ct_data = load_dcmnifti(CT_path)
-        mask_data = load_masknifti(mask_path)
+    ct_data = load_dcmnifti(CT_path)
+    mask_data = load_masknifti(mask_path)
 
     if ct_data is None or mask_data is None:
         return
@@ -49,23 +204,17 @@ def main():
         return
 
     ##masked_voxels는 전체 DICOM NifTi 파일에 대해 NifTI Mask와 같은 값만 추출
-    masked_voxels = ct_data[mask_data>0]    
+    masked_voxels = ct_data[mask_data]
 
     if masked_voxels.size == 0:
         print('마스크 영역이 없습니다...')
         return 
 
-    ##OncoSoft 버전에서 주로 나오던 bin 영역대로 설정 
-    bins = np.arange(-184, 698, 1)
-    hist_counts, hist_bins = np.histogram(masked_voxels, bins=bins)
-    hist_portions = hist_counts/hist_counts.sum()
-    hist_centers = (hist_bins[:-1]+hist_bins[1:])/2
-    df = pd.DataFrame({
-        'Bin Center': hist_centers.astype(int), 'Portions': hist_portions
-        })
+    hist_counts = hu_histogram(masked_voxels)
+    df = histogram_table(hist_counts)
     df.to_csv(output_path, index=False)
 
-    plt.hist(masked_voxels.flatten(), bins=bins, color='gray')
+    plt.stairs(hist_counts, BIN_EDGES, fill=True, color='gray')
     plt.title("HU Histogram")
     plt.xlabel("Hounsfield Unit (HU)")
     plt.ylabel("Voxel Count")
@@ -1,7 +1,21 @@
+import multiprocessing
 import os
+import queue
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import SimpleITK as sitk
-from radiomics import featureextractor
+from radiomics import featureextractor, imageoperations
 import pandas as pd
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Common"))
+from cohort import discover_cases
+from profiling import failed_status, instrument, process_peak_rss_mb
+from feature_cache import DEFAULT_CACHE_PATH, cache_get, cache_put, content_hash, make_key
+from geometry import LPS_TO_RAS
+from volume_store import read_roi, store_cases
+from prefetch import DEFAULT_BATCH_BYTES, DEFAULT_MAX_BYTES, per_worker_bytes, prefetch, split_chunks
 
 ##둘 다 NifTI 파일로 데이터를 불러와 Radiomics를 추출할 수 있지만 축 일치 문제를 고려했을 때 SimpleITK를 둘 다 적용해 
 ##사전에 생길 수 있는 문제를 차단하고자 함 
@@ -18,21 +32,138 @@ def load_image(image_path):
         raise ValueError("DICOM 이미지가 아닌데...")
     return image
 
-def run_extraction(image_path, mask_path, param_path=None, output_csv=None):
-    image = load_image(image_path)
+##YAML 경로마다 extractor를 한 번만 만들고 프로세스 안에서 계속 재사용
+_EXTRACTORS = {}
+
+def get_extractor(param_path=None):
+    ##parameters를 정의, yaml 경로 
+    key = param_path if param_path and os.path.exists(param_path) else None
+    if key not in _EXTRACTORS:
+        if key:
+            _EXTRACTORS[key] = featureextractor.RadiomicsFeatureExtractor(key)
+            print(f"너로 정했다: {key}")
+        else:
+            _EXTRACTORS[key] = featureextractor.RadiomicsFeatureExtractor()
+            print("선택 장애는 기본이 좋아")
+    return _EXTRACTORS[key]
+
+##결과 키를 특징 클래스별로 나눔 (original_glcm_Contrast -> glcm, diagnostics_* 는 diagnostics로 따로)
+def _split_by_class(result):
+    groups = {}
+    for key, val in result.items():
+        cls = "diagnostics" if key.startswith("diagnostics") else key.split("_")[1]
+        groups.setdefault(cls, {})[key] = val
+    return groups
+
+##빠진 특징 클래스만 켜둔 extractor (YAML + 클래스 조합마다 한 번만 만듦)
+_SUB_EXTRACTORS = {}
+
+def get_sub_extractor(param_path, classes):
+    full = get_extractor(param_path)
+    key = (param_path if param_path and os.path.exists(param_path) else None, tuple(classes))
+    if key not in _SUB_EXTRACTORS:
+        sub = featureextractor.RadiomicsFeatureExtractor(key[0]) if key[0] else featureextractor.RadiomicsFeatureExtractor()
+        sub.disableAllFeatures()
+        sub.enableFeaturesByName(**{cls: full.enabledFeatures[cls] for cls in classes})
+        _SUB_EXTRACTORS[key] = sub
+    return _SUB_EXTRACTORS[key]
+
+##캐시를 거치는 execute: (CT 해시, 마스크 해시, 설정/이미지 타입/label, 특징 클래스)마다 따로 저장해서
+##YAML에서 클래스 하나만 바꾸면 그 클래스만 다시 계산함. 다 있으면 계산 없이 바로 돌려줌
+def cached_execute(image, mask, image_hash, mask_hash, param_path=None, label=1, cache_path=None):
+    extractor = get_extractor(param_path)
+    base = {"settings": extractor.settings, "imageTypes": extractor.enabledImagetypes, "label": label}
+    keys = {"diagnostics": make_key("radiomics", image_hash, mask_hash, dict(base, featureClass="diagnostics"))}
+    for cls, feats in extractor.enabledFeatures.items():
+        keys[cls] = make_key("radiomics", image_hash, mask_hash, dict(base, featureClass=cls, features=feats))
+
+    groups = {cls: cache_get(key, cache_path) for cls, key in keys.items()}
+    missing = [cls for cls, group in groups.items() if group is None]
+    if missing:
+        ##diagnostics만 빠졌으면 클래스 없이 돌려도 diagnostics는 나옴
+        feature_classes = [cls for cls in missing if cls != "diagnostics"]
+        result = get_sub_extractor(param_path, feature_classes).execute(image, mask, label=label)
+        computed = _split_by_class(result)
+        for cls in missing:
+            groups[cls] = computed.get(cls, {})
+            cache_put(keys[cls], "radiomics", groups[cls], cache_path)
+
+    result = {}
+    for group in groups.values():
+        result.update(group)
+    return result
+
+def load_mask_for(image, mask_path):
     mask = sitk.ReadImage(mask_path)
     mask.CopyInformation(image)
+    return mask
 
-    ##parameters를 정의, yaml 경로 
-    if param_path and os.path.exists(param_path):
-        extractor = featureextractor.RadiomicsFeatureExtractor(param_path)
-        print(f"너로 정했다: {param_path}")
-    else:
-        extractor = featureextractor.RadiomicsFeatureExtractor()
-        print("선택 장애는 기본이 좋아")
+##저장소에서 잘라 온 ROI 배열(NIfTI x, y, z 순서)을 SimpleITK 이미지로, RAS affine을 ITK의 LPS 원점/간격/방향으로 바꿈
+def _sitk_from_roi(array, affine):
+    image = sitk.GetImageFromArray(np.ascontiguousarray(np.asarray(array).transpose(2, 1, 0)))
+    affine = np.asarray(affine, dtype=np.float64)
+    lps = affine[:3, :3] * LPS_TO_RAS[:, None]
+    spacing = np.linalg.norm(lps, axis=0)
+    image.SetSpacing(spacing.tolist())
+    image.SetDirection((lps / spacing).ravel().tolist())
+    image.SetOrigin((affine[:3, 3] * LPS_TO_RAS).tolist())
+    return image
 
-    # 특징 추출, label 값을 정해야 하는데 각각의 label마다 매칭되는 장기가 존재, 췌장은 7
-    result = extractor.execute(image, mask, label = 7)
+##저장소 모드에서 장기 bounding box 밖으로 더 읽을 여유 (mm, 복셀): 원본 NIfTI 전체로 뽑은 것과 같은 특징이 나오게 설정에서 정함
+##필터는 CT 전체에 걸리지만 ROI 안 값은 가까운 이웃만 봄: LoG는 5σ(재귀 가우시안 꼬리가 1e-5 아래),
+##wavelet은 분해 한 번마다 필터 길이-1 복셀(pyradiomics는 레벨마다 같은 필터로 다시 분해), 기울기/LBP는 반경+1
+##preCrop이면 pyradiomics가 padDistance만큼 먼저 잘라 놓고 필터를 걸어서 그만큼만 있으면 됨
+##정규화, 리샘플링(격자가 잘린 위치에 따라 달라짐), Square 같은 영상 최댓값 기준 필터, 모르는 필터면 None (CT 전체를 읽음)
+STORE_FILTER_VOXELS = {"Original": 0, "Gradient": 1}
+
+def store_margin(extractor):
+    settings = extractor.settings
+    if settings.get("normalize") or settings.get("resampledPixelSpacing"):
+        return None
+    if settings.get("preCrop"):
+        return 0.0, int(settings.get("padDistance", 5)) + 1
+    margin_mm, margin_voxels = 0.0, 1
+    for image_type, custom in extractor.enabledImagetypes.items():
+        args = dict(settings, **custom)
+        if image_type in STORE_FILTER_VOXELS:
+            margin_voxels = max(margin_voxels, STORE_FILTER_VOXELS[image_type] + 1)
+        elif image_type == "LoG":
+            margin_mm = max([margin_mm] + [5.0 * sigma for sigma in args.get("sigma", [])])
+        elif image_type == "Wavelet":
+            import pywt
+            wavelet = pywt.Wavelet(args.get("wavelet", "coif1"))
+            levels = args.get("start_level", 0) + args.get("level", 1)
+            margin_voxels = max(margin_voxels, (wavelet.dec_len - 1) * levels + 1)
+        elif image_type == "LBP2D":
+            margin_voxels = max(margin_voxels, int(np.ceil(args.get("lbp2DRadius", 1))) + 1)
+        elif image_type == "LBP3D":
+            margin_voxels = max(margin_voxels, int(np.ceil(args.get("lbp3DIcosphereRadius", 1))) + 1)
+        else:
+            return None
+    return margin_mm, margin_voxels
+
+##volume_store 저장소에서 장기 주변 블록만 읽어 (CT 이미지, 마스크 이미지, ROI 정보), 마스크 label은 1
+##margin은 store_margin의 (mm, 복셀), None이면 CT 전체
+def load_store_roi(store, patient_id, phase, organ, margin=(0.0, 1)):
+    margin_mm, margin_voxels = margin if margin is not None else (0.0, None)
+    ct, mask, info = read_roi(store, patient_id, phase, organ, margin_mm, margin_voxels)
+    image = _sitk_from_roi(ct, info["affine"])
+    mask_image = _sitk_from_roi(mask.astype(np.uint8), info["affine"])
+    mask_image.CopyInformation(image)
+    return image, mask_image, info
+
+# 특징 추출, label 값을 정해야 하는데 각각의 label마다 매칭되는 장기가 존재, 췌장은 7
+@instrument("radiomics")
+def run_extraction(image_path, mask_path, param_path=None, output_csv=None, label=7, cache_path=None):
+    image = load_image(image_path)
+    mask = load_mask_for(image, mask_path)
+
+    if cache_path:
+        result = cached_execute(image, mask, content_hash(image_path, cache_path), content_hash(mask_path, cache_path),
+                                param_path, label, cache_path)
+    else:
+        extractor = get_extractor(param_path)
+        result = extractor.execute(image, mask, label = label)
 
     print("\n라디오 믹스 나온당:")
     for key, val in result.items():
@@ -50,7 +181,389 @@ def run_extraction(image_path, mask_path, param_path=None, output_csv=None):
         df.to_csv(output_csv, index=False)
         print(f"\n엑셀 저장 완료: {output_csv}")
 
+THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS")
+_thread_limits = []
+
+##워커 프로세스 시작할 때 스레드 수를 제한하고 YAML로 extractor를 미리 만들어 둠 (부모 환경 변수는 안 건드림)
+##이 모듈을 불러오면서 numpy가 이미 떠서 환경 변수는 워커가 나중에 띄우는 것용, 이미 뜬 BLAS/OpenMP 풀은 threadpoolctl로 줄임
+def _init_worker(param_path, threads_per_worker):
+    os.environ.update({key: str(threads_per_worker) for key in THREAD_ENV})
+    try:
+        from threadpoolctl import threadpool_limits
+        _thread_limits.append(threadpool_limits(limits=threads_per_worker))
+    except ImportError:
+        pass
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads_per_worker)
+    get_extractor(param_path)
+
+def _worker_pool(max_workers, param_path, threads_per_worker):
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(param_path, threads_per_worker))
+
+##환자/phase 한 건: CT를 한 번만 읽고, 장기(마스크 경로, label)마다 같은 이미지로 특징 추출
+##labels는 {장기: label 번호}, TotalSegmentator 장기별 마스크면 1
+##cache_path를 주면 CT/마스크 내용 해시로 특징 클래스별 캐시를 씀 (CT 해시는 환자마다 한 번)
+##preloaded는 load_case_images가 미리 읽어 둔 (이미지, {마스크 경로: 마스크 이미지})
+@instrument("radiomics", failed=failed_status)
+def extract_case(case, param_path=None, labels=None, cache_path=None, preloaded=None):
+    if case.get("store"):
+        return _extract_store_case(case, param_path, labels, cache_path)
+    labels = labels or {}
+    base = {"patient_id": case["patient_id"], "phase": case["phase"], "image": case["ct_path"]}
+    try:
+        image, masks = preloaded if preloaded is not None else (load_image(case["ct_path"]), {})
+    except Exception as e:
+        return [dict(base, organ=organ, status="failed", error=f"이미지 로딩 실패: {e}")
+                for organ in case["mask_paths"]]
+
+    extractor = get_extractor(param_path)
+    image_hash = content_hash(case["ct_path"], cache_path) if cache_path else None
+    masks = dict(masks)
+    rows = []
+    for organ, mask_path in case["mask_paths"].items():
+        row = dict(base, organ=organ, mask=mask_path)
+        if mask_path is None:
+            rows.append(dict(row, status="missing_mask", error="마스크 파일 없음"))
+            continue
+        try:
+            ##같은 다중 라벨 파일을 여러 장기가 같이 쓰면 한 번만 읽음
+            if mask_path not in masks:
+                masks[mask_path] = load_mask_for(image, mask_path)
+            if cache_path:
+                result = cached_execute(image, masks[mask_path], image_hash, content_hash(mask_path, cache_path),
+                                        param_path, labels.get(organ, 1), cache_path)
+            else:
+                result = extractor.execute(image, masks[mask_path], label=labels.get(organ, 1))
+            rows.append(dict(row, status="ok", error=None, **result))
+        except Exception as e:
+            rows.append(dict(row, status="failed", error=str(e)))
+    return rows
+
+##prefetch용 로더: CT 이미지와 마스크들을 미리 SimpleITK로 읽어 둠 (저장소 케이스는 장기마다 따로 읽어서 None)
+def load_case_images(case):
+    if case.get("store"):
+        return None
+    image = load_image(case["ct_path"])
+    masks = {}
+    for mask_path in case["mask_paths"].values():
+        if mask_path and mask_path not in masks:
+            masks[mask_path] = load_mask_for(image, mask_path)
+    return image, masks
+
+##워커 하나가 케이스 덩어리를 순서대로: 지금 환자 특징을 뽑는 동안 다음 환자 이미지를 백그라운드에서 읽음
+##미리 읽기가 실패하면 extract_case가 직접 읽다가 같은 오류를 행에 남기므로 여기선 무시
+##results(큐)를 주면 케이스가 끝날 때마다 그 행들을 큐에 넣고 빈 목록을 돌려줌 (덩어리가 다 끝나길 안 기다리고 바로 씀)
+def extract_cases(cases, param_path=None, labels=None, cache_path=None, prefetch_depth=1,
+                  prefetch_bytes=DEFAULT_MAX_BYTES, results=None):
+    rows = []
+    for case, preloaded, _ in prefetch(cases, load_case_images, prefetch_depth, prefetch_bytes):
+        case_rows = extract_case(case, param_path, labels, cache_path, preloaded)
+        if results is not None:
+            results.put(case_rows)
+        else:
+            rows.append(case_rows)
+    return rows
+
+##volume_store.store_cases 케이스: 장기마다 bounding box 주변(store_margin)만 읽어서 추출 (CT 전체를 풀지 않음)
+##저장소 마스크는 가져올 때 label 하나로 이미 골라 둔 bool이라, labels가 가져올 때와 다르면 그 장기는 실패로 남김
+##캐시 키는 저장소 배열 digest + 잘라낸 영역이라 원본 NIfTI로 뽑은 캐시와는 따로 쌓임
+def _extract_store_case(case, param_path=None, labels=None, cache_path=None):
+    labels = labels or {}
+    base = {"patient_id": case["patient_id"], "phase": case["phase"], "image": case["ct_path"]}
+    extractor = get_extractor(param_path)
+    margin = store_margin(extractor)
+    rows = []
+    for organ, mask_path in case["mask_paths"].items():
+        row = dict(base, organ=organ, mask=mask_path)
+        if mask_path is None:
+            rows.append(dict(row, status="missing_mask", error="저장소에 마스크 없음"))
+            continue
+        try:
+            image, mask, info = load_store_roi(case["store"], case["patient_id"], case["phase"], organ, margin)
+            label = labels.get(organ, 1)
+            if label != 1 and info["label"] != label:
+                rows.append(dict(row, status="failed", error=f"저장소 마스크는 label {info['label'] or '0 아닌 값 전부'}로 "
+                                 f"가져왔어요 (요청 label {label}), import_cohort에 labels를 주고 다시 가져와요"))
+                continue
+            if cache_path:
+                box = "_".join(f"{lo}-{hi}" for lo, hi in info["box"])
+                result = cached_execute(image, mask, f"{info['ct_digest']}@{box}", info["mask_digest"],
+                                        param_path, 1, cache_path)
+            else:
+                result = extractor.execute(image, mask, label=1)
+            rows.append(dict(row, status="ok", error=None, **result))
+        except Exception as e:
+            rows.append(dict(row, status="failed", error=str(e)))
+    return rows
+
+##ROI bounding box를 tile_size 칸씩 자르고, 각 타일에 커널 반경만큼 여유(halo)를 붙임 (numpy z, y, x 순서)
+##core는 이 타일이 결과를 책임지는 영역, halo는 경계 복셀의 커널이 이웃을 다 보도록 같이 넘기는 영역
+def voxel_tiles(mask, tile_size=32, radius=1):
+    coords = np.argwhere(mask)
+    if coords.size == 0:
+        return []
+    lo, hi = coords.min(axis=0), coords.max(axis=0) + 1
+    tiles = []
+    for start in np.ndindex(*[int(np.ceil((h - l) / tile_size)) for l, h in zip(lo, hi)]):
+        core = tuple(slice(l + i * tile_size, min(l + (i + 1) * tile_size, h)) for i, l, h in zip(start, lo, hi))
+        if not mask[core].any():
+            continue
+        halo = tuple(slice(max(c.start - radius, 0), min(c.stop + radius, n)) for c, n in zip(core, mask.shape))
+        tiles.append((core, halo))
+    return tiles
+
+##타일로 나눠도 통째로 돌린 것과 같은 맵이 나오는 설정인지: 원본 이미지만, 정규화/리샘플링/재분할 없이, maskedKernel
+##필터(LoG, wavelet 등)나 정규화는 잘린 타일 가장자리/통계에 따라 값이 달라져서 타일로 나누면 안 됨
+def _tiling_exact(extractor) -> bool:
+    settings = extractor.settings
+    return set(extractor.enabledImagetypes) == {"Original"} and not settings.get("normalize") \
+        and not settings.get("resampledPixelSpacing") and settings.get("resegmentRange") is None \
+        and settings.get("removeOutliers") is None and settings.get("maskedKernel", True)
+
+##voxel 맵용 extractor: 계산 못 한 복셀이 0과 헷갈리지 않게 initValue를 NaN으로
+##features((클래스, (특징, ...)), ...)를 주면 그것만 켜고, voxel_batch를 주면 YAML의 voxelBatch 대신 씀
+_VOXEL_EXTRACTORS = {}
+
+def get_voxel_extractor(param_path=None, features=None, voxel_batch=None):
+    key = (param_path if param_path and os.path.exists(param_path) else None, features, voxel_batch)
+    if key not in _VOXEL_EXTRACTORS:
+        extractor = featureextractor.RadiomicsFeatureExtractor(key[0]) if key[0] \
+            else featureextractor.RadiomicsFeatureExtractor()
+        if features:
+            extractor.disableAllFeatures()
+            extractor.enableFeaturesByName(**{cls: list(names) for cls, names in features})
+        extractor.settings["initValue"] = np.nan
+        if voxel_batch is not None:
+            extractor.settings["voxelBatch"] = voxel_batch
+        _VOXEL_EXTRACTORS[key] = extractor
+    return _VOXEL_EXTRACTORS[key]
+
+##전체 ROI를 PyRadiomics와 같은 구간(binWidth/binCount)으로 나눴을 때 나오는 회색조마다 대표 값 하나 + 최소/최대 값
+##이 값들이 타일 ROI에 들어 있으면 타일 ROI의 최소/최대(= 구간 경계)와 회색조 목록이 전체 ROI와 똑같아짐
+def _level_anchors(values, settings):
+    values = np.asarray(values).ravel()
+    levels = np.digitize(values, imageoperations.getBinEdges(values, **settings))
+    _, first = np.unique(levels, return_index=True)
+    return np.unique(np.concatenate([values[first], [values.min(), values.max()]]))
+
+##타일 하나: halo까지 붙은 CT/마스크로 voxel-based 추출해서 core 영역 맵만 돌려줌
+##maskedKernel(기본)은 커널 안의 ROI 복셀만 쓰므로 halo의 ROI 복셀도 마스크에 그대로 둬야 이음매 커널이 이웃을 봄
+##anchor 덩어리가 필요한 이유: voxel 모드도 복셀마다가 아니라 넘겨준 마스크 ROI 전체로 한 번 이산화함
+##  binWidth 경계는 ROI 최솟값에서, binCount 경계는 ROI 최소/최대에서 시작하고, 텍스처 행렬 크기(Ng)와 회색조 목록도 ROI에 있는 값으로 정함
+##  타일 ROI는 전체 ROI의 일부라 최소/최대와 회색조 목록이 달라서, 같은 복셀이라도 회색조 번호와 행렬 크기가 달라져 특징 값이 바뀜
+##  그래서 전체 ROI의 회색조마다 값 하나와 최소/최대(anchors)를 타일 뒤에 ROI로 덧대서 이산화 기준을 전체 ROI와 똑같이 맞춤
+##  덩어리는 ROI가 아닌 radius+1장 뒤에 있어서 실제 복셀의 커널에는 안 들어가고, anchor 복셀 맵은 core 밖이라 버려짐
+def _voxel_tile_job(job):
+    ct_tile, mask_tile, core_in_tile, origin, spacing, direction, param_path, label, radius, anchors = job
+    if anchors is not None:
+        plane = ct_tile.shape[1:]
+        ##덧댄 덩어리는 두 장 이상 꽉 채운 ROI라야 anchor 커널의 GLCM 방향이 비지 않음 (빈 방향이 있으면 MCC가 타일 전체에서 실패)
+        depth = max(2, -(-len(anchors) // int(np.prod(plane))))
+        ct_block = np.full(depth * int(np.prod(plane)), anchors[0], dtype=ct_tile.dtype)
+        ct_block[:len(anchors)] = anchors
+        mask_block = np.full(ct_block.shape, label, dtype=mask_tile.dtype)
+        gap = (radius + 1,) + plane
+        ct_tile = np.concatenate([ct_tile, np.full(gap, anchors[0], dtype=ct_tile.dtype),
+                                  ct_block.reshape((depth,) + plane)])
+        mask_tile = np.concatenate([mask_tile, np.zeros(gap, dtype=mask_tile.dtype),
+                                    mask_block.reshape((depth,) + plane)])
+
+    def as_image(array):
+        image = sitk.GetImageFromArray(array)
+        image.SetOrigin(origin)
+        image.SetSpacing(spacing)
+        image.SetDirection(direction)
+        return image
+
+    image, mask = as_image(ct_tile), as_image(mask_tile)
+    core_roi = mask_tile[core_in_tile] == label
+
+    def place(result, maps):
+        for name, feature_map in result.items():
+            if not isinstance(feature_map, sitk.Image):
+                continue
+            ##맵은 마스크 bounding box만큼만 나오므로 원점으로 타일 안 위치를 찾아서 타일 크기 배열에 넣음
+            index = image.TransformPhysicalPointToIndex(feature_map.GetOrigin())[::-1]
+            values = sitk.GetArrayFromImage(feature_map).astype(np.float32)
+            full = np.full(ct_tile.shape, np.nan, dtype=np.float32)
+            full[tuple(slice(i, i + n) for i, n in zip(index, values.shape))] = values
+            maps[name] = full[core_in_tile]
+        return maps
+
+    maps = place(get_voxel_extractor(param_path).execute(image, mask, label=label, voxelBased=True), {})
+    ##PyRadiomics는 배치 안에 한 복셀이라도 실패하면(MCC는 빈 GLCM 방향 하나로도) 그 특징을 배치 전체에서 버림
+    ##타일 가장자리에서 잘린 halo 커널 때문에 통째로 돌릴 땐 멀쩡한 특징이 타일에선 다 NaN이 될 수 있어서 복셀마다 다시 계산
+    failed = [name for name, values in maps.items() if anchors is not None and np.isnan(values[core_roi]).all()]
+    if failed:
+        features = {}
+        for name in failed:
+            _, cls, feature = name.split("_", 2)
+            features.setdefault(cls, []).append(feature)
+        features = tuple((cls, tuple(names)) for cls, names in sorted(features.items()))
+        place(get_voxel_extractor(param_path, features, voxel_batch=1).execute(image, mask, label=label,
+                                                                               voxelBased=True), maps)
+    return maps, core_roi, process_peak_rss_mb()
+
+##voxel-based 특징 맵: ROI를 커널 반경만큼 겹치는 타일로 나눠 프로세스 풀로 돌리고, 다시 이어 붙여
+##CT와 같은 geometry의 NIfTI(특징마다 한 파일)로 저장. {특징 이름: 파일 경로} 돌려줌
+##tile_size=None이거나 타일로 나누면 값이 달라지는 설정(_tiling_exact)이면 CT 전체를 한 번에 계산
+def voxel_feature_maps(image_path, mask_path, output_dir, param_path=None, label=1, tile_size=32,
+                       max_workers=None, threads_per_worker=1):
+    image = load_image(image_path)
+    mask = load_mask_for(image, mask_path)
+    ct = sitk.GetArrayFromImage(image)
+    roi = sitk.GetArrayFromImage(mask) == label
+    if not roi.any():
+        raise ValueError(f"label {label} 영역이 마스크에 없어요")
+    extractor = get_extractor(param_path)
+    radius = int(extractor.settings.get("kernelRadius", 1))
+    if tile_size and not _tiling_exact(extractor):
+        print("필터/정규화/리샘플링 설정이 있어서 타일로 나누지 않고 한 번에 계산해요")
+        tile_size = None
+
+    if tile_size:
+        tiles = voxel_tiles(roi, tile_size, radius)
+        anchors = _level_anchors(ct[roi], extractor.settings).astype(ct.dtype)
+    else:
+        whole = tuple(slice(0, n) for n in roi.shape)
+        tiles = [(whole, whole)]
+        anchors = None
+
+    jobs = []
+    for core, halo in tiles:
+        origin = image.TransformIndexToPhysicalPoint([int(s.start) for s in halo[::-1]])
+        core_in_tile = tuple(slice(c.start - h.start, c.stop - h.start) for c, h in zip(core, halo))
+        jobs.append((ct[halo], roi[halo].astype(np.uint8) * label, core_in_tile, origin,
+                     image.GetSpacing(), image.GetDirection(), param_path, label, radius, anchors))
+
+    maps = {}
+    with _worker_pool(max_workers, param_path, threads_per_worker) as executor:
+        futures = {executor.submit(_voxel_tile_job, job): core for job, (core, _) in zip(jobs, tiles)}
+        progress = tqdm(as_completed(futures), total=len(futures), desc="Voxel 맵 타일 계산 中")
+        for future in progress:
+            core = futures[future]
+            tile_maps, core_roi, rss_mb = future.result()
+            for name, values in tile_maps.items():
+                if name not in maps:
+                    maps[name] = np.zeros(ct.shape, dtype=np.float32)
+                maps[name][core][core_roi] = values[core_roi]
+            progress.set_postfix(voxels=int(core_roi.sum()),
+                                 rss_mb=f"{rss_mb:.0f}" if rss_mb is not None else "?")
+
+    os.makedirs(output_dir, exist_ok=True)
+    prefix = os.path.basename(mask_path).split(".")[0]
+    outputs = {}
+    for name, values in maps.items():
+        feature_image = sitk.GetImageFromArray(values)
+        feature_image.CopyInformation(image)
+        outputs[name] = os.path.join(output_dir, f"{prefix}_{name}.nii.gz")
+        sitk.WriteImage(feature_image, outputs[name])
+    print(f"Voxel 맵 {len(outputs)}개 저장 완료: {output_dir}")
+    return outputs
+
+##코호트 전체를 프로세스 풀로 나눠 돌리고, 환자 한 건이 끝날 때마다 큐로 받아서 바로 표 하나(CSV)에 이어 씀
+##중간에 멈춰도 그때까지 끝난 환자 결과는 남아 있음. store_path(volume_store 저장소)를 주면 저장소에 든 환자를 돌림
+##prefetch_depth/prefetch_bytes: 워커마다 미리 읽을 환자 수, 모든 워커를 합친 미리 읽기 메모리 예산(워커 수로 나눠 씀)
+def batch_extraction(ct_base, seg_base, organs, output_csv, param_path=None, phases=("PRE", "POST"),
+                     max_workers=None, threads_per_worker=1, labels=None, cache_path=None, store_path=None,
+                     prefetch_depth=1, prefetch_bytes=DEFAULT_BATCH_BYTES):
+    if store_path:
+        cases = store_cases(store_path, organs, phases)
+    else:
+        cases = discover_cases(ct_base, seg_base, organs, phases)
+    output_dir = os.path.dirname(output_csv)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    if os.path.exists(output_csv):
+        os.remove(output_csv)
+
+    ##열 순서는 첫 성공 결과 기준으로 고정, 그 전에 끝난 실패 행은 잠깐 모아뒀다가 같이 씀
+    columns = None
+    pending = []
+    counts = {}
+
+    def write(df):
+        df.reindex(columns=columns).to_csv(output_csv, mode="a", index=False,
+                                          header=not os.path.exists(output_csv))
+
+    ##워커마다 케이스 덩어리를 넘겨서 덩어리 안에서 다음 환자 이미지를 미리 읽게 하고, 결과는 환자마다 큐로 받음
+    ##큐가 비어 있는데 덩어리가 다 끝났으면(넣는 쪽은 큐에 들어간 뒤에야 돌아옴) 남은 게 없는 것, 워커 예외는 그때 올림
+    with _worker_pool(max_workers, param_path, threads_per_worker) as executor, \
+            multiprocessing.get_context("spawn").Manager() as manager, \
+            tqdm(total=len(cases), desc="Radiomics 추출 中") as pbar:
+        results = manager.Queue()
+        futures = [executor.submit(extract_cases, chunk, param_path, labels, cache_path, prefetch_depth,
+                                   per_worker_bytes(prefetch_bytes, max_workers), results)
+                   for chunk in split_chunks(cases, max_workers)]
+        while True:
+            try:
+                case_rows = results.get(timeout=1.0)
+            except queue.Empty:
+                if all(future.done() for future in futures) and results.empty():
+                    for future in futures:
+                        future.result()
+                    break
+                continue
+            pbar.update(1)
+            ##장기가 없거나 케이스에 마스크가 하나도 없으면 빈 목록이라 열도 없음
+            if not case_rows:
+                continue
+            df = pd.DataFrame(case_rows)
+            for status in df["status"]:
+                counts[status] = counts.get(status, 0) + 1
+            if columns is None:
+                pending.append(df)
+                if "ok" not in set(df["status"]):
+                    continue
+                columns = list(df.columns)
+                for waiting in pending:
+                    write(waiting)
+                pending = []
+            else:
+                write(df)
+
+    if pending:
+        columns = list(pd.concat(pending).columns)
+        for waiting in pending:
+            write(waiting)
+
+    print(f"\n엑셀 저장 완료: {output_csv}")
+    for status, count in counts.items():
+        print(f" - {status}: {count}")
+    return output_csv
+
+def batch_main():
+    store_path = input("청크 저장소 폴더 (NIfTI 폴더에서 바로 읽으려면 엔터): ").strip().strip('"')
+    ct_base = seg_base = None
+    if not store_path:
+        ct_base = input("CT NIfTI 루트 폴더: ").strip().strip('"')
+        seg_base = input("Segmentation 루트 폴더: ").strip().strip('"')
+    organs = input("장기 이름 (여러 개면 띄어쓰기): ").strip().lower().split()
+    param_path = input("YAML 파일 경로 입해요: ").strip().strip('"')
+    output_csv = input("결과 얻을 곳: ").strip().strip('"')
+    workers = input(f"프로세스 수 (기본 {os.cpu_count()}): ").strip()
+
+    batch_extraction(ct_base, seg_base, organs, output_csv, param_path or None,
+                     max_workers=int(workers) if workers.isdigit() else None, cache_path=DEFAULT_CACHE_PATH,
+                     store_path=store_path or None)
+
+def voxel_main():
+    image_path = input("CT NIfTI (또는 DICOM 폴더) 경로: ").strip().strip('"')
+    mask_path = input("원하는 장기 마스크 파일 경로: ").strip().strip('"')
+    param_path = input("YAML 파일 경로 입해요 (kernelRadius 포함): ").strip().strip('"')
+    output_dir = input("맵 저장 폴더: ").strip().strip('"')
+    label = input("label 번호 (기본 1): ").strip()
+    voxel_feature_maps(image_path, mask_path, output_dir, param_path or None,
+                       label=int(label) if label.isdigit() else 1)
+
 def main():
+    if input("코호트 전체를 돌릴까요? (y/N): ").strip().lower() == "y":
+        batch_main()
+        return
+    if input("Voxel 특징 맵으로 뽑을까요? (y/N): ").strip().lower() == "y":
+        voxel_main()
+        return
+
     print("PyRadiomics 특징 추출기")
     image_path = input("DICOM 파일들 있는 곳: ").strip()
     mask_path = input("원하는 장기 마스크 파일 경로: ").strip()
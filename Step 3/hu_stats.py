@@ -0,0 +1,153 @@
+import numpy as np
+
+##마스크 안 HU 값을 한 번만 훑으면서 합계/모멘트/최솟값/최댓값/정수 히스토그램을 같이 쌓는 누적기
+##조각(z 슬랩, 하위 영역, 환자)별로 만든 누적기를 merge로 합칠 수 있고, 합친 결과도 한 번에 계산한 것과 같음
+##모멘트는 Pébay 병합 공식을 써서 수치적으로 안정적, 중앙값/백분위수는 정수 히스토그램에서 정확히 계산
+##정수가 아닌 값(스케일링된 float 볼륨)은 1/FLOAT_BINS_PER_HU HU 폭 히스토그램에 가장 가까운 칸으로 넣어서 메모리가 값 범위에만 비례
+##이때 중앙값/백분위수는 근사값 (오차 최대 0.5/FLOAT_BINS_PER_HU HU), 평균/분산/왜도/첨도/최솟값/최댓값은 그대로 정확
+
+FLOAT_BINS_PER_HU = 10
+
+class HUStats:
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.total = 0
+        self.min = None
+        self.max = None
+        ##HU 히스토그램: hist[i]는 HU = (hist_offset + i) / bins_per_hu 인 복셀 수 (정수 값만 있으면 bins_per_hu = 1)
+        self.bins_per_hu = 1
+        self.hist_offset = 0
+        self.hist = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def from_values(cls, values):
+        stats = cls()
+        stats.update(values)
+        return stats
+
+    def update(self, values):
+        values = np.asarray(values).ravel()
+        if values.size == 0:
+            return self
+        chunk = HUStats()
+        chunk.n = values.size
+        as_float = values.astype(np.float64)
+        chunk.mean = float(as_float.mean())
+        centered = as_float - chunk.mean
+        squared = centered * centered
+        chunk.m2 = float(squared.sum())
+        chunk.m3 = float((squared * centered).sum())
+        chunk.m4 = float((squared * squared).sum())
+        chunk.min = values.min().item()
+        chunk.max = values.max().item()
+        if np.issubdtype(values.dtype, np.integer):
+            chunk.total = int(values.sum(dtype=np.int64))
+            bins = values.astype(np.int64)
+        else:
+            chunk.total = float(as_float.sum())
+            chunk.bins_per_hu = FLOAT_BINS_PER_HU
+            bins = np.rint(as_float * FLOAT_BINS_PER_HU).astype(np.int64)
+        chunk.hist_offset = int(bins.min())
+        chunk.hist = np.bincount(bins - chunk.hist_offset).astype(np.int64)
+        return self.merge(chunk)
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.__dict__.update(other.__dict__)
+            self.hist = other.hist.copy()
+            return self
+
+        na, nb = self.n, other.n
+        n = na + nb
+        delta = other.mean - self.mean
+        delta2 = delta * delta
+        m2 = self.m2 + other.m2 + delta2 * na * nb / n
+        m3 = (self.m3 + other.m3 + delta * delta2 * na * nb * (na - nb) / n ** 2
+              + 3.0 * delta * (na * other.m2 - nb * self.m2) / n)
+        m4 = (self.m4 + other.m4 + delta2 * delta2 * na * nb * (na * na - na * nb + nb * nb) / n ** 3
+              + 6.0 * delta2 * (na * na * other.m2 + nb * nb * self.m2) / n ** 2
+              + 4.0 * delta * (na * other.m3 - nb * self.m3) / n)
+        self.mean = self.mean + delta * nb / n
+        self.m2, self.m3, self.m4 = m2, m3, m4
+        self.n = n
+        self.total = self.total + other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._merge_hist(other)
+        return self
+
+    ##정수 히스토그램(칸 폭 1 HU)을 float 칸 폭으로 옮김, 정수 HU는 칸 중심에 딱 맞아서 정확함
+    @staticmethod
+    def _rescaled_hist(stats, bins_per_hu):
+        if stats.bins_per_hu == bins_per_hu:
+            return stats.hist_offset, stats.hist
+        factor = bins_per_hu // stats.bins_per_hu
+        hist = np.zeros((stats.hist.size - 1) * factor + 1, dtype=np.int64)
+        hist[::factor] = stats.hist
+        return stats.hist_offset * factor, hist
+
+    def _merge_hist(self, other):
+        bins_per_hu = max(self.bins_per_hu, other.bins_per_hu)
+        self_offset, self_hist = self._rescaled_hist(self, bins_per_hu)
+        other_offset, other_hist = self._rescaled_hist(other, bins_per_hu)
+        start = min(self_offset, other_offset)
+        end = max(self_offset + self_hist.size, other_offset + other_hist.size)
+        merged = np.zeros(end - start, dtype=np.int64)
+        merged[self_offset - start:self_offset - start + self_hist.size] += self_hist
+        merged[other_offset - start:other_offset - start + other_hist.size] += other_hist
+        self.bins_per_hu, self.hist_offset, self.hist = bins_per_hu, start, merged
+
+    ##rank번째(0부터) 작은 값 (float 칸이면 칸 중심 값)
+    def _value_at_rank(self, rank):
+        cumulative = np.cumsum(self.hist)
+        index = int(np.searchsorted(cumulative, rank, side="right")) + self.hist_offset
+        return index if self.bins_per_hu == 1 else index / self.bins_per_hu
+
+    ##np.percentile 기본(linear)과 같은 방식
+    def percentile(self, q):
+        if self.n == 0:
+            return float("nan")
+        position = q / 100.0 * (self.n - 1)
+        lower = int(np.floor(position))
+        upper = min(lower + 1, self.n - 1)
+        low_value = self._value_at_rank(lower)
+        if upper == lower or position == lower:
+            return float(low_value)
+        return float(low_value + (position - lower) * (self._value_at_rank(upper) - low_value))
+
+    def median(self):
+        return self.percentile(50)
+
+    def std(self):
+        return float(np.sqrt(self.m2 / self.n)) if self.n else float("nan")
+
+    ##scipy.stats.skew(bias=True)와 같은 값
+    def skewness(self):
+        if self.n == 0 or self.m2 == 0:
+            return float("nan")
+        return float(np.sqrt(self.n) * self.m3 / self.m2 ** 1.5)
+
+    ##scipy.stats.kurtosis(fisher=True, bias=True)와 같은 값
+    def kurtosis(self):
+        if self.n == 0 or self.m2 == 0:
+            return float("nan")
+        return float(self.n * self.m4 / (self.m2 * self.m2) - 3.0)
+
+##CT/마스크를 z 방향으로 chunk_slices장씩 잘라 읽으면서 누적 (memmap이면 그 조각만 메모리에 올라옴)
+##마스크가 없는 슬랩은 CT를 읽지 않고 넘어감
+def stream_hu_stats(ct, mask, chunk_slices: int = 32, stats: HUStats = None):
+    stats = stats if stats is not None else HUStats()
+    depth = ct.shape[2]
+    for z0 in range(0, depth, chunk_slices):
+        z1 = min(z0 + chunk_slices, depth)
+        mask_chunk = np.asarray(mask[:, :, z0:z1]) > 0
+        if not mask_chunk.any():
+            continue
+        stats.update(np.asarray(ct[:, :, z0:z1])[mask_chunk])
+    return stats
@@ -1,144 +1,214 @@
 import os
+import sys
 import nibabel as nib
+import numpy as np
 from rt_utils import RTStructBuilder
 import pydicom
 from pydicom.tag import Tag
 from tqdm import tqdm
 import multiprocessing
-from nibabel.orientations import affaxcodes, io_orientation
-def is_image_series(dicom_path):
-    ## 유효한 CT 이미지 시리즈인지 확인하는 코드, 부여된 ds.Modality와 UID, hasattr이 CT에 부여된 게 맞는지 조금 더 확장된 버전 
-    try:
-        ds = pydicom.dcmread(dicom_path, stop_before_pixels=True, force=True)
-        return (
-            ds.Modality == 'CT' and 
-            ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.2' and
-            hasattr(ds, 'ImagePositionPatient')
-        )
-    except Exception as e:
-        return False
+from functools import partial
 
-def get_slice_position(dicom_path):
-    ##x, y 좌표는 괜찮은데 Slice Increment 방지용으로 디버깅 해볼 데이터
-    ds = pydicom.dcmread(dicom_path, stop_before_pixels=True, force=True)
-    return float(ds.ImagePositionPatient[2])
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Common"))
+from manifest import default_manifest_path, is_stage_done, record_stage
+from dicom_index import image_slices
+from geometry import check_geometry, reorient_to_dicom, slice_normal
+from cohort import find_mask_path
+from profiling import instrument, record_metric
+from volume_io import load_label_names, load_labelmap, load_mask
+from prefetch import DEFAULT_BATCH_BYTES, DEFAULT_MAX_BYTES, per_worker_bytes, prefetch, split_chunks
 
 def validate_dicom_series(dicom_folder):
     ##DICOM 시리즈 유효성 검증 및 정렬된 슬라이스 반환
-    slices = []
-    for fname in os.listdir(dicom_folder):
-        if not fname.lower().endswith('.dcm'):
-            continue
-            
-        file_path = os.path.join(dicom_folder, fname)
-        if not is_image_series(file_path):
-            continue
-            
-        try:
-            z_pos = get_slice_position(file_path)
-            slices.append((z_pos, file_path))
-        except Exception as e:
-            continue
+    ##헤더는 dicom_index에서 파일당 한 번만 읽고(stop_before_pixels), 유효한 CT 영상 시리즈인지도 거기서 확인
+    headers = image_slices(dicom_folder)
     
-    if not slices:
+    if not headers:
         raise ValueError("유효한 DICOM 슬라이스가 없습니다")
         
-    # Z축 기준 정렬 (내림차순/오름차순 자동 감지)
-    slices.sort(key=lambda x: x[0])
-    if len(slices) > 1 and slices[0][0] > slices[1][0]:
-        slices = sorted(slices, key=lambda x: -x[0])
+    # 법선 방향 위치 기준 오름차순 정렬 (rt_utils가 마스크 3번째 축을 보는 순서와 같게)
+    normal = slice_normal(headers[0])
+    slices = sorted(
+        ((float(np.dot(normal, h["ImagePositionPatient"])), h["path"], h) for h in headers),
+        key=lambda x: x[0],
+    )
     
     return slices
 
-def validate_coordinate_system(dicom_slices, nifti_img):
+def validate_coordinate_system(dicom_slices, nifti_img, tol_mm=0.5):
     # DICOM-NIfTI 좌표계 일치 여부 검증
-    # DICOM 방향 정보 추출
-    sample_ds = pydicom.dcmread(dicom_slices[0][1], force=True)
-    dicom_orientation = tuple(map(float, sample_ds.ImageOrientationPatient))
-    
-    # NIfTI 방향 정보 변환
-    nifti_affine = nifti_img.affine
-    nifti_orientation = nib.aff2axcodes(nifti_affine)
+    ##헤더만 비교 (nib.load는 헤더만 읽고, DICOM 쪽은 색인된 IPP/IOP/PixelSpacing), 안 맞으면 마스크 읽기 전에 바로 탈락
+    ##슬라이스 전부의 모서리 좌표 오차(mm)와 축 바꿈/뒤집힘을 담은 report를 돌려줌
+    report = check_geometry(nifti_img.affine, nifti_img.shape[:3], [h for _, _, h in dicom_slices], tol_mm)
+    if not report["ok"]:
+        raise ValueError(f"좌표계 불일치: {report['message']}")
+    return report
 
-    print("DICOM ImageOrientationPatient:", dicom_orientation)
-    print("NIfTI Orientation (affine):", nifti_orient)
-    
-    # 좌표계 일치 여부 검증
-    if nifti_orientation not in [('R', 'A', 'S'), ('L', 'P', 'I')]:
-        raise ValueError(f"지원되지 않는 NIfTI 방향: {nifti_orientation}")
-    
-    # 실제 구현 시 DICOM orientation과의 상세 비교 필요
+##ROI 색 (장기 순서대로 돌려 씀), rt_utils에 색을 안 주면 매번 무작위라 뷰어에서 헷갈림
+ROI_COLORS = [
+    [255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 0], [255, 0, 255], [0, 255, 255],
+    [255, 128, 0], [128, 0, 255], [0, 128, 255], [255, 0, 128], [128, 255, 0], [0, 255, 128],
+]
+
+def roi_name(organ: str) -> str:
+    return organ.replace("_", " ").title()
+
+##환자/phase 폴더에서 장기 마스크 찾기. organs가 없으면 폴더 안 마스크 전부 ({환자}_{phase}_ 접두어는 떼고 장기 이름으로)
+def find_organ_masks(seg_base, patient_id, phase, organs=None) -> dict:
+    if organs:
+        return {organ: path for organ in organs
+                if (path := find_mask_path(seg_base, patient_id, phase, organ))}
+    folder = os.path.join(seg_base, patient_id, phase)
+    if not os.path.isdir(folder):
+        return {}
+    masks = {}
+    prefix = f"{patient_id}_{phase}_"
+    for fname in sorted(os.listdir(folder)):
+        for ext in (".nii.gz", ".nii"):
+            if fname.endswith(ext):
+                organ = fname[:-len(ext)]
+                masks[organ[len(prefix):] if organ.startswith(prefix) else organ] = os.path.join(folder, fname)
+                break
+    return masks
+
+##마스크 파일들을 (ROI 이름, bool 마스크, 마스크 경로)로. label_names가 있으면 다중 라벨 맵으로 보고 라벨마다 ROI 하나
+def collect_rois(mask_paths: dict, label_names: dict = None) -> list:
+    rois = []
+    for organ, mask_path in mask_paths.items():
+        if label_names:
+            labelmap, img = load_labelmap(mask_path)
+            for label in np.unique(labelmap):
+                if label in label_names:
+                    rois.append((roi_name(label_names[label]), labelmap == label, mask_path))
+        else:
+            mask_data, _ = load_mask(mask_path)
+            rois.append((roi_name(organ), np.asarray(mask_data), mask_path))
+    return rois
+
+##시리즈는 한 번만 읽고(rt_utils), 모든 ROI를 이름/색을 붙여 RTSTRUCT 하나에 넣음
+def build_rtstruct(dicom_path: str, rois: list, output_file: str):
+    rtstruct = RTStructBuilder.create_new(dicom_series_path=dicom_path)
+    for index, (name, mask, _) in enumerate(rois):
+        rtstruct.add_roi(mask=mask, name=name, color=ROI_COLORS[index % len(ROI_COLORS)])
+    rtstruct.save(output_file)
+    return output_file
+
+##I/O 쪽 절반: 경로/manifest 확인, 헤더로 좌표계 검증, 마스크 읽기 (배치에서는 prefetch로 다음 환자 것을 미리 돌림)
+##이미 끝난 작업이면 {"result": 결과 튜플}, 아니면 RTSTRUCT 만들 재료 dict. 문제가 있으면 예외
+def prepare_patient(patient_args) -> dict:
+    ##(환자, CT 루트, Seg 루트, 출력 루트[, manifest, phase, 장기 목록, 라벨 이름]) 뒤쪽은 생략 가능
+    patient_id, ct_base, seg_base, output_base = patient_args[:4]
+    extra = list(patient_args[4:]) + [None, "PRE", None, None][len(patient_args) - 4:]
+    manifest_path, phase, organs, label_names = extra[:4]
+
+    dicom_path = os.path.join(ct_base, patient_id, phase)
+    output_file = os.path.join(output_base, f"{patient_id}_{phase}_rtstruct.dcm")
+
+    # 1. 경로 유효성 검사
+    if not os.path.exists(dicom_path):
+        raise FileNotFoundError(f"DICOM 경로 없음: {dicom_path}")
+    mask_paths = find_organ_masks(seg_base, patient_id, phase, organs)
+    if not mask_paths:
+        raise FileNotFoundError(f"Segmentation 파일 없음: {os.path.join(seg_base, patient_id, phase)}")
+
+    ##시리즈와 마스크가 그대로고 RTSTRUCT도 남아 있으면 건너뜀
+    job_key = f"{patient_id}/{phase}"
+    inputs = [dicom_path, *mask_paths.values()]
+    params = {"organs": sorted(mask_paths), "label_names": label_names}
+    if is_stage_done(manifest_path, "rtstruct", job_key, inputs, params):
+        return {"result": (patient_id, "성공", output_file)}
 
-def process_patient(patient_args):
+    # 2. DICOM 시리즈 검증
+    dicom_slices = validate_dicom_series(dicom_path)
+
+    # 3. 좌표계 일치 여부 검증 (헤더만, 마스크 복셀을 읽기 전에)
+    reports = {path: validate_coordinate_system(dicom_slices, nib.load(path)) for path in mask_paths.values()}
+
+    # 4. NIfTI 파일 로드 (float 복사본 없이 바로 bool 마스크, 장기/라벨마다 ROI 하나)
+    rois = collect_rois(mask_paths, label_names)
+    if not rois:
+        raise ValueError("넣을 ROI가 없어요 (라벨 이름과 맞는 라벨이 없음)")
+
+    return {"patient_id": patient_id, "dicom_path": dicom_path, "output_base": output_base,
+            "output_file": output_file, "manifest_path": manifest_path, "job_key": job_key, "inputs": inputs,
+            "params": params, "reports": reports, "rois": rois}
+
+##(환자, 상태, 출력 경로)를 돌려주고 실패면 출력 경로가 None
+@instrument("rtstruct", failed=lambda result: result[2] is None and result[1])
+def process_patient(patient_args, prepared=None):
     # 병렬 처리를 위한 환자 단위 처리 함수
-    patient_id, ct_base, seg_base, output_base = patient_args
-    
+    ##prepared에 prepare_patient 결과를 주면 읽기는 건너뛰고 RTSTRUCT만 만듦
+    patient_id = patient_args[0]
+
     try:
-        dicom_path = os.path.join(ct_base, patient_id, "PRE")
-        mask_path = os.path.join(seg_base, patient_id, "PRE", "pancreas.nii.gz")
-        output_file = os.path.join(output_base, f"{patient_id}_PRE_rtstruct.dcm")
-
-        # 1. 경로 유효성 검사
-        if not os.path.exists(dicom_path):
-            raise FileNotFoundError(f"DICOM 경로 없음: {dicom_path}")
-        if not os.path.exists(mask_path):
-            raise FileNotFoundError(f"Segmentation 파일 없음: {mask_path}")
-
-        # 2. DICOM 시리즈 검증
-        dicom_slices = validate_dicom_series(dicom_path)
-        
-        # 3. NIfTI 파일 로드
-        mask_img = nib.load(mask_path)
-        mask_data = mask_img.get_fdata()
-        
-        # 4. 좌표계 일치 여부 검증
-        validate_coordinate_system(dicom_slices, mask_img)
-        
-        # 5. 슬라이스 수 일치 검증
-        if len(dicom_slices) != mask_data.shape[2]:
-            raise ValueError(
-                f"슬라이스 수 불일치 (DICOM: {len(dicom_slices)}, NIfTI: {mask_data.shape[2]})"
-            )
-
-        # 6. 이진 마스크 생성
-        binary_mask = mask_data > 0
-        
-        # 7. RTStruct 생성
-        rtstruct = RTStructBuilder.create_new(dicom_series_path=dicom_path)
-        rtstruct.add_roi(mask=binary_mask, name="Pancreas")
-        rtstruct.save(output_file)
+        if prepared is None:
+            prepared = prepare_patient(patient_args)
+        if "result" in prepared:
+            return prepared["result"]
+
+        # 5. 축 바꾸기/뒤집기만으로 DICOM 순서 (행, 열, 슬라이스)로 맞춤
+        rois = [(name, reorient_to_dicom(mask, prepared["reports"][path]), path)
+                for name, mask, path in prepared["rois"]]
 
-        return (patient_id, "성공", output_file)
+        # 6. RTStruct 생성 (시리즈 한 번 읽고 ROI 전부)
+        os.makedirs(prepared["output_base"], exist_ok=True)
+        build_rtstruct(prepared["dicom_path"], rois, prepared["output_file"])
+        record_metric("rois", len(rois))
+        record_stage(prepared["manifest_path"], "rtstruct", prepared["job_key"], prepared["inputs"],
+                     prepared["params"], outputs=prepared["output_file"])
+
+        return (patient_id, "성공", prepared["output_file"])
         
     except Exception as e:
         return (patient_id, f"실패: {str(e)}", None)
 
-def main():
+##워커 하나가 환자 덩어리를 순서대로 처리, 지금 환자 RTSTRUCT를 만드는 동안 다음 환자 마스크/헤더를 미리 읽음
+##(rt_utils가 시리즈 픽셀을 읽는 부분은 RTStructBuilder 안이라 그대로)
+def process_patients(chunk, prefetch_depth=1, prefetch_bytes=DEFAULT_MAX_BYTES):
+    results = []
+    for patient_args, prepared, error in prefetch(chunk, prepare_patient, prefetch_depth, prefetch_bytes):
+        if error is not None:
+            results.append((patient_args[0], f"실패: {error}", None))
+        else:
+            results.append(process_patient(patient_args, prepared))
+    return results
+
+##prefetch_depth/prefetch_bytes: 워커마다 미리 읽을 환자 수, 모든 워커를 합친 미리 읽기 메모리 예산(워커 수로 나눠 씀)
+def main(prefetch_depth=1, prefetch_bytes=DEFAULT_BATCH_BYTES):
     print("RTSTRUCT 생성기")
     
     # 경로 입력 및 검증
     ct_base = os.path.normpath(input("CT DICOM 루트 경로: ").strip().strip('"'))
     seg_base = os.path.normpath(input("Segmentation 루트 경로: ").strip().strip('"'))
     output_base = os.path.normpath(input("출력 루트 경로: ").strip().strip('"'))
+    phases = input("Phase (기본 PRE, 여러 개면 띄어쓰기): ").strip().upper().split() or ["PRE"]
+    organs = input("장기 이름 (여러 개면 띄어쓰기, 엔터면 있는 마스크 전부): ").strip().lower().split()
+    label_map = input("다중 라벨 맵이면 라벨 이름 파일 경로 (아니면 엔터): ").strip().strip('"')
 
     # 보안 검증
     if os.path.commonpath([ct_base, output_base]) == ct_base:
         raise ValueError("출력 경로가 입력 경로 내에 있습니다")
     
+    manifest_path = default_manifest_path(output_base)
+    label_names = load_label_names(label_map) or None
+
     ##Normal 환자에 대해서만이긴 하지만... 
     patients = [
-        (folder, ct_base, seg_base, output_base)
+        (folder, ct_base, seg_base, output_base, manifest_path, phase, organs or None, label_names)
         for folder in os.listdir(ct_base)
         if folder.isdigit() and os.path.isdir(os.path.join(ct_base, folder))
+        for phase in phases
     ]
 
-    ##연습 삼아 빠르게 시도 가능한지 병렬처리 도전
-    with multiprocessing.Pool() as pool:
-        results = list(tqdm(
-            pool.imap(process_patient, patients),
-            total=len(patients),
-            desc="환자 처리 진행 상황"
-        ))
+    ##연습 삼아 빠르게 시도 가능한지 병렬처리 도전, 워커마다 환자 덩어리를 받아 다음 환자를 미리 읽으면서 처리
+    results = []
+    workers = os.cpu_count() or 1
+    with multiprocessing.Pool(workers) as pool, tqdm(total=len(patients), desc="환자 처리 진행 상황") as pbar:
+        worker = partial(process_patients, prefetch_depth=prefetch_depth,
+                         prefetch_bytes=per_worker_bytes(prefetch_bytes, workers))
+        for chunk_results in pool.imap(worker, split_chunks(patients, workers)):
+            results.extend(chunk_results)
+            pbar.update(len(chunk_results))
 
     ##성공 케이스 셀 수 있도록 조정
     print("\n처리 결과:")
@@ -1,56 +1,304 @@
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import nibabel as nib
 import numpy as np
 import pandas as pd
-from scipy.stats import skew, kurtosis
+from scipy import ndimage
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Common"))
+from volume_io import load_volume
+from cohort import discover_cases
+from feature_cache import DEFAULT_CACHE_PATH, cache_get, cache_put, content_hash, make_key
+from hu_stats import HUStats, stream_hu_stats
+from profiling import failed_status, instrument, record_metric
+from volume_store import case_meta, read_roi, store_cases
+from prefetch import DEFAULT_BATCH_BYTES, DEFAULT_MAX_BYTES, per_worker_bytes, prefetch, split_chunks
 
 def load_nifti(path):
     return nib.load(path)
 
-def extract_hu_features(ct_path, mask_path):
-    try:
-        ct_img = load_nifti(ct_path)
-        mask_img = load_nifti(mask_path)
+##HUStats 누적기에서 특징 dict 만들기 (여러 환자/영역을 merge한 누적기에도 그대로 사용 가능)
+def features_from_stats(stats: HUStats, voxel_volume):
+    return {
+        "Integral_Total_HU": stats.total*0.001,
+        "Kurtosis": stats.kurtosis(),
+        "Max_HU": stats.max,
+        "Mean_HU": stats.total / stats.n,
+        "Median_HU": stats.median(),
+        "Min_HU": stats.min,
+        "Skewness": stats.skewness(),
+        "HU_STD": stats.std(),
+        "Total_HU": stats.total * voxel_volume,
+    }
+
+FEATURE_NAMES = [
+    "Integral_Total_HU", "Kurtosis", "Max_HU", "Mean_HU", "Median_HU",
+    "Min_HU", "Skewness", "HU_STD", "Total_HU",
+]
+
+##CT와 같은 격자의 마스크 배열로 특징 계산 (전체 볼륨이든 저장소에서 잘라 온 ROI든 같음)
+def _mask_features(ct, mask, voxel_volume, chunk_slices=32):
+    if mask.shape != ct.shape:
+        raise ValueError(f"❌ CT({ct.shape})와 마스크({mask.shape})의 shape이 달라요.")
+
+    stats = stream_hu_stats(ct, mask, chunk_slices)
+    record_metric("mask_voxels", stats.n)
+
+    if stats.n == 0:
+        raise ValueError("❌ 마스크 내부에 해당하는 CT 값이 없습니다.")
+    return features_from_stats(stats, voxel_volume)
+
+##이미 열어둔 CT(memmap)에 마스크 하나를 대서 특징 계산, 여러 장기를 CT 한 번 읽고 돌릴 때 씀
+def _features_for_mask(ct, ct_img, mask_path, chunk_slices=32):
+    mask, _ = load_volume(mask_path)
+    return _mask_features(ct, mask, np.prod(ct_img.header.get_zooms()), chunk_slices)
+
+##실패하면 0으로 채운 값을 돌려주지 않고 예외를 그대로 올림 (0은 진짜 데이터와 구분이 안 돼서)
+@instrument("hu_features")
+def extract_hu_features(ct_path, mask_path, chunk_slices=32):
+    ##CT와 마스크를 저장된 dtype 그대로(memmap) 열고 z 슬랩 단위로 한 번만 훑음
+    ##float64 복사본이나 정렬 없이 모멘트는 누적, 중앙값은 정수 히스토그램에서 계산
+    ct, ct_img = load_volume(ct_path)
+    return _features_for_mask(ct, ct_img, mask_path, chunk_slices)
+
+##장기 경계에서의 부호 있는 거리(mm) 구간. 바깥이 +, 안쪽이 - (이름, 하한 초과, 상한 이하)
+DEFAULT_SHELLS = [
+    ("core", -np.inf, -5.0),
+    ("inner_0_5mm", -5.0, 0.0),
+    ("outer_0_5mm", 0.0, 5.0),
+    ("outer_5_10mm", 5.0, 10.0),
+]
+
+##마스크 bounding box에 가장 바깥 shell 두께만큼(복셀 간격 고려) 여유를 두고 잘라낸 영역에서만 EDT 계산
+##전체 볼륨에 EDT를 돌리지 않아서 코호트 단위로 돌려도 부담이 적음. (sdf, 잘라낸 영역 slices) 돌려줌
+def signed_distance_roi(mask, spacing, margin_mm):
+    coords = np.nonzero(mask)
+    if coords[0].size == 0:
+        raise ValueError("❌ 마스크가 비어 있어요.")
+    slices = []
+    for axis, axis_coords in enumerate(coords):
+        pad = int(np.ceil(margin_mm / spacing[axis])) + 1
+        slices.append(slice(max(int(axis_coords.min()) - pad, 0),
+                            min(int(axis_coords.max()) + pad + 1, mask.shape[axis])))
+    slices = tuple(slices)
+    roi = np.asarray(mask[slices], dtype=bool)
+    outside = ndimage.distance_transform_edt(~roi, sampling=spacing)
+    inside = ndimage.distance_transform_edt(roi, sampling=spacing)
+    return outside - inside, slices
 
-        ct = ct_img.get_fdata()
-        mask = mask_img.get_fdata()
+##shell마다 extract_hu_features와 같은 통계를 계산. 잘라낸 영역의 복셀에 shell 번호를 한 번 매기고
+##번호 순으로 정렬해서 한 번에 나눠 담음. {shell 이름: 특징 dict}
+def shell_hu_features(ct_path, mask_path, shells=None):
+    shells = shells or DEFAULT_SHELLS
+    ct, ct_img = load_volume(ct_path)
+    mask, _ = load_volume(mask_path)
+    if mask.shape != ct.shape:
+        raise ValueError(f"❌ CT({ct.shape})와 마스크({mask.shape})의 shape이 달라요.")
+    return _shell_features(ct, ct_img.header.get_zooms()[:3], np.asarray(mask) > 0, shells)
 
-        hu_values = ct[mask > 0]
+##가장 바깥 shell 두께(mm), signed_distance_roi와 저장소 ROI 여유에 같이 씀
+def _shell_margin(shells):
+    return max(max(hi for _, _, hi in shells if np.isfinite(hi)), 0.0)
 
-        if len(hu_values) == 0:
-            raise ValueError("❌ 마스크 내부에 해당하는 CT 값이 없습니다.")
+def _shell_features(ct, spacing, mask, shells):
+    spacing = np.array(spacing, dtype=np.float64)
+    sdf, slices = signed_distance_roi(mask, spacing, _shell_margin(shells))
+    values = np.asarray(ct[slices]).ravel()
 
-        voxel_volume = np.prod(ct_img.header.get_zooms())
+    labels = np.full(sdf.size, -1, dtype=np.int32)
+    flat = sdf.ravel()
+    for index, (_, lo, hi) in enumerate(shells):
+        labels[(flat > lo) & (flat <= hi)] = index
 
-        features = {
-            "Integral_Total_HU": np.sum(hu_values)*0.001,
-            "Kurtosis": kurtosis(hu_values),
-            "Max_HU": np.max(hu_values),
-            "Mean_HU": np.mean(hu_values),
-            "Median_HU": np.median(hu_values),
-            "Min_HU": np.min(hu_values),
-            "Skewness": skew(hu_values),
-            "HU_STD": np.std(hu_values),
-            "Total_HU": np.sum(hu_values) * voxel_volume,
-        }
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.searchsorted(labels[order], np.arange(len(shells) + 1))
+    voxel_volume = np.prod(spacing)
 
-        return features
+    features = {}
+    for index, (name, _, _) in enumerate(shells):
+        shell_values = values[order[boundaries[index]:boundaries[index + 1]]]
+        if shell_values.size:
+            features[name] = features_from_stats(HUStats.from_values(shell_values), voxel_volume)
+        else:
+            features[name] = None
+    return features
 
+##장기 하나: 전체(whole) 행과 shell별 행을 만들어 돌려줌
+##load()는 (CT, 마스크, 복셀 간격)을 돌려주는 함수, NIfTI 전체든 저장소 ROI든 같은 식으로 계산
+def _organ_rows(row, load, chunk_slices=32, shells=None):
+    rows = []
+    try:
+        ct, mask, spacing = load()
+        rows.append(dict(row, status="ok", error=None,
+                         **_mask_features(ct, mask, np.prod(spacing), chunk_slices)))
     except Exception as e:
-        print(f"⚠️ 예외 발생: {e}")
-        return {
-            "Integral_Total_HU": 0,
-            "Kurtosis": 0,
-            "Max_HU": 0,
-            "Mean_HU": 0,
-            "Median_HU": 0,
-            "Min_HU": 0,
-            "Skewness": 0,
-            "HU_STD": 0,
-            "Total_HU": 0,
-        }
+        return [dict(row, status="failed", error=str(e))]
+    if not shells:
+        return rows
+    try:
+        for name, features in _shell_features(ct, spacing, np.asarray(mask) > 0, shells).items():
+            if features is None:
+                rows.append(dict(row, shell=name, status="failed", error="shell 안에 복셀이 없음"))
+            else:
+                rows.append(dict(row, shell=name, status="ok", error=None, **features))
+    except Exception as e:
+        rows.extend(dict(row, shell=name, status="failed", error=str(e)) for name, _, _ in shells)
+    return rows
+
+##환자/phase 한 건: CT는 한 번만 열고 장기 마스크마다 특징을 뽑아 status/error가 있는 행으로 돌려줌
+##shells를 주면 장기 전체(shell="whole") 행 뒤에 거리 구간별 행이 붙음
+##cache_path를 주면 (CT 내용, 마스크 내용, 특징/shell 목록)이 같은 장기는 캐시에서 꺼내고, 다 캐시에 있으면 CT도 안 읽음
+##volume_store.store_cases로 만든 케이스("store" 키)는 장기 bounding box(+ shell 여유)에 걸친 블록만 읽음
+##preloaded는 load_case_volumes가 미리 읽어 둔 CT/마스크 (없는 것만 여기서 읽음)
+@instrument("hu_features", failed=failed_status)
+def hu_features_case(case, chunk_slices=32, shells=None, cache_path=None, preloaded=None):
+    rows = []
+    preloaded = preloaded or {}
+    base = {"patient_id": case["patient_id"], "phase": case["phase"], "shell": "whole",
+            "CT_File": os.path.basename(case["ct_path"])}
+    params = _cache_params(shells)
+    store = case.get("store")
+    meta = case_meta(store, case["patient_id"], case["phase"]) if store else None
+    if store:
+        ct_hash = meta["ct"]["digest"]
+    else:
+        ct_hash = content_hash(case["ct_path"], cache_path) if cache_path else None
+    ct = ct_img = None
+
+    for organ, mask_path in case["mask_paths"].items():
+        row = dict(base, organ=organ, Mask_File=os.path.basename(mask_path) if mask_path else None)
+        if mask_path is None:
+            rows.append(dict(row, status="missing_mask", error="마스크 파일 없음"))
+            continue
+
+        cache_key = None
+        if cache_path:
+            mask_hash = meta["masks"][organ]["digest"] if store else content_hash(mask_path, cache_path)
+            cache_key = make_key("hu_features", ct_hash, mask_hash, params)
+            cached = cache_get(cache_key, cache_path)
+            if cached is not None:
+                rows.extend(dict(row, **cached_row) for cached_row in cached)
+                continue
+
+        if store:
+            load = partial(_store_roi, store, case, organ, shells)
+        else:
+            if ct is None:
+                try:
+                    ct, ct_img = preloaded["ct"] if "ct" in preloaded else load_volume(case["ct_path"])
+                except Exception as e:
+                    rows.append(dict(row, status="failed", error=f"CT 로딩 실패: {e}"))
+                    continue
+            load = partial(_nifti_arrays, ct, ct_img, mask_path, preloaded.get("masks", {}).get(mask_path))
+
+        organ_rows = _organ_rows(row, load, chunk_slices, shells)
+        if cache_key and organ_rows[0]["status"] == "ok":
+            keep = [k for k in organ_rows[0] if k not in row or k == "shell"]
+            cache_put(cache_key, "hu_features", [{k: r.get(k) for k in keep + ["status", "error"]}
+                                                  for r in organ_rows], cache_path)
+        rows.extend(organ_rows)
+    return rows
+
+def _nifti_arrays(ct, ct_img, mask_path, mask=None):
+    if mask is None:
+        mask, _ = load_volume(mask_path)
+    return ct, mask, ct_img.header.get_zooms()[:3]
+
+def _cache_params(shells):
+    return {"features": FEATURE_NAMES, "shells": [list(map(float, shell[1:])) + [shell[0]] for shell in shells or []]}
+
+##prefetch용 로더: 캐시에 없는 장기의 마스크와 CT를 memmap 없이 메모리로 읽어 둠, 다 캐시에 있거나 저장소 케이스면 None
+def load_case_volumes(case, shells=None, cache_path=None):
+    if case.get("store"):
+        return None
+    todo = [path for path in case["mask_paths"].values() if path]
+    if cache_path and todo:
+        ct_hash = content_hash(case["ct_path"], cache_path)
+        params = _cache_params(shells)
+        todo = [path for path in todo if cache_get(
+            make_key("hu_features", ct_hash, content_hash(path, cache_path), params), cache_path) is None]
+    if not todo:
+        return None
+    ct, ct_img = load_volume(case["ct_path"], mmap=False)
+    return {"ct": (np.asarray(ct), ct_img),
+            "masks": {path: np.asarray(load_volume(path, mmap=False)[0]) for path in todo}}
+
+##워커 하나가 케이스 덩어리를 순서대로: 지금 케이스를 계산하는 동안 다음 케이스 볼륨을 백그라운드에서 읽음
+##미리 읽기가 실패하면 hu_features_case가 직접 읽다가 같은 오류를 행에 남기므로 여기선 무시
+def hu_features_cases(cases, chunk_slices=32, shells=None, cache_path=None, prefetch_depth=1,
+                      prefetch_bytes=DEFAULT_MAX_BYTES):
+    loader = partial(load_case_volumes, shells=shells, cache_path=cache_path)
+    return [hu_features_case(case, chunk_slices, shells, cache_path, preloaded)
+            for case, preloaded, _ in prefetch(cases, loader, prefetch_depth, prefetch_bytes)]
+
+##shell 거리를 재려면 bounding box 밖으로 가장 바깥 shell 두께 + 1복셀만큼 더 읽어야 signed_distance_roi와 같은 영역이 됨
+def _store_roi(store, case, organ, shells):
+    margin = _shell_margin(shells) if shells else 0.0
+    ct, mask, info = read_roi(store, case["patient_id"], case["phase"], organ, margin, margin_voxels=1)
+    return ct, mask, info["zooms"]
+
+##코호트 전체: {patient_id}_{phase}_{organ}.nii.gz 규칙으로 CT/마스크 짝을 찾아 프로세스 풀로 돌리고
+##한 장의 표(환자, phase, 장기, status, error, 특징들)로 저장. 실패한 칸은 0이 아니라 비어 있음(NaN)
+##store_path(volume_store 저장소)를 주면 ct_base/seg_base 대신 저장소에 든 환자를 돌림
+##prefetch_depth/prefetch_bytes: 워커마다 미리 읽을 케이스 수, 모든 워커를 합친 미리 읽기 메모리 예산(워커 수로 나눠 씀)
+def batch_hu_features(ct_base, seg_base, organs, output_path, phases=("PRE", "POST"), max_workers=None,
+                      shells=None, cache_path=None, store_path=None, prefetch_depth=1,
+                      prefetch_bytes=DEFAULT_BATCH_BYTES):
+    if store_path:
+        cases = store_cases(store_path, organs, phases)
+    else:
+        cases = discover_cases(ct_base, seg_base, organs, phases)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(total=len(cases), desc="HU 특징 추출 中") as pbar:
+        chunk_results = executor.map(partial(hu_features_cases, shells=shells, cache_path=cache_path,
+                                             prefetch_depth=prefetch_depth,
+                                             prefetch_bytes=per_worker_bytes(prefetch_bytes, max_workers)),
+                                     split_chunks(cases, max_workers))
+        for chunk_rows in chunk_results:
+            for case_rows in chunk_rows:
+                rows.extend(case_rows)
+            pbar.update(len(chunk_rows))
+
+    columns = ["patient_id", "phase", "organ", "shell", "status", "error", "CT_File", "Mask_File"] + FEATURE_NAMES
+    df = pd.DataFrame(rows, columns=columns)
+
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    if output_path.lower().endswith(".parquet"):
+        df.to_parquet(output_path, index=False)
+    else:
+        df.to_csv(output_path, index=False)
+
+    print(f"✅ 저장 완료: {output_path}")
+    print(df["status"].value_counts().to_string())
+    return df
+
+def batch_main():
+    store_path = input("📦 청크 저장소 폴더 (NIfTI 폴더에서 바로 읽으려면 엔터): ").strip().strip('"').replace('\\', '/')
+    ct_base = seg_base = None
+    if not store_path:
+        ct_base = input("📁 CT NIfTI 루트 폴더 입력: ").strip().strip('"').replace('\\', '/')
+        seg_base = input("📁 Segmentation 루트 폴더 입력: ").strip().strip('"').replace('\\', '/')
+    organs = input("🫁 장기 이름 입력 (여러 개면 띄어쓰기): ").strip().lower().split()
+    phase = input("PRE, POST, BOTH 중 입력: ").strip().upper()
+    output_path = input("💾 결과 저장 경로 입력 (.csv 또는 .parquet): ").strip().strip('"').replace('\\', '/')
+    use_shells = input("🧅 장기 안팎 거리 구간(shell)별 특징도 뽑을까요? (y/N): ").strip().lower() == "y"
+
+    phases = ("PRE", "POST") if phase == "BOTH" else (phase,)
+    batch_hu_features(ct_base, seg_base, organs, output_path, phases, shells=DEFAULT_SHELLS if use_shells else None,
+                      cache_path=DEFAULT_CACHE_PATH, store_path=store_path or None)
 
 def main():
+    if input("코호트 전체를 돌릴까요? (y/N): ").strip().lower() == "y":
+        batch_main()
+        return
+
     print("🔍 단일 CT + 마스크 파일 HU 특징 추출")
     ct_path = input("📄 CT NIfTI 파일 경로 입력: ").strip().strip('"').replace('\\', '/')
     mask_path = input("📄 마스크 NIfTI 파일 경로 입력: ").strip().strip('"').replace('\\', '/')
@@ -63,7 +311,11 @@ def main():
         print(f"❌ 마스크 파일이 존재하지 않음: {mask_path}")
         return
 
-    features = extract_hu_features(ct_path, mask_path)
+    try:
+        features = extract_hu_features(ct_path, mask_path)
+    except Exception as e:
+        print(f"⚠️ 예외 발생: {e}")
+        return
     features["CT_File"] = os.path.basename(ct_path)
     features["Mask_File"] = os.path.basename(mask_path)
 